@@ -1,52 +1,64 @@
+import asyncio
 import os
 from datetime import datetime
 from time import perf_counter
 from typing import Any
 from uuid import uuid4
 
-import pyaudio
 from loguru import logger
-from openai import AsyncOpenAI
-from termcolor import colored
-
-from src.chat import ahandle_stream, extract_tool_input_args
-from src.gui import WaveformVisualizer
-from src.persistence import save_json_chat_history
+from openai import AsyncOpenAI, AsyncStream, BadRequestError
+
+from src.chat import ahandle_stream, assistant_tool_call_message, rejects_native_tools, to_text_protocol, tool_output_message
+from src.completion_cache import completion_cache, completion_key, is_cacheable
+from src.intent import FastPathStats, IntentMatch, IntentMatcher
+from src.memory import format_memories, memory_index
+from src.offload import offload
+from src.persistence import save_transcript
+from src.profiling import LoopWatchdog, SamplingProfiler
+from src.pydantic_classes import ToolCall
+from src.render import TokenRenderer
+from src.scheduler import scheduler, set_turn_deadline
 from src.settings import Settings
-from src.stt import capture_voice_input
-from src.tools.google_tools.base import GoogleTool
-from src.tools.google_tools.credentials import GoogleCredsConfig, GoogleCredsManager
-from src.tools.google_tools.executors import CalendarInsertExecutor, CalendarReadExecutor, GmailReadExecutor, GmailWriteExecutor
-from src.tools.news import NewspaperFrontTool
-from src.tools.utils import prepare_schemas
-from src.tools.weather import WeatherTool
-from src.tts import play_audio
+from src.speculative import SpeculationStats, SpeculativeTurn
+from src.tools.registry import tool_registry
+from src.tools.utils import prepare_schemas, prepare_tool_definitions
+from src.transcript import Transcript
 
 settings: Settings = Settings()
-p = pyaudio.PyAudio()
-openai_client = AsyncOpenAI(api_key=settings.openai_api_key)
-samba_client = AsyncOpenAI(api_key=settings.samba_api_key, base_url=settings.samba_url)
-creds_manager = GoogleCredsManager(creds_config=GoogleCredsConfig(client_secrets_path=settings.credentials_path))
-google_tools: dict[str, Any] = {
-    "read_gmail_emails": GmailReadExecutor,
-    "send_gmail_email": GmailWriteExecutor,
-    "insert_calendar_appointment": CalendarInsertExecutor,
-    "get_calendar_appointments": CalendarReadExecutor,
-}
-other_tools: dict[str, Any] = {
-    "get_weather_data": WeatherTool,
-    "get_news_data": NewspaperFrontTool,
-}
-
-schemas: str = prepare_schemas(models=[*google_tools.values(), *other_tools.values()])
-
-system_prompt: str = f"""Cutting Knowledge Date: December 2023
+# Retries are left to the scheduler
+samba_client = AsyncOpenAI(api_key=settings.samba_api_key, base_url=settings.samba_url, max_retries=0)
+
+
+def build_system_prompt(native: bool) -> str:
+    """Build the system prompt for the chosen tool calling protocol.
+
+    Args:
+        native (bool): Whether the tool schemas go through the `tools` parameter instead of the prompt.
+
+    Returns:
+        str: The system prompt.
+    """
+    header: str = f"""Cutting Knowledge Date: December 2023
 Today Date: {datetime.now().strftime('%Y-%m-%d')}
 
 You are Jarvis, a personal assistant working for Juan Ovalle. His life depends on you. You will be always talking with him. You have function calling capabilities.
-You have access to the following functions:
+"""
+    if native:
+        return (
+            header
+            + """
+Important Rules:
+- Required parameters MUST be specified
+- Only call one function at a time
+- If there is no function call available, answer the question like normal with your current knowledge and do not tell the user about function calls
+- Only call a function if you have all the required information to call it, follow up questions must not be accompanied by a function call
+"""
+        )
+    return (
+        header
+        + f"""You have access to the following functions:
 
-{schemas}
+{prepare_schemas(schemas=list(tool_registry.schemas.values()))}
 
 You MUST respond in ONE of these two formats:
 
@@ -64,118 +76,389 @@ Important Rules:
 - If there is no function call available, answer the question like normal with your current knowledge and do not tell the user about function calls
 - Only respond with a function call if you have all the required information to call the function, follow up questions must not be accompanied by a function call
 """
+    )
+
+
+def with_memory(messages: list[dict[str, Any]], memory: str | None) -> list[dict[str, Any]]:
+    """Messages to send, with the recalled past turns right before the last user message.
+
+    Args:
+        messages (list[dict[str, Any]]): Conversation messages.
+        memory (str | None): Content of the memory system message, if anything was recalled.
+
+    Returns:
+        list[dict[str, Any]]: The messages, or a copy with the memory message inserted.
+    """
+    if not memory:
+        return messages
+    at: int = max(i for i, message in enumerate(messages) if message.get("role") == "user")
+    return [*messages[:at], {"role": "system", "content": memory}, *messages[at:]]
+
+
+async def create_stream(messages: list[dict[str, Any]], native: bool, memory: str | None = None) -> tuple[AsyncStream, bool]:
+    """Start a streamed completion, falling back to the text protocol if the endpoint rejects native function calling.
+
+    With the completion cache enabled, a context that was answered before is replayed from the cache instead.
+
+    Args:
+        messages (list[dict[str, Any]]): Conversation messages. Rewritten in place on fallback.
+        native (bool): Whether to use native function calling.
+        memory (str | None): Recalled past turns, sent with this request only and never added to the conversation.
+
+    Returns:
+        tuple[AsyncStream, bool]: The stream and whether native function calling is (still) in use.
+    """
+    params: dict[str, Any] = {
+        "temperature": 0.0,
+        "stop": ["<|eot_id|>"],
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        **({"tools": prepare_tool_definitions(schemas=list(tool_registry.schemas.values()))} if native else {}),
+    }
+
+    payload: list[dict[str, Any]] = with_memory(messages=messages, memory=memory)
+
+    # Identical temperature 0 contexts get the same answer, unless tool outputs are involved
+    key: str | None = None
+    if settings.completion_cache:
+        if is_cacheable(messages=payload):
+            key = completion_key(model="llama3-405b", params=params, messages=payload)
+            if (chunks := await completion_cache.aget(key=key)) is not None:
+                logger.info("SambaNova Llama3.1-405B response served from the completion cache")
+                completion_cache.log_stats()
+                return completion_cache.replay(chunks=chunks), native
+        else:
+            completion_cache.stats.bypasses += 1
+
+    async def request(model: str) -> tuple[str, AsyncStream]:
+        return model, await samba_client.chat.completions.create(messages=payload, model=model, **params)
+
+    logger.info("SambaNova Llama3.1-405B generating response...")
+    _now: float = perf_counter()
+    try:
+        # A slow request is hedged with a duplicate, or with the fallback model if there is one
+        model, stream = await scheduler.call(
+            "samba",
+            lambda: request(model="llama3-405b"),
+            hedge=lambda: request(model=settings.samba_fallback_model or "llama3-405b"),
+            discard=lambda answer: answer[1].close(),
+        )
+    except BadRequestError as e:
+        if not native or not rejects_native_tools(e=e):
+            raise
+        logger.warning("Native function calling not supported, falling back to the text protocol: {e}", e=e)
+        messages[:] = to_text_protocol(messages=messages)
+        messages[0] = {"role": "system", "content": build_system_prompt(native=False)}
+        return await create_stream(messages=messages, native=False, memory=memory)
+    logger.info("SambaNova Llama3.1-405B generation time: {s:.3f} seconds", s=perf_counter() - _now)
+    if key is not None and model != "llama3-405b":
+        # The key is the primary model's, an answer of the fallback model must not be served for it
+        logger.info("Response of the fallback model {m} not cached", m=model)
+        key = None
+    if key is not None:
+        completion_cache.log_stats()
+        return completion_cache.record(stream=stream, key=key), native
+    return stream, native
+
+
+async def recall(query: str) -> str | None:
+    """Recall the past turns most relevant to a user message, if long-term memory is enabled.
+
+    Args:
+        query (str): The user message.
+
+    Returns:
+        str | None: Content of the memory system message, None if nothing relevant was found.
+    """
+    if not settings.memory:
+        return None
+    try:
+        memories = await asyncio.to_thread(
+            memory_index.search, query=query, k=settings.memory_top_k, min_score=settings.memory_min_score
+        )
+    except Exception as e:
+        logger.error("Error searching long-term memory: {e}", e=e)
+        return None
+    if not memories:
+        return None
+    logger.info("Recalled {n} past turns (best score {s:.2f})", n=len(memories), s=memories[0].score)
+    return format_memories(memories=memories)
+
+
+async def speculative_stream(messages: list[dict[str, Any]], native: bool) -> tuple[AsyncStream, bool]:
+    """Recall and start a completion for a speculative turn."""
+    memory: str | None = await recall(query=messages[-1]["content"])
+    return await create_stream(messages=messages, native=native, memory=memory)
 
 
 async def main():
+    # The GUI, audio and Google tool modules are imported, and devices, clients and caches set up, here rather than on
+    # import: the offload process pool spawns workers that import this module as `__mp_main__`
+    import pyaudio
+
+    from src.audio import AudioOutput
+    from src.gui import WaveformVisualizer
+    from src.stt import capture_streaming_voice_input, capture_voice_input
+    from src.tools.google_tools.cache import calendar_cache
+    from src.tools.google_tools.credentials import GoogleCredsConfig, GoogleCredsManager
+    from src.tools.google_tools.mirror import gmail_mirror
+    from src.tools.google_tools.outbox import outbox
+    from src.tts import play_audio
+    from src.wakeword import WakeWordDetector, WakeWordListener
+
+    # Retries are left to the scheduler
+    openai_client = AsyncOpenAI(api_key=settings.openai_api_key, max_retries=0)
+    creds_manager = GoogleCredsManager(creds_config=GoogleCredsConfig(client_secrets_path=settings.credentials_path))
+
+    p = pyaudio.PyAudio()
+    audio_output = AudioOutput(p=p)
+    audio_output.load_cue("thinking", path="assets/beeps.mp3", volume=0.05)
+
+    # Tool modules are imported on first call, the schemas come from the registry's cache. This does not keep the Google
+    # API client from loading at startup: the calendar cache, Gmail mirror and outbox above import it
+    intent_matcher: IntentMatcher | None = (
+        IntentMatcher(schemas=list(tool_registry.schemas.values()), models=tool_registry, threshold=settings.intent_threshold)
+        if settings.intent_fast_path
+        else None
+    )
+
     # Initialize visualizer
     visualizer = WaveformVisualizer(x=0, y=0)
     visualizer.show()
 
+    # Keep the local calendar cache and Gmail mirror current and perform the queued writes in the background
+    background_syncs: list[asyncio.Task] = [
+        asyncio.create_task(
+            calendar_cache.run_periodic_sync(creds_manager=creds_manager, interval=settings.calendar_sync_interval)
+        ),
+        asyncio.create_task(gmail_mirror.run_periodic_sync(creds_manager=creds_manager, interval=settings.gmail_sync_interval)),
+        asyncio.create_task(outbox.run_worker(creds_manager=creds_manager, executors=tool_registry)),
+    ]
+
     # Initialize Conversation ID and Chat History
     conversation_id: str = str(uuid4())
     logger.info("Starting conversation with ID: {id}", id=conversation_id)
-    chat_history: dict[str, Any] = {
-        "conversation_id": conversation_id,
-        "content": [],
-    }
+    history: Transcript = Transcript(conversation_id=conversation_id)
+
+    # Embed the turns of past conversations saved since the last start
+    if settings.memory:
+        background_syncs.append(asyncio.create_task(asyncio.to_thread(memory_index.index_history, exclude={conversation_id})))
+
+    # Intent fast-path and speculative start metrics
+    fast_path_stats = FastPathStats()
+    speculation_stats = SpeculationStats()
 
     # Define System Prompt
-    messages: list[dict[str, str]] = [
+    native: bool = settings.native_tool_calling
+    messages: list[dict[str, Any]] = [
         {
             "role": "system",
-            "content": system_prompt,
+            "content": build_system_prompt(native=native),
         },
     ]
 
+    # Terminal output is flushed at a capped frame rate, or not at all in headless mode
+    renderer = TokenRenderer(hz=settings.render_hz, enabled=not settings.headless)
+    renderer.start()
+
+    # Shared audio output for speech and cues
+    audio_output.open()
+
+    # Always-on microphone for the wake word in hands-free mode
+    wake_word_listener = WakeWordListener(
+        p=p, detector=WakeWordDetector(model_name=settings.wake_word, threshold=settings.wake_word_threshold)
+    )
+    if settings.hands_free:
+        wake_word_listener.open()
+
+    # Report callbacks that block the loop, profile on demand (SIGUSR1) with one folded stacks file per turn
+    watchdog = LoopWatchdog(threshold=settings.loop_lag_threshold)
+    watchdog.start()
+    profiler = SamplingProfiler(directory=settings.profile_dir, interval=settings.profile_interval)
+    profiler.install_signal_handler()
+    if settings.profile:
+        profiler.start()
+    turn: int = 0
+
     os.system("clear")
     while True:
         visualizer.app.processEvents()
+        # Recording has no deadline, the turn gets one once the user is done speaking
+        set_turn_deadline(seconds=None)
+
+        # Let the model know about queued writes that failed since the last turn
+        for operation in outbox.drain_failures():
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"The background call to '{operation.name}' with {operation.payload} failed: {operation.error}. "
+                    "Tell the user about it.",
+                }
+            )
+
+        # Start the completion on a stable partial transcript, unless the fast-path will serve it
+        speculation: SpeculativeTurn | None = None
+
+        def on_stable(transcript: str) -> None:
+            nonlocal speculation
+            if speculation is not None:
+                if speculation.matches(transcript=transcript):
+                    return
+                speculation.cancel()
+                speculation = None
+            if intent_matcher and intent_matcher.match(utterance=transcript):
+                return
+            logger.info("Speculative completion started: {t}", t=transcript)
+            speculation_stats.launched += 1
+            speculation = SpeculativeTurn(
+                transcript=transcript, messages=messages, start=lambda m: speculative_stream(messages=m, native=native)
+            )
 
-        if not (prompt := await capture_voice_input(client=openai_client, p=p)):
+        if settings.hands_free:
+            # Wait for the wake word, then record until the user stops speaking
+            pre_roll: bytes = await wake_word_listener.listen()
+            prompt: str | None = await capture_streaming_voice_input(
+                client=openai_client,
+                p=p,
+                on_stable=on_stable if settings.speculative_start else None,
+                partial_interval=settings.partial_interval,
+                endpoint_silence=settings.endpoint_silence,
+                stream=wake_word_listener.stream,
+                pre_roll=pre_roll,
+            )
+        elif settings.speculative_start:
+            prompt: str | None = await capture_streaming_voice_input(
+                client=openai_client,
+                p=p,
+                on_stable=on_stable,
+                partial_interval=settings.partial_interval,
+                endpoint_silence=settings.endpoint_silence,
+            )
+        else:
+            prompt: str | None = await capture_voice_input(client=openai_client, p=p)
+        if not prompt:
+            if speculation is not None:
+                speculation.cancel()
             continue
 
-        print(f"You > {prompt}", end="", flush=True)
+        set_turn_deadline(seconds=settings.turn_timeout)
+        renderer.write(f"You > {prompt}")
         if prompt.lower().strip() in ("exit"):
+            if speculation is not None:
+                speculation.cancel()
+            await renderer.stop()
+            audio_output.close()
+            wake_word_listener.close()
+            watchdog.stop()
+            profiler.stop()
+            offload.shutdown()
             break
 
         # Add user input to messages
         messages.append({"role": "user", "content": prompt})
 
-        # Generate stream
-        logger.info("SambaNova Llama3.1-405B generating response...")
-        _now: float = perf_counter()
-        stream = await samba_client.chat.completions.create(
-            messages=messages,
-            model="llama3-405b",
-            temperature=0.0,
-            stop=["<|eot_id|>"],
-            stream=True,
-            stream_options={"include_usage": True},
+        # Resolve unambiguous tool requests locally, otherwise let the model plan
+        memory: str | None = None
+        match: IntentMatch | None = intent_matcher.match(utterance=prompt) if intent_matcher else None
+        if speculation is not None and (match or not speculation.matches(transcript=prompt)):
+            speculation.cancel()
+            speculation = None
+        if match:
+            response: str = ""
+            tool_calls: list[ToolCall] = [ToolCall(name=match.name, arguments=match.parameters)]
+            saved: float = fast_path_stats.record_hit()
+            logger.info("Fast-path tool call ({c:.2f} confidence): {r}", c=match.confidence, r=tool_calls[0])
+        else:
+            # Generate stream, or take over the one started on the partial transcript
+            _now: float = perf_counter()
+            if speculation is not None:
+                try:
+                    stream, native = await speculation.commit()
+                except Exception as e:
+                    logger.warning("Speculative completion failed, starting over: {e}", e=e)
+                    memory = await recall(query=prompt)
+                    stream, native = await create_stream(messages=messages, native=native, memory=memory)
+                else:
+                    # The speculative messages carry the protocol fallback, if any
+                    messages[:] = [*speculation.messages[:-1], messages[-1]]
+                    speculation_stats.committed += 1
+                    speculation_stats.saved_seconds += _now - speculation.started_at
+                    logger.info(
+                        "Speculative completion committed, started {s:.3f} seconds early ({r:.0%} of {n} committed)",
+                        s=_now - speculation.started_at,
+                        r=speculation_stats.commit_rate,
+                        n=speculation_stats.launched,
+                    )
+            else:
+                memory = await recall(query=prompt)
+                stream, native = await create_stream(messages=messages, native=native, memory=memory)
+
+            # Handle stream (1)
+            renderer.write("Assistant > ", "blue")
+            response, metadata, tool_calls = await ahandle_stream(stream=stream, renderer=renderer, audio=audio_output)
+            fast_path_stats.record_miss(planning_seconds=perf_counter() - _now if tool_calls else None)
+            saved: float = 0.0
+            if tool_calls:
+                logger.info("tool call: {r}", r=tool_calls[0])
+        logger.info(
+            "Fast-path hit rate: {r:.0%} ({h}/{t} turns), saved {s:.3f} seconds this turn, {total:.3f} seconds overall",
+            r=fast_path_stats.hit_rate,
+            h=fast_path_stats.hits,
+            t=fast_path_stats.turns,
+            s=saved,
+            total=fast_path_stats.saved_seconds,
         )
-        logger.info("SambaNova Llama3.1-405B generation time: {s:.3f} seconds", s=perf_counter() - _now)
-
-        # Handle stream (1)
-        print(colored("Assistant > ", "blue"), end="", flush=True)
-        response, metadata, tool_calls = await ahandle_stream(stream=stream)
-        if tool_calls:
-            logger.info("tool call: {r}", r=response.removeprefix("<tool>").removesuffix("</tool>"))
 
         # TTS (1)
         if not tool_calls:
-            await play_audio(p=p, openai_client=openai_client, response=response, visualizer=visualizer)
+            await play_audio(output=audio_output, openai_client=openai_client, response=response, visualizer=visualizer)
 
         # Add model response to messages
-        messages.append({"role": "assistant", "content": response})
+        if tool_calls:
+            messages.append(assistant_tool_call_message(tool_calls=tool_calls, native=native))
+        else:
+            messages.append({"role": "assistant", "content": response})
 
         # Handle stream (2) if tool calls
         if tool_calls:
-            # Prepare tool arguments
-            tool_args: dict[str, Any] = extract_tool_input_args(s=response)
-            tool_name: str = tool_args.get("name")
-            tool_input: dict[str, Any] = tool_args.get("parameters")
-
-            # Invoke the tool
-            if tool_name in google_tools:
-                tool_output: Any = await GoogleTool(
-                    creds_manager=creds_manager, executor=google_tools.get(tool_name)(**tool_input)
-                ).run()
-            else:
-                tool_output: Any = await other_tools.get(tool_name)(**tool_input).run()
-            logger.info("Tool output: {o}", o=tool_output)
-
-            # Handles all the messages that need to be added to proper tool calling
-            messages.append({"role": "ipython", "content": str(tool_output)})
-
-            # Update chat history with tool information
-            chat_history["content"].append({"messages": messages.copy(), **metadata.model_dump()})
-            save_json_chat_history(conversation_id=conversation_id, chat_history=chat_history)
-
-            # Final completion with tool responses
-            logger.info("SambaNova Llama3.1-405B generating response...")
-            _now: float = perf_counter()
-            stream = await samba_client.chat.completions.create(
-                messages=messages,
-                model="llama3-405b",
-                temperature=0.0,
-                stop=["<|eot_id|>"],
-                stream=True,
-                stream_options={"include_usage": True},
-            )
-            logger.info("SambaNova Llama3.1-405B generation time: {s:.3f} seconds", s=perf_counter() - _now)
-
-            print(colored("Assistant > ", "blue"), end="", flush=True)
-            response, metadata, _ = await ahandle_stream(stream=stream)
+            audio_output.start_cue("thinking", loop=True)
+            for tool_call in tool_calls:
+                # Invoke the tool
+                tool_output: Any = await tool_registry.run(
+                    name=tool_call.name, arguments=tool_call.arguments, creds_manager=creds_manager
+                )
+                logger.info("Tool output: {o}", o=tool_output)
+
+                # Handles all the messages that need to be added to proper tool calling
+                messages.append(tool_output_message(tool_call=tool_call, output=tool_output, native=native))
+            audio_output.stop_cue()
+
+            # Update chat history with tool information (the fast-path has no planning completion to trace)
+            if not match:
+                history.record(messages=messages, metadata=metadata.model_dump())
+                save_transcript(transcript=history)
+
+            # Final completion with tool responses, the committed speculation recalled on its own
+            if speculation is not None and memory is None:
+                memory = await recall(query=prompt)
+            stream, native = await create_stream(messages=messages, native=native, memory=memory)
+
+            renderer.write("Assistant > ", "blue")
+            response, metadata, _ = await ahandle_stream(stream=stream, renderer=renderer, audio=audio_output)
 
             # Audio (2)
-            await play_audio(p=p, openai_client=openai_client, response=response, visualizer=visualizer)
-        print()
+            await play_audio(output=audio_output, openai_client=openai_client, response=response, visualizer=visualizer)
+        renderer.write("\n")
 
         # Update chat history with final completion
-        chat_history["content"].append({"messages": messages.copy(), **metadata.model_dump()})
-        save_json_chat_history(conversation_id=conversation_id, chat_history=chat_history)
+        history.record(messages=messages, metadata=metadata.model_dump())
+        save_transcript(transcript=history)
 
+        # Turn instrumentation
+        turn += 1
+        watchdog.log_stats()
+        profiler.dump(label=f"{conversation_id}-{turn}")
 
-if __name__ == "__main__":
-    import asyncio
 
+if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,82 @@
+"""Benchmark the Gmail mirror on a synthetic mailbox.
+
+Run with `poetry run python -m benchmarks.gmail_mirror`.
+"""
+
+import random
+import tempfile
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+from src.tools.google_tools.mirror import GmailMirror
+
+# Common words first so the Zipf weights below make them frequent, like in a real mailbox
+WORDS: list[str] = (
+    "update meeting project report payment receipt newsletter review security alert offer weekend family "
+    "invoice flight hotel booking conference agenda deadline contract interview dinner football python release"
+).split() + [f"word{i}" for i in range(5000)]
+WEIGHTS: list[float] = [1 / (rank + 1) for rank in range(len(WORDS))]
+SENDERS: list[str] = [f"{name} <{name}@example.com>" for name in ("alice", "bob", "carol", "dave", "erin", "frank", "grace")]
+LABELS: list[list[str]] = [
+    ["INBOX", "CATEGORY_PERSONAL"],
+    ["INBOX", "CATEGORY_UPDATES"],
+    ["INBOX", "CATEGORY_PROMOTIONS"],
+    ["SENT"],
+]
+
+
+def synthetic_message(i: int, rng: random.Random) -> dict:
+    return {
+        "id": f"{i:016x}",
+        "threadId": f"{i // 3:016x}",
+        "internalDate": str(1_700_000_000_000 + i * 60_000),
+        "snippet": " ".join(rng.choices(WORDS, weights=WEIGHTS, k=20)),
+        "labelIds": rng.choice(LABELS),
+        "payload": {
+            "headers": [
+                {"name": "From", "value": rng.choice(SENDERS)},
+                {"name": "Subject", "value": " ".join(rng.choices(WORDS, weights=WEIGHTS, k=5)).capitalize()},
+                {"name": "Date", "value": "Mon, 1 Jan 2024 10:00:00 +0000"},
+            ]
+        },
+    }
+
+
+def timed(fn, repeat: int = 200) -> float:
+    samples: list[float] = []
+    for _ in range(repeat):
+        _now: float = perf_counter()
+        fn()
+        samples.append(perf_counter() - _now)
+    return median(samples) * 1e6
+
+
+def main(n: int = 100_000, batch: int = 500) -> None:
+    rng = random.Random(0)
+    messages: list[dict] = [synthetic_message(i=i, rng=rng) for i in range(n)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        mirror = GmailMirror(path=Path(directory) / "gmail.sqlite3", size=n + batch)
+
+        # Initial sync
+        _now: float = perf_counter()
+        mirror.store(messages=messages, history_id="1", replace=True)
+        elapsed: float = perf_counter() - _now
+        print(f"initial sync: {n} messages in {elapsed:.2f} s ({n / elapsed:,.0f} messages/s)")
+
+        # Incremental sync of label changes and new messages
+        _now = perf_counter()
+        updates: list[dict] = [synthetic_message(i=rng.randrange(n + batch), rng=rng) for _ in range(batch)]
+        mirror.store(messages=updates, history_id="2")
+        print(f"incremental sync: {batch} messages in {(perf_counter() - _now) * 1e3:.1f} ms")
+
+        print(f"recent(5): {timed(lambda: mirror.recent(n=5)):.0f} us")
+        print(f"recent(50): {timed(lambda: mirror.recent(n=50)):.0f} us")
+        print(f"search('invoice'): {timed(lambda: mirror.search(query='invoice', n=5)):.0f} us")
+        print(f"search('alice flight hotel'): {timed(lambda: mirror.search(query='alice flight hotel', n=5)):.0f} us")
+        print(f"search('no such word'): {timed(lambda: mirror.search(query='zzzz', n=5)):.0f} us")
+
+
+if __name__ == "__main__":
+    main()
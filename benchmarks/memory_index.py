@@ -0,0 +1,95 @@
+"""Benchmark long-term memory indexing throughput and query latency at 1M stored turns.
+
+Run with `poetry run python -m benchmarks.memory_index`. Vectors are synthetic (clustered unit vectors of the size the
+default fastembed model produces) so the index itself is measured, not the embedding model; the embedder throughput is
+reported separately on a small sample of synthetic turns.
+"""
+
+import argparse
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from src.memory import MemoryIndex, default_embedder, normalize, top_k
+
+
+def clustered_vectors(rng: np.random.Generator, centers: np.ndarray, n: int, noise: float = 1.0) -> np.ndarray:
+    """Unit vectors scattered around topic centers, like the embeddings of a real history are."""
+    labels: np.ndarray = rng.integers(0, len(centers), size=n)
+    noise_vectors: np.ndarray = rng.standard_normal((n, centers.shape[1]), dtype=np.float32)
+    return normalize(vectors=centers[labels] + noise * normalize(vectors=noise_vectors))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--block", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    rng: np.random.Generator = np.random.default_rng(0)
+    centers: np.ndarray = normalize(vectors=rng.standard_normal((2000, args.dim), dtype=np.float32))
+
+    embedder = default_embedder()
+    texts: list[str] = [f"User: remind me about topic {i} and item {i * 7 % 101}\nAssistant: Sure, noted." for i in range(2000)]
+    _now: float = perf_counter()
+    embedder.embed(texts)
+    print(f"Embedder ({embedder.name}): {len(texts) / (perf_counter() - _now):,.0f} turns/s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = MemoryIndex(directory=Path(directory), embedder=embedder, ivf_min_rows=args.rows + 1)
+        index.state["dim"] = args.dim
+
+        # Indexing
+        elapsed: float = 0.0
+        for start in range(0, args.rows, args.block):
+            n: int = min(args.block, args.rows - start)
+            vectors: np.ndarray = clustered_vectors(rng=rng, centers=centers, n=n)
+            records: list[dict] = [
+                {"conversation_id": "bench", "date": "2024-01-01", "text": f"turn {start + i}"} for i in range(n)
+            ]
+            _now = perf_counter()
+            index.add_vectors(vectors=vectors, records=records)
+            elapsed += perf_counter() - _now
+        print(f"Append: {args.rows:,} turns in {elapsed:.2f} s ({args.rows / elapsed:,.0f} turns/s)")
+
+        queries: np.ndarray = clustered_vectors(rng=rng, centers=centers, n=args.queries)
+        np.asarray(index.vectors).sum()  # Page it in, queries are measured warm
+
+        # Exact search
+        exact: list[np.ndarray] = []
+        _now = perf_counter()
+        for query in queries:
+            exact.append(index.search_vector(query=query, k=10)[0])
+        print(f"Exact top-10: {(perf_counter() - _now) / args.queries * 1000:.1f} ms/query")
+
+        # IVF search
+        _now = perf_counter()
+        index.build_ivf()
+        print(f"IVF build: {perf_counter() - _now:.1f} s")
+        index.ivf_min_rows = 0
+        for nprobe in (8, 16, 32):
+            index.nprobe = nprobe
+            recall: float = 0.0
+            _now = perf_counter()
+            results: list[np.ndarray] = [index.search_vector(query=query, k=10)[0] for query in queries]
+            latency: float = (perf_counter() - _now) / args.queries * 1000
+            for result, truth in zip(results, exact):
+                recall += len(np.intersect1d(result, truth)) / len(truth)
+            print(f"IVF top-10 (nprobe={nprobe}): {latency:.1f} ms/query, recall@10 {recall / args.queries:.2f}")
+
+        # Partial sort
+        scores: np.ndarray = np.asarray(index.vectors) @ queries[0]
+        _now = perf_counter()
+        top_k(scores=scores, k=10)
+        partition: float = perf_counter() - _now
+        _now = perf_counter()
+        np.argsort(-scores)[:10]
+        print(f"Top-10 selection: argpartition {partition * 1000:.1f} ms, full argsort {(perf_counter() - _now) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
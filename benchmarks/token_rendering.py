@@ -0,0 +1,86 @@
+"""Benchmark stream consumption throughput with per-token printing and with the frame-rate-capped renderer.
+
+Run with `poetry run python -m benchmarks.token_rendering`. Output goes to /dev/null, so the numbers show the cost of
+formatting and flushing, not of the terminal itself.
+"""
+
+import asyncio
+import os
+import sys
+from time import perf_counter
+
+from openai.types.chat import ChatCompletionChunk
+from termcolor import colored
+
+from src.chat import ahandle_stream
+from src.render import TokenRenderer
+
+
+def fake_chunks(n: int) -> list[ChatCompletionChunk]:
+    base: dict = {"id": "bench", "created": 0, "model": "bench", "object": "chat.completion.chunk", "system_fingerprint": "bench"}
+    chunks: list[ChatCompletionChunk] = [
+        ChatCompletionChunk.model_validate({**base, "choices": [{"index": 0, "delta": {"content": f" token{i}"}}]})
+        for i in range(n)
+    ]
+    chunks.append(ChatCompletionChunk.model_validate({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+    usage: dict = {"prompt_tokens": 1, "completion_tokens": n, "total_tokens": n + 1}
+    chunks.append(ChatCompletionChunk.model_validate({**base, "choices": [], "usage": usage}))
+    return chunks
+
+
+class CountingWriter:
+    """Stand-in for the terminal that counts the flushing writes."""
+
+    def __init__(self):
+        self.devnull = open(os.devnull, "w")
+        self.flushes = 0
+
+    def write(self, s: str) -> int:
+        return self.devnull.write(s)
+
+    def flush(self) -> None:
+        self.flushes += 1
+        self.devnull.flush()
+
+
+async def fake_stream(chunks: list[ChatCompletionChunk], chunks_per_yield: int):
+    """Replay the chunks, yielding to the loop every few chunks like a network stream does."""
+    for i, chunk in enumerate(chunks):
+        if i % chunks_per_yield == 0:
+            await asyncio.sleep(0)
+        yield chunk
+
+
+async def legacy(chunks: list[ChatCompletionChunk], chunks_per_yield: int) -> None:
+    """The previous consumer: one ANSI formatting call and one flushing write per token."""
+    async for chunk in fake_stream(chunks=chunks, chunks_per_yield=chunks_per_yield):
+        if chunk.choices and (token := chunk.choices[0].delta.content):
+            print(colored(token, "blue"), end="", flush=True)
+
+
+async def rendered(chunks: list[ChatCompletionChunk], chunks_per_yield: int) -> None:
+    async with TokenRenderer(hz=30) as renderer:
+        await ahandle_stream(stream=fake_stream(chunks=chunks, chunks_per_yield=chunks_per_yield), renderer=renderer)
+
+
+def main(n: int = 50_000) -> None:
+    chunks: list[ChatCompletionChunk] = fake_chunks(n=n)
+    results: list[str] = []
+    for chunks_per_yield in (1, 16):
+        for name, consumer in (("print per token", legacy), ("renderer", rendered)):
+            writer = CountingWriter()
+            stdout, sys.stdout = sys.stdout, writer
+            try:
+                _now: float = perf_counter()
+                asyncio.run(consumer(chunks=chunks, chunks_per_yield=chunks_per_yield))
+                elapsed: float = perf_counter() - _now
+            finally:
+                sys.stdout = stdout
+            results.append(
+                f"{chunks_per_yield:>2} chunks per read | {name:>15}: {n / elapsed:>10,.0f} tokens/s, {writer.flushes:>6} flushes"
+            )
+    print("\n".join(results))
+
+
+if __name__ == "__main__":
+    main()
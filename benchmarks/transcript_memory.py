@@ -0,0 +1,96 @@
+"""Benchmark chat history memory over a multi-hour session.
+
+Run with `poetry run python -m benchmarks.transcript_memory [--turns 2000]`. A session of one voice turn every ~10
+seconds is simulated (2000 turns is five and a half hours), a fifth of them with a tool call, which takes two
+completions. The chat history dict with a copy of the message list per completion is compared with the transcript log,
+measured with tracemalloc at doubling turn counts: quadratic growth quadruples, linear growth doubles. The transcript is
+saved by appending the lines of each completion, timed over the whole session.
+"""
+
+import argparse
+import random
+import tracemalloc
+from time import perf_counter
+from typing import Any
+
+from src.transcript import Transcript
+
+METADATA: dict[str, Any] = {
+    "id": "chatcmpl-0",
+    "created": 0,
+    "model": "llama3-405b",
+    "system_fingerprint": "fp_0",
+    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    "finish_reason": "stop",
+}
+
+
+def session(turns: int, seed: int = 0):
+    """Yield the messages of each completion and the messages to append before the next one."""
+    rng = random.Random(seed)
+    yield [{"role": "system", "content": "You are a helpful assistant. " * 150}]
+    for turn in range(turns):
+        user: dict[str, Any] = {"role": "user", "content": f"Question {turn}: " + "word " * rng.randint(5, 30)}
+        if rng.random() < 0.2:
+            call: dict[str, Any] = {"role": "assistant", "content": '<tool>{"name": "get_weather_data"}</tool>'}
+            yield [user, call, {"role": "ipython", "content": "Sunny, 21 degrees. " * 20}]
+            yield [{"role": "assistant", "content": "It is sunny. " * rng.randint(5, 40)}]
+        else:
+            yield [user, {"role": "assistant", "content": "Answer " + "word " * rng.randint(10, 80)}]
+
+
+def run(turns: int, checkpoints: list[int], transcript: bool) -> tuple[dict[int, float], Any]:
+    messages: list[dict[str, Any]] = []
+    history: Any = Transcript(conversation_id="bench") if transcript else {"conversation_id": "bench", "content": []}
+    sizes: dict[int, float] = {}
+    tracemalloc.start()
+    baseline: int = tracemalloc.get_traced_memory()[0]
+    completions = session(turns=turns)
+    messages.extend(next(completions))
+    turn: int = 0
+    for new in completions:
+        messages.extend(new)
+        if new[0]["role"] == "user":
+            turn += 1
+        # The message dicts are the conversation, only the history bookkeeping on top of them is measured
+        if transcript:
+            history.record(messages=messages, metadata=dict(METADATA))
+        else:
+            history["content"].append({"messages": messages.copy(), **METADATA})
+        if turn in checkpoints and new[-1]["role"] == "assistant" and turn not in sizes:
+            sizes[turn] = (tracemalloc.get_traced_memory()[0] - baseline) / (1 << 20)
+    tracemalloc.stop()
+    return sizes, history
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=2000)
+    args = parser.parse_args()
+
+    checkpoints: list[int] = [args.turns // 8, args.turns // 4, args.turns // 2, args.turns]
+    legacy_sizes, _ = run(turns=args.turns, checkpoints=checkpoints, transcript=False)
+    sizes, _ = run(turns=args.turns, checkpoints=checkpoints, transcript=True)
+    print("Turns   chat history (MB)   transcript (MB)")
+    for turn in checkpoints:
+        print(f"{turn:>5}   {legacy_sizes[turn]:>17.2f}   {sizes[turn]:>15.2f}")
+    for name, series in (("chat history", legacy_sizes), ("transcript", sizes)):
+        ratios: list[str] = [f"{b / a:.1f}x" for a, b in zip(list(series.values()), list(series.values())[1:])]
+        print(f"Growth per doubling, {name}: {', '.join(ratios)}")
+
+    appended: int = 0
+    slowest: float = 0.0
+    saved = Transcript(conversation_id="bench")
+    messages: list[dict[str, Any]] = []
+    for new in session(turns=args.turns):
+        messages.extend(new)
+        if len(messages) > 1:
+            saved.record(messages=messages, metadata=dict(METADATA))
+            _now: float = perf_counter()
+            appended += len(saved.pending())
+            slowest = max(slowest, perf_counter() - _now)
+    print(f"Saving {args.turns} turns: {appended / (1 << 20):.1f} MB appended, slowest save {slowest * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Benchmark the CPU cost of always-on wake word listening.
+
+Run with `poetry run python -m benchmarks.wake_word [--audio recording.wav ...]`. Recordings (any format miniaudio
+decodes) are streamed through the detector frame by frame, as fast as possible; CPU time over audio duration is the share
+of one core the detector needs in real time. The detector is run with and without the energy gate, and the share of
+frames the gate lets through to the model is reported.
+
+The CPU target is only verified by recordings of a real room (speech, TV, appliances) and the openWakeWord model. The
+synthetic fixture used without recordings, low level noise with the assistant's beeps every minute, keeps the gate shut
+almost all the time, and without the model nothing is scored: its figures say nothing about the target.
+"""
+
+import argparse
+from time import process_time
+
+import miniaudio
+import numpy as np
+
+from src.wakeword import WAKE_WORD_FRAME, WAKE_WORD_RATE, WakeWordDetector, load_model
+
+
+def decode(path: str) -> np.ndarray:
+    decoded = miniaudio.decode_file(path, output_format=miniaudio.SampleFormat.SIGNED16, nchannels=1, sample_rate=WAKE_WORD_RATE)
+    return np.frombuffer(decoded.samples, dtype=np.int16)
+
+
+def idle_room(minutes: int) -> np.ndarray:
+    """Quiet background noise with short sounds once a minute."""
+    rng: np.random.Generator = np.random.default_rng(0)
+    audio: np.ndarray = rng.normal(0, 40, size=minutes * 60 * WAKE_WORD_RATE)
+    beeps: np.ndarray = decode("assets/beeps.mp3").astype(np.float64) * 0.5
+    for minute in range(minutes):
+        start: int = minute * 60 * WAKE_WORD_RATE + 30 * WAKE_WORD_RATE
+        audio[start : start + len(beeps)] += beeps[: len(audio) - start]
+    return np.clip(audio, -32768, 32767).astype(np.int16)
+
+
+class NullModel:
+    """Used when openWakeWord is not available: the gate is measured, the scored frames are only counted."""
+
+    def predict(self, frame: np.ndarray) -> dict[str, float]:
+        return {"hey_jarvis": 0.0}
+
+    def reset(self) -> None:
+        pass
+
+
+def run(audio: np.ndarray, model, energy_threshold: float) -> tuple[float, float, int]:
+    """CPU share of one core, share of the frames scored by the model and number of detections."""
+    detector = WakeWordDetector(energy_threshold=energy_threshold, model=model)
+    frames: list[bytes] = [
+        audio[i : i + WAKE_WORD_FRAME].tobytes() for i in range(0, len(audio) - WAKE_WORD_FRAME + 1, WAKE_WORD_FRAME)
+    ]
+    detections: int = 0
+    _now: float = process_time()
+    for frame in frames:
+        if detector.process(frame=frame):
+            detections += 1
+            detector.reset()
+    cpu: float = process_time() - _now
+    return cpu / (len(audio) / WAKE_WORD_RATE), 1 - detector.stats.gated_ratio, detections
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio", nargs="*", default=[])
+    parser.add_argument("--minutes", type=int, default=10)
+    args = parser.parse_args()
+
+    verified: bool = bool(args.audio)
+    try:
+        model = load_model(name="hey_jarvis")
+        model_name: str = "openWakeWord hey_jarvis"
+    except Exception as e:
+        model, model_name, verified = (
+            NullModel(),
+            f"none, scoring is not timed ({type(e).__name__}: openwakeword or its models are missing)",
+            False,
+        )
+    print(f"Model: {model_name}")
+
+    fixtures: dict[str, np.ndarray] = {path: decode(path) for path in args.audio} or {
+        f"synthetic idle room ({args.minutes} min)": idle_room(minutes=args.minutes)
+    }
+    for name, audio in fixtures.items():
+        for label, threshold in (("gated", 300.0), ("ungated", 0.0)):
+            cpu, scored, detections = run(audio=audio, model=model, energy_threshold=threshold)
+            print(f"{name}, {label}: gate open {scored:.1%} of frames, {cpu:.2%} of one core, {detections} detections")
+    if not verified:
+        print("CPU target unverified: it takes recordings of a real room (--audio) and the openWakeWord model")
+
+
+if __name__ == "__main__":
+    main()
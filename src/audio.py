@@ -0,0 +1,320 @@
+import asyncio
+import queue
+import threading
+from pathlib import Path
+from time import perf_counter
+
+import miniaudio
+import numpy as np
+import pyaudio
+from pydantic import BaseModel
+
+SAMPLE_RATE: int = 24_000
+
+
+class Earcon:
+    """Short audio cue decoded to PCM once, at startup."""
+
+    def __init__(self, samples: np.ndarray):
+        self.samples = samples
+
+    @classmethod
+    def from_file(cls, path: Path | str, volume: float = 1.0, sample_rate: int = SAMPLE_RATE) -> "Earcon":
+        """Decode an audio file (mp3, flac, wav or vorbis) to mono 16-bit PCM.
+
+        Args:
+            path (Path | str): Audio file.
+            volume (float): Gain applied to the samples.
+            sample_rate (int): Sample rate of the output stream the cue is mixed into.
+
+        Returns:
+            Earcon: The decoded cue.
+        """
+        decoded = miniaudio.decode_file(
+            str(path), output_format=miniaudio.SampleFormat.SIGNED16, nchannels=1, sample_rate=sample_rate
+        )
+        samples: np.ndarray = np.frombuffer(decoded.samples, dtype=np.int16).astype(np.float32) * volume
+        return cls(samples=samples.astype(np.int16))
+
+
+class SpeechStats(BaseModel):
+    """Latency and smoothness of one spoken response."""
+
+    time_to_first_audio: float | None = None
+    underruns: int = 0
+    prefill: float = 0.0
+    jitter: float = 0.0
+
+
+class JitterBuffer:
+    """Speech buffer that starts playback after a prefill sized from the observed arrival jitter.
+
+    The jitter is the smoothed deviation between the time audio takes to arrive and the time it takes to play
+    (RFC 3550 style). The prefill follows it, grows on every underrun and decays back after a smooth response.
+    """
+
+    def __init__(
+        self,
+        rate: int = SAMPLE_RATE,
+        min_prefill: float = 0.05,
+        max_prefill: float = 1.0,
+        jitter_factor: float = 4.0,
+        underrun_growth: float = 1.5,
+    ):
+        self.rate = rate
+        self.min_prefill = min_prefill
+        self.max_prefill = max_prefill
+        self.jitter_factor = jitter_factor
+        self.underrun_growth = underrun_growth
+        self.prefill: float = min_prefill
+        self.jitter: float = 0.0
+        self.stats = SpeechStats()
+        self._data = bytearray()
+        self._playing: bool = False
+        self._ended: bool = True
+        self._started_at: float = 0.0
+        self._last_arrival: float | None = None
+        self._last_duration: float = 0.0
+
+    def __len__(self) -> int:
+        return len(self._data) // 2
+
+    def begin(self) -> None:
+        """Start a new response."""
+        self._data.clear()
+        self._playing, self._ended = False, False
+        self._started_at = perf_counter()
+        self._last_arrival = None
+        self.stats = SpeechStats(prefill=self.prefill, jitter=self.jitter)
+
+    def end(self) -> None:
+        """Mark the response as complete, whatever is buffered can be played without waiting for more."""
+        self._ended = True
+        if not self.stats.underruns:
+            # Smooth response, give back some of the latency
+            self.prefill = max(self.min_prefill, 0.5 * self.prefill + 0.5 * self.jitter_factor * self.jitter)
+
+    def push(self, pcm: bytes) -> None:
+        """Add arrived audio and update the jitter estimate.
+
+        Args:
+            pcm (bytes): Mono 16-bit PCM.
+        """
+        now: float = perf_counter()
+        if self._last_arrival is not None:
+            deviation: float = abs((now - self._last_arrival) - self._last_duration)
+            self.jitter += (deviation - self.jitter) / 16
+            target: float = self.jitter_factor * self.jitter
+            self.prefill = min(self.max_prefill, max(self.prefill, target))
+        self._last_arrival, self._last_duration = now, len(pcm) / 2 / self.rate
+        self._data.extend(pcm)
+
+    def pull(self, frame_count: int) -> bytes:
+        """Take up to frame_count frames for playback.
+
+        Args:
+            frame_count (int): Frames requested by the output device.
+
+        Returns:
+            bytes: Audio to play, empty while prefilling.
+        """
+        if not self._playing:
+            if not self._data or (not self._ended and len(self) < self.prefill * self.rate):
+                return b""
+            self._playing = True
+            if self.stats.time_to_first_audio is None:
+                self.stats.time_to_first_audio = perf_counter() - self._started_at
+
+        n: int = min(frame_count, len(self)) * 2
+        pcm: bytes = bytes(self._data[:n])
+        del self._data[:n]
+        if n < frame_count * 2 and not self._ended:
+            # Ran dry mid response, buffer again with a larger prefill
+            self.stats.underruns += 1
+            self.prefill = min(self.max_prefill, self.prefill * self.underrun_growth)
+            self._playing = False
+        return pcm
+
+
+class StreamingDecoder:
+    """Decodes a compressed audio stream (mp3 or flac) incrementally, as the bytes arrive.
+
+    miniaudio pulls the bytes it needs from a queue fed by the network reader, so decoding runs in one worker thread
+    per response and never blocks the event loop.
+    """
+
+    class _Source(miniaudio.StreamableSource):
+        def __init__(self):
+            self.chunks: queue.Queue[bytes | None] = queue.Queue()
+            self.buffer = bytearray()
+            self.eof: bool = False
+
+        def read(self, num_bytes: int) -> bytes:
+            while len(self.buffer) < num_bytes and not self.eof:
+                if (chunk := self.chunks.get()) is None:
+                    self.eof = True
+                else:
+                    self.buffer.extend(chunk)
+            data: bytes = bytes(self.buffer[:num_bytes])
+            del self.buffer[:num_bytes]
+            return data
+
+    FORMATS: dict[str, miniaudio.FileFormat] = {"mp3": miniaudio.FileFormat.MP3, "flac": miniaudio.FileFormat.FLAC}
+
+    def __init__(self, audio_format: str, on_pcm, rate: int = SAMPLE_RATE):
+        self.audio_format = self.FORMATS[audio_format]
+        self.on_pcm = on_pcm
+        self.rate = rate
+        self.error: Exception | None = None
+        self._source = self._Source()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def feed(self, data: bytes | None) -> None:
+        """Hand compressed bytes to the decoder, None marks the end of the stream."""
+        self._source.chunks.put(data)
+
+    async def wait(self) -> None:
+        """Wait until everything fed has been decoded."""
+        await asyncio.to_thread(self._thread.join)
+        if self.error is not None:
+            raise self.error
+
+    def _run(self) -> None:
+        try:
+            for frames in miniaudio.stream_any(
+                self._source,
+                source_format=self.audio_format,
+                output_format=miniaudio.SampleFormat.SIGNED16,
+                nchannels=1,
+                sample_rate=self.rate,
+                frames_to_read=1024,
+            ):
+                self.on_pcm(frames.tobytes())
+        except Exception as e:
+            self.error = e
+
+
+class AudioOutput:
+    """The one output stream of the assistant. Speech is queued and cues are mixed in by the PortAudio callback.
+
+    Cues start and stop on a sample boundary of the next callback buffer, without any extra thread.
+    """
+
+    def __init__(self, p: pyaudio.PyAudio, rate: int = SAMPLE_RATE, frames_per_buffer: int = 256):
+        self.p = p
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self.cues: dict[str, Earcon] = {}
+        self.last_frames: np.ndarray = np.zeros(frames_per_buffer, dtype=np.int16)
+        self.speech = JitterBuffer(rate=rate)
+        self._cue: Earcon | None = None
+        self._cue_position: int = 0
+        self._cue_loop: bool = False
+        self._lock = threading.Lock()
+        self._stream: pyaudio.Stream | None = None
+
+    def open(self) -> None:
+        """Open the output stream."""
+        self._stream = self.p.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=self.rate,
+            output=True,
+            frames_per_buffer=self.frames_per_buffer,
+            stream_callback=self._callback,
+        )
+
+    def close(self) -> None:
+        """Close the output stream."""
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+
+    def load_cue(self, name: str, path: Path | str, volume: float = 1.0) -> None:
+        """Decode a cue so it can be started by name.
+
+        Args:
+            name (str): Name of the cue.
+            path (Path | str): Audio file.
+            volume (float): Gain applied to the cue.
+        """
+        self.cues[name] = Earcon.from_file(path=path, volume=volume, sample_rate=self.rate)
+
+    def start_cue(self, name: str, loop: bool = False) -> None:
+        """Start mixing a cue into the output, from its first sample.
+
+        Args:
+            name (str): Name of a loaded cue.
+            loop (bool): Whether to repeat the cue until it is stopped.
+        """
+        if not len(self.cues[name].samples):
+            return
+        with self._lock:
+            self._cue, self._cue_position, self._cue_loop = self.cues[name], 0, loop
+
+    def stop_cue(self) -> None:
+        """Stop the cue that is playing, if any."""
+        with self._lock:
+            self._cue = None
+
+    def begin_speech(self) -> None:
+        """Start a spoken response, playback waits for the jitter buffer prefill."""
+        with self._lock:
+            self.speech.begin()
+
+    def write(self, pcm: bytes) -> None:
+        """Queue mono 16-bit PCM speech for playback.
+
+        Args:
+            pcm (bytes): Audio at the stream sample rate.
+        """
+        with self._lock:
+            self.speech.push(pcm)
+
+    def end_speech(self) -> None:
+        """Mark the spoken response as complete."""
+        with self._lock:
+            self.speech.end()
+
+    @property
+    def pending_frames(self) -> int:
+        return len(self.speech)
+
+    async def drain(self, on_frame=None) -> None:
+        """Wait until the queued speech has been played.
+
+        Args:
+            on_frame (Callable[[np.ndarray], None] | None): Called with the last played buffer while waiting.
+        """
+        while self.pending_frames:
+            if on_frame is not None:
+                on_frame(self.last_frames)
+            await asyncio.sleep(max(self.frames_per_buffer / self.rate, 0.02))
+
+    def _callback(self, in_data, frame_count: int, time_info, status) -> tuple[bytes, int]:
+        mix: np.ndarray = np.zeros(frame_count, dtype=np.int32)
+        with self._lock:
+            # Speech
+            if speech := self.speech.pull(frame_count=frame_count):
+                mix[: len(speech) // 2] += np.frombuffer(speech, dtype=np.int16)
+
+            # Cue, looping over its samples if needed
+            filled: int = 0
+            while self._cue is not None and filled < frame_count:
+                chunk: np.ndarray = self._cue.samples[self._cue_position : self._cue_position + frame_count - filled]
+                mix[filled : filled + len(chunk)] += chunk
+                filled += len(chunk)
+                self._cue_position += len(chunk)
+                if self._cue_position >= len(self._cue.samples):
+                    if self._cue_loop:
+                        self._cue_position = 0
+                    else:
+                        self._cue = None
+
+        frames: np.ndarray = np.clip(mix, -32768, 32767).astype(np.int16)
+        self.last_frames = frames
+        return frames.tobytes(), pyaudio.paContinue
@@ -1,25 +1,26 @@
 import json
-import threading
-from threading import Event
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-import pygame
-from openai import AsyncStream
-from termcolor import colored
+from openai import AsyncStream, BadRequestError
 
-from src.pydantic_classes import Metadata
+from src.pydantic_classes import Metadata, ToolCall
+from src.render import TokenRenderer
 
+if TYPE_CHECKING:
+    # For the annotation only, offload workers import app.py and with it this module, but not the audio stack
+    from src.audio import AudioOutput
 
-def extract_tool_input_args(s: str) -> dict[str, Any]:
-    """Extracts the tool input arguments from model response.
+
+def parse_tool_arguments(s: str) -> dict[str, Any]:
+    """Parses a JSON object produced by the model, decoding values that are JSON strings themselves.
 
     Args:
-        s (str): The input string containing the content.
+        s (str): The JSON object.
 
     Returns:
-        dict: tool input arguments.
+        dict: parsed object.
     """
-    data = json.loads(s.removeprefix("<tool>").removesuffix("</tool>"))
+    data = json.loads(s) if s else {}
 
     def parse_possible_json_strings(obj):
         if isinstance(obj, dict):
@@ -37,70 +38,169 @@ def extract_tool_input_args(s: str) -> dict[str, Any]:
     return parse_possible_json_strings(data)
 
 
-def play_mp3_loop(file_path: str, stop_event: Event) -> None:
+def extract_tool_input_args(s: str) -> dict[str, Any]:
+    """Extracts the tool input arguments from model response.
+
+    Args:
+        s (str): The input string containing the content.
+
+    Returns:
+        dict: tool input arguments.
+    """
+    return parse_tool_arguments(s.removeprefix("<tool>").removesuffix("</tool>"))
+
+
+def assistant_tool_call_message(tool_calls: list[ToolCall], native: bool) -> dict[str, Any]:
+    """Builds the assistant message that records the tool calls.
+
+    Args:
+        tool_calls (list[ToolCall]): Tool calls requested by the model.
+        native (bool): Whether the endpoint uses native function calling or the `<tool>` text protocol.
+
+    Returns:
+        dict: assistant message.
+    """
+    if not native:
+        tool_call: ToolCall = tool_calls[0]
+        return {
+            "role": "assistant",
+            "content": f"<tool>{json.dumps({'name': tool_call.name, 'parameters': tool_call.arguments})}</tool>",
+        }
+    return {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [
+            {"id": t.id, "type": "function", "function": {"name": t.name, "arguments": json.dumps(t.arguments)}}
+            for t in tool_calls
+        ],
+    }
+
+
+def tool_output_message(tool_call: ToolCall, output: Any, native: bool) -> dict[str, Any]:
+    """Builds the message that hands a tool output back to the model.
+
+    Args:
+        tool_call (ToolCall): Tool call that produced the output.
+        output (Any): Tool output.
+        native (bool): Whether the endpoint uses native function calling or the `<tool>` text protocol.
+
+    Returns:
+        dict: tool message.
     """
-    Play an MP3 file in a loop until the stop_event is set.
+    if native:
+        return {"role": "tool", "tool_call_id": tool_call.id, "content": str(output)}
+    return {"role": "ipython", "content": str(output)}
+
+
+def rejects_native_tools(e: BadRequestError) -> bool:
+    """Whether an endpoint rejected a request for its native function calling parameters.
+
+    Other bad requests, like a context that is too long, fail the same way with either protocol.
 
     Args:
-        file_path (str): The path to the MP3 file to be played.
-        stop_event (Event): A threading event used to stop the playback loop.
+        e (BadRequestError): The error.
+
+    Returns:
+        bool: True if the error is about `tools`, `tool_calls` or the `tool` role.
     """
-    pygame.mixer.init()
-    pygame.mixer.music.load(file_path)
-    pygame.mixer.music.set_volume(0.05)
+    details: str = f"{e.message} {json.dumps(e.body) if e.body is not None else ''}".lower()
+    return any(word in details for word in ("tool", "function"))
 
-    while not stop_event.is_set():
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy() and not stop_event.is_set():
-            pygame.time.Clock().tick(10)
 
+def to_text_protocol(messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Rewrites native function calling messages into the `<tool>` text protocol.
+
+    Args:
+        messages (list[dict[str, Any]]): Conversation messages.
 
-async def ahandle_stream(stream: AsyncStream, verbose: bool = True) -> tuple[str, Metadata, bool]:
+    Returns:
+        list[dict[str, Any]]: Messages without `tool_calls` or `tool` roles.
+    """
+    converted: list[dict[str, Any]] = []
+    for message in messages:
+        if message.get("tool_calls"):
+            tool_calls = [
+                ToolCall(id=t["id"], name=t["function"]["name"], arguments=parse_tool_arguments(t["function"]["arguments"]))
+                for t in message["tool_calls"]
+            ]
+            converted.append(assistant_tool_call_message(tool_calls=tool_calls, native=False))
+        elif message.get("role") == "tool":
+            converted.append({"role": "ipython", "content": message.get("content")})
+        else:
+            converted.append(message)
+    return converted
+
+
+async def ahandle_stream(
+    stream: AsyncStream, verbose: bool = True, renderer: TokenRenderer | None = None, audio: "AudioOutput | None" = None
+) -> tuple[str, Metadata, list[ToolCall]]:
+    renderer = renderer or TokenRenderer()
     response: list[str] = []
     tool_calls: bool = False
-    stop_audio = threading.Event()
-    audio_thread = None
+    native_calls: dict[int, dict[str, Any]] = {}
+
+    def start_thinking() -> None:
+        renderer.write("Thinking ...", "yellow")
+        # Start the thinking cue, mixed into the shared output
+        if audio is not None and "thinking" in audio.cues:
+            audio.start_cue("thinking", loop=True)
+
+    def stop_thinking() -> None:
+        if audio is not None:
+            audio.stop_cue()
 
     async for chunk in stream:
         if not chunk.choices:
             # When the chunk contain empty choices -> the chunk produced by stream_options={"include_usage": True}. This is the last chunk.
-            if audio_thread and audio_thread.is_alive():
-                # Stop the audio if it's playing
-                stop_audio.set()
-                audio_thread.join()
+            stop_thinking()
 
             metadata: Metadata = Metadata(
                 **chunk.model_dump(),
                 finish_reason=finish_reason,  # noqa: F821
             )
 
+        elif chunk.choices[0].delta.tool_calls:
+            # When the model uses native function calling. Name and arguments arrive in fragments keyed by index.
+            if not native_calls:
+                start_thinking()
+            for delta in chunk.choices[0].delta.tool_calls:
+                call: dict[str, Any] = native_calls.setdefault(delta.index, {"id": None, "name": "", "arguments": []})
+                call["id"] = delta.id or call["id"]
+                if delta.function:
+                    call["name"] += delta.function.name or ""
+                    call["arguments"].append(delta.function.arguments or "")
+
+            if chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason  # noqa: F841
+
         elif token := chunk.choices[0].delta.content:
             # When the delta content has payload. This is when the model dont use a tool.
             response.append(token)
 
             if "<tool>" in token:
                 tool_calls = True
-                print(colored("Thinking ...", "yellow"), end="", flush=True)
-                # Start playing audio in a separate thread
-                stop_audio.clear()
-                audio_thread = threading.Thread(target=play_mp3_loop, args=("assets/beeps.mp3", stop_audio))
-                audio_thread.start()
+                start_thinking()
 
             elif verbose and not tool_calls:
                 # When the stream message stops. This is the n-1 chunk.
-                print(colored(token, "blue"), end="", flush=True)
+                renderer.write(token, "blue")
 
         else:
             # Stop the audio if it's playing
-            if audio_thread and audio_thread.is_alive():
-                stop_audio.set()
-                audio_thread.join()
+            stop_thinking()
 
             finish_reason = chunk.choices[0].finish_reason  # noqa: F841
 
     # Ensure audio is stopped if the function exits
-    if audio_thread and audio_thread.is_alive():
-        stop_audio.set()
-        audio_thread.join()
-
-    return "".join(response), metadata, tool_calls
+    stop_thinking()
+
+    # Gather the tool calls of either protocol
+    calls: list[ToolCall] = [
+        ToolCall(name=c["name"], arguments=parse_tool_arguments("".join(c["arguments"])), **({"id": c["id"]} if c["id"] else {}))
+        for _, c in sorted(native_calls.items())
+    ]
+    if tool_calls and not calls:
+        tool_args: dict[str, Any] = extract_tool_input_args(s="".join(response))
+        calls.append(ToolCall(name=tool_args.get("name"), arguments=tool_args.get("parameters") or {}))
+
+    return "".join(response), metadata, calls
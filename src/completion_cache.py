@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import date
+from pathlib import Path
+from time import time
+from typing import Any, AsyncIterator
+
+from loguru import logger
+from openai import AsyncStream
+from openai.types.chat import ChatCompletionChunk
+from pydantic import BaseModel
+
+from src.settings import Settings
+
+settings = Settings()
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    chunks TEXT,
+    created_at REAL,
+    used_at REAL
+);
+CREATE INDEX IF NOT EXISTS completions_used_at ON completions (used_at);
+"""
+
+
+class CacheStats(BaseModel):
+    """Hit rate of the completion cache."""
+
+    hits: int = 0
+    misses: int = 0
+    bypasses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+
+class ChunkStream:
+    """Async iterator over completion chunks with the `close` of `AsyncStream`, so it can stand in for one."""
+
+    def __init__(self, chunks: AsyncIterator[ChatCompletionChunk]):
+        self._chunks = chunks
+
+    def __aiter__(self) -> AsyncIterator[ChatCompletionChunk]:
+        return self._chunks
+
+    async def close(self) -> None:
+        await self._chunks.aclose()
+
+
+def is_cacheable(messages: list[dict[str, Any]]) -> bool:
+    """Whether a completion only depends on the conversation, not on tool outputs that may have changed since.
+
+    Args:
+        messages (list[dict[str, Any]]): Conversation messages.
+
+    Returns:
+        bool: False if any tool call or tool output is part of the context.
+    """
+    return not any(message.get("role") in ("tool", "ipython") or message.get("tool_calls") for message in messages)
+
+
+def completion_key(model: str, params: dict[str, Any], messages: list[dict[str, Any]]) -> str:
+    """Hash everything a temperature 0 completion depends on.
+
+    Args:
+        model (str): Model name.
+        params (dict[str, Any]): Request parameters other than the messages.
+        messages (list[dict[str, Any]]): Conversation messages.
+
+    Returns:
+        str: Cache key.
+    """
+    # Whitespace differences do not change the answer
+    normalized: list[dict[str, Any]] = [
+        {**message, "content": " ".join(str(message.get("content") or "").split())} for message in messages
+    ]
+    # The date is part of the key so answers never outlive the day they were given on
+    serialized: str = json.dumps(
+        {"model": model, "params": params, "messages": normalized, "date": date.today().isoformat()}, sort_keys=True
+    )
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class CompletionCache:
+    """Cache of streamed temperature 0 completions, replayed as a stream so cached answers go through the same handling.
+
+    Entries expire after `ttl` seconds and the least recently used ones are evicted beyond `max_entries`. SQLite and the
+    JSON encoding of the chunks stay off the event loop: lookups run in a worker thread (`aget`) and completions are
+    stored in the background once their stream ends.
+    """
+
+    def __init__(self, path: Path, ttl: float = 86400.0, max_entries: int = 1000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        # Background stores, referenced until they are done
+        self._storing: set[asyncio.Task] = set()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def get(self, key: str) -> list[dict[str, Any]] | None:
+        """Get the chunks of a cached completion, if it has not expired.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            list[dict[str, Any]] | None: Serialized chunks, None on a miss.
+        """
+        now: float = time()
+        with self._lock, self.connection as connection:
+            row = connection.execute(
+                "SELECT chunks FROM completions WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is not None:
+                connection.execute("UPDATE completions SET used_at = ? WHERE key = ?", (now, key))
+        if row is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return json.loads(row[0])
+
+    async def aget(self, key: str) -> list[dict[str, Any]] | None:
+        """`get` in a worker thread."""
+        return await asyncio.to_thread(self.get, key=key)
+
+    def put(self, key: str, chunks: list[dict[str, Any]]) -> None:
+        """Store a completion and evict the least recently used ones beyond the size limit.
+
+        Args:
+            key (str): Cache key.
+            chunks (list[dict[str, Any]]): Serialized chunks.
+        """
+        now: float = time()
+        with self._lock, self.connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO completions (key, chunks, created_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(chunks), now, now),
+            )
+            connection.execute("DELETE FROM completions WHERE created_at <= ?", (now - self.ttl,))
+            connection.execute(
+                "DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def record(self, stream: AsyncStream, key: str) -> ChunkStream:
+        """Pass a stream through, storing it once it has been consumed to the end.
+
+        Args:
+            stream (AsyncStream): Completion stream.
+            key (str): Cache key.
+
+        Returns:
+            ChunkStream: The same chunks.
+        """
+
+        async def chunks() -> AsyncIterator[ChatCompletionChunk]:
+            recorded: list[dict[str, Any]] = []
+            try:
+                async for chunk in stream:
+                    recorded.append(chunk.model_dump(exclude_unset=True))
+                    yield chunk
+            finally:
+                await stream.close()
+            # Only complete completions are stored, an interrupted one never reaches this point
+            task: asyncio.Task = asyncio.create_task(asyncio.to_thread(self.put, key=key, chunks=recorded))
+            self._storing.add(task)
+            task.add_done_callback(self._stored)
+
+        return ChunkStream(chunks=chunks())
+
+    def _stored(self, task: asyncio.Task) -> None:
+        self._storing.discard(task)
+        if not task.cancelled() and (e := task.exception()) is not None:
+            logger.error("Error storing a completion in the cache: {e}", e=e)
+
+    @staticmethod
+    def replay(chunks: list[dict[str, Any]]) -> ChunkStream:
+        """Turn cached chunks back into a stream.
+
+        Args:
+            chunks (list[dict[str, Any]]): Serialized chunks.
+
+        Returns:
+            ChunkStream: The completion chunks.
+        """
+
+        async def replayed() -> AsyncIterator[ChatCompletionChunk]:
+            for chunk in chunks:
+                yield ChatCompletionChunk.model_validate(chunk)
+
+        return ChunkStream(chunks=replayed())
+
+    def log_stats(self) -> None:
+        logger.info(
+            "Completion cache hit rate: {r:.0%} ({h} hits, {m} misses, {b} bypassed)",
+            r=self.stats.hit_rate,
+            h=self.stats.hits,
+            m=self.stats.misses,
+            b=self.stats.bypasses,
+        )
+
+
+completion_cache = CompletionCache(
+    path=settings.cache_dir / "completions.sqlite3", ttl=settings.completion_cache_ttl, max_entries=settings.completion_cache_size
+)
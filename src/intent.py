@@ -0,0 +1,277 @@
+import math
+import re
+from collections import Counter
+from collections.abc import Mapping
+from typing import Any
+
+from pydantic import BaseModel, Field, ValidationError
+
+# Words that never help to tell one tool apart from another.
+STOPWORDS: set[str] = {
+    "a", "an", "and", "are", "at", "be", "can", "could", "for", "from", "get", "give", "hey", "i", "in", "is", "it",
+    "jarvis", "like", "me", "my", "of", "on", "please", "show", "tell", "the", "to", "what", "whats", "will", "with",
+    "you", "n", "number", "specified",
+}  # fmt: skip
+
+# Words that signal a side effect. Those requests always go through the planning LLM call.
+WRITE_VERBS: set[str] = {"add", "book", "create", "draft", "insert", "reply", "schedule", "send", "write"}
+
+NUMBER_WORDS: dict[str, int] = {
+    "a": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}  # fmt: skip
+
+# Most items a single fast-path read returns, larger requests are left to the model.
+MAX_COUNT: int = 20
+
+# Words that do not belong in a city name: times, units, conjunctions and relative clauses make the request ambiguous.
+CITY_STOPWORDS: set[str] = {
+    "today", "tonight", "tomorrow", "yesterday", "now", "later", "morning", "afternoon", "evening", "weekend", "week",
+    "next", "this", "last", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "in", "at", "on",
+    "for", "near", "around", "fahrenheit", "celsius", "degrees", "and", "or", "but", "vs", "versus", "where", "which",
+    "that", "who", "when", "my", "your", "our", "their", "his", "her", "city", "place", "there", "here",
+}  # fmt: skip
+MAX_CITY_WORDS: int = 4
+
+# Words the rules match on that the tool schemas do not mention, added to the classifier documents.
+KEYWORDS: dict[str, str] = {
+    "get_news_data": "headlines guardian el espectador",
+}
+
+_PREFIX: str = r"(?:(?:hey |ok |hi )?jarvis )?(?:please )?(?:(?:can|could|would) you )?(?:please )?"
+_COUNT: str = r"(?P<n>\d+|" + "|".join(NUMBER_WORDS) + r")"
+
+# Rules map an utterance onto a tool and extract its arguments. Utterances are normalized before matching:
+# lowercase, no punctuation apart from apostrophes and hyphens, single spaces.
+RULES: dict[str, list[re.Pattern]] = {
+    "get_weather_data": [
+        re.compile(
+            _PREFIX + r"(?:tell me )?(?:what(?:'s| is) |how(?:'s| is) )?the weather (?:like )?(?:today |now |right now )?"
+            r"(?:in|for|at) (?P<city>[^\W\d_][\w '\-]*?)(?: today| now| right now)?"
+        ),
+        re.compile(_PREFIX + r"(?:what(?:'s| is) the )?weather (?:in|for) (?P<city>[^\W\d_][\w '\-]*?)(?: today| now)?"),
+    ],
+    "read_gmail_emails": [
+        re.compile(
+            _PREFIX
+            + r"(?:read|show|check|get|give) (?:me )?(?:my )?(?:the )?(?:(?:last|latest|most recent|newest) )?"
+            + _COUNT
+            + r" (?:(?:last|latest|most recent|newest|recent) )?(?:e ?mails?|messages?)"
+        ),
+        re.compile(
+            _PREFIX
+            + r"(?:read|show|check|get|give) (?:me )?(?:my )?(?:the )?(?:last|latest|most recent|newest) (?:e ?mail|message)"
+        ),
+    ],
+    "get_calendar_appointments": [
+        re.compile(
+            _PREFIX
+            + r"(?:what are |what's |tell me |show me |read |get |give me |list )?(?:my |the )?(?:next|upcoming) "
+            + _COUNT
+            + r" (?:appointments?|events?|meetings?)"
+        ),
+        re.compile(_PREFIX + r"(?:what(?:'s| is) |tell me |show me )?(?:my |the )?next (?:appointment|event|meeting)"),
+    ],
+    "get_news_data": [
+        re.compile(
+            _PREFIX
+            + r"(?:read |show |get |give |tell )?(?:me )?(?:what(?:'s| is) (?:on )?)?(?:the )?(?:front page|headlines|news) "
+            r"(?:of|from|in|on) (?:the )?(?P<source>guardian|el espectador)(?: today)?"
+        ),
+    ],
+}
+
+# Arguments a rule cannot extract but that follow from what it did extract.
+SOURCE_COUNTRY: dict[str, dict[str, str]] = {
+    "guardian": {"city": "gb", "source": "the-guardian"},
+    "el espectador": {"city": "co", "source": "el-espectador"},
+}
+
+
+def normalize_utterance(s: str) -> str:
+    """Normalize an utterance before matching it against the rules.
+
+    Args:
+        s (str): Raw transcription.
+
+    Returns:
+        str: Lowercase utterance without punctuation and with single spaces.
+    """
+    s = s.lower().replace("’", "'")
+    s = re.sub(r"[^\w' \-]+", " ", s)
+    return " ".join(s.split())
+
+
+def tokenize(s: str) -> list[str]:
+    """Split a text into crude stems, dropping stopwords.
+
+    Args:
+        s (str): Text to tokenize.
+
+    Returns:
+        list[str]: Tokens of the text.
+    """
+    tokens: list[str] = []
+    for word in re.findall(r"[^\W\d_]+", s.lower().replace("_", " ")):
+        if word in STOPWORDS:
+            continue
+        # Singular and plural forms should count as the same word
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+class IntentMatch(BaseModel):
+    """A tool call resolved locally from the user utterance."""
+
+    name: str
+    parameters: dict[str, Any]
+    confidence: float
+
+
+class FastPathStats(BaseModel):
+    """Hit rate and saved latency of the intent fast-path."""
+
+    turns: int = 0
+    hits: int = 0
+    saved_seconds: float = 0.0
+    planning_seconds: float | None = Field(default=None, description="Moving average of the planning call latency")
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.turns if self.turns else 0.0
+
+    def record_hit(self) -> float:
+        """Record a turn served by the fast-path.
+
+        Returns:
+            float: Estimated seconds saved by skipping the planning call.
+        """
+        self.turns += 1
+        self.hits += 1
+        saved: float = self.planning_seconds or 0.0
+        self.saved_seconds += saved
+        return saved
+
+    def record_miss(self, planning_seconds: float | None = None, alpha: float = 0.3) -> None:
+        """Record a turn that went through the planning call.
+
+        Args:
+            planning_seconds (float | None): Latency of a planning call that ended in a tool call, if any.
+            alpha (float): Weight of the newest sample in the moving average.
+        """
+        self.turns += 1
+        if planning_seconds is not None:
+            if self.planning_seconds is None:
+                self.planning_seconds = planning_seconds
+            else:
+                self.planning_seconds = alpha * planning_seconds + (1 - alpha) * self.planning_seconds
+
+
+class IntentMatcher:
+    """Resolves unambiguous tool requests locally, without the planning LLM call.
+
+    Rules extract the tool arguments and a bag-of-words classifier built over the tool schemas must agree with the rule.
+    The tool classes are only looked up to validate the arguments of a match, so a lazy registry stays unloaded.
+    """
+
+    def __init__(self, schemas: list[dict[str, Any]], models: Mapping[str, Any], threshold: float = 0.75):
+        self.threshold = threshold
+        self.models = models
+        documents: dict[str, Counter] = {}
+        for schema in schemas:
+            text: list[str] = [schema["name"], schema["description"]]
+            text.extend(p.get("description", "") for p in schema["parameters"]["properties"].values())
+            text.append(KEYWORDS.get(schema["name"], ""))
+            documents[schema["name"]] = Counter(tokenize(" ".join(text)))
+
+        # TF-IDF vectors of the tool schemas
+        df: Counter = Counter(token for document in documents.values() for token in document)
+        self.idf: dict[str, float] = {token: math.log((1 + len(documents)) / (1 + count)) + 1 for token, count in df.items()}
+        self.vectors: dict[str, dict[str, float]] = {}
+        for name, document in documents.items():
+            vector = {token: tf * self.idf[token] for token, tf in document.items()}
+            norm = math.sqrt(sum(v * v for v in vector.values()))
+            self.vectors[name] = {token: v / norm for token, v in vector.items()}
+
+    def scores(self, utterance: str) -> dict[str, float]:
+        """Cosine similarity between the utterance and every tool schema.
+
+        Args:
+            utterance (str): User utterance.
+
+        Returns:
+            dict[str, float]: Similarity per tool name.
+        """
+        counts = Counter(token for token in tokenize(utterance) if token in self.idf)
+        query = {token: tf * self.idf[token] for token, tf in counts.items()}
+        norm = math.sqrt(sum(v * v for v in query.values())) or 1.0
+        return {
+            name: sum(weight * vector.get(token, 0.0) for token, weight in query.items()) / norm
+            for name, vector in self.vectors.items()
+        }
+
+    def extract(self, utterance: str) -> tuple[str, dict[str, Any]] | None:
+        """Apply the rules to a normalized utterance.
+
+        Args:
+            utterance (str): Normalized utterance.
+
+        Returns:
+            tuple[str, dict[str, Any]] | None: Tool name and raw arguments of the first matching rule.
+        """
+        for name, patterns in RULES.items():
+            if name not in self.models:
+                continue
+            for pattern in patterns:
+                if not (match := pattern.fullmatch(utterance)):
+                    continue
+                groups: dict[str, str] = {k: v for k, v in match.groupdict().items() if v is not None}
+                if "n" in groups:
+                    n: int = int(groups["n"]) if groups["n"].isdigit() else NUMBER_WORDS[groups["n"]]
+                    if not 1 <= n <= MAX_COUNT:
+                        return None
+                    groups["n"] = n
+                elif name in ("read_gmail_emails", "get_calendar_appointments"):
+                    groups["n"] = 1
+                if "city" in groups:
+                    # "New York tomorrow", "London and Paris", "the city where my meeting is": leave it to the model
+                    words: list[str] = groups["city"].split()
+                    if words[:1] == ["the"]:
+                        # "the uk", "the netherlands"
+                        words = words[1:]
+                    if not words or len(words) > MAX_CITY_WORDS or CITY_STOPWORDS.intersection(words):
+                        return None
+                    groups["city"] = " ".join(words).title()
+                if "source" in groups:
+                    groups = SOURCE_COUNTRY[groups["source"]]
+                return name, groups
+        return None
+
+    def match(self, utterance: str) -> IntentMatch | None:
+        """Resolve the utterance into a validated tool call.
+
+        Args:
+            utterance (str): User utterance.
+
+        Returns:
+            IntentMatch | None: The tool call if the confidence is above the threshold, None otherwise.
+        """
+        normalized: str = normalize_utterance(utterance)
+        if WRITE_VERBS.intersection(normalized.split()) or not (extracted := self.extract(normalized)):
+            return None
+        name, parameters = extracted
+
+        # The rule and the classifier must agree on the tool
+        scores: dict[str, float] = self.scores(normalized)
+        total: float = sum(scores.values())
+        share: float = scores[name] / total if total else 0.0
+        confidence: float = 0.5 + 0.5 * share
+        if confidence < self.threshold:
+            return None
+
+        try:
+            parameters = self.models[name].model_validate(parameters).model_dump()
+        except ValidationError:
+            return None
+        return IntentMatch(name=name, parameters=parameters, confidence=confidence)
@@ -0,0 +1,348 @@
+import json
+import re
+import threading
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from loguru import logger
+from pydantic import BaseModel
+
+from src.persistence import load_transcript
+from src.settings import Settings
+from src.transcript import Transcript
+
+settings = Settings()
+
+
+class Memory(BaseModel):
+    """A past turn recalled for the current one."""
+
+    conversation_id: str
+    date: str
+    text: str
+    score: float
+
+
+class HashingEmbedder:
+    """Dependency free embedder: signed feature hashing of words and word bigrams.
+
+    Only captures lexical overlap. Used when fastembed is not installed.
+    """
+
+    name: str = "hashing"
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors: np.ndarray = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words: list[str] = re.findall(r"\w+", text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                h: int = zlib.crc32(feature.encode())
+                vectors[i, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors=vectors)
+
+
+class FastEmbedder:
+    """Small CPU embedding model through fastembed (ONNX runtime)."""
+
+    def __init__(self, model_name: str = "BAAI/bge-small-en-v1.5"):
+        from fastembed import TextEmbedding
+
+        self.name = model_name
+        self.model = TextEmbedding(model_name=model_name)
+        self.dim: int = len(next(iter(self.model.embed(["dimension probe"]))))
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        return normalize(vectors=np.array(list(self.model.embed(texts, batch_size=64)), dtype=np.float32))
+
+
+def default_embedder() -> HashingEmbedder | FastEmbedder:
+    """fastembed if it is installed, feature hashing otherwise."""
+    try:
+        return FastEmbedder()
+    except ImportError:
+        logger.warning("fastembed is not installed, long-term memory falls back to lexical hashing embeddings")
+        return HashingEmbedder()
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale rows to unit length, so dot products are cosine similarities."""
+    norms: np.ndarray = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    if len(scores) > k:
+        candidates: np.ndarray = np.argpartition(-scores, k)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def conversation_turns(transcript: Transcript) -> list[str]:
+    """Pair each user message of a saved conversation with the assistant answer to it.
+
+    Args:
+        transcript (Transcript): The conversation, as loaded by `load_transcript`.
+
+    Returns:
+        list[str]: One text per turn, in conversation order.
+    """
+    if not len(transcript):
+        return []
+    # Every snapshot holds the whole conversation up to that point, the last one has it all
+    messages: list[dict[str, Any]] = transcript.messages(index=-1)
+    turns: list[str] = []
+    question: str | None = None
+    for message in messages:
+        if message.get("role") == "user":
+            question = message.get("content")
+        elif message.get("role") == "assistant" and question and message.get("content") and not message.get("tool_calls"):
+            if "<tool>" not in message["content"]:
+                turns.append(f"User: {question}\nAssistant: {message['content']}")
+                question = None
+    return turns
+
+
+class MemoryIndex:
+    """Embeddings of past conversation turns in a memory mapped matrix, answering top-k cosine similarity queries.
+
+    Vectors are appended to a raw float32 file and turn texts to a JSON lines file with a parallel offsets file, so
+    neither is ever loaded whole. Queries are one matrix-vector product; past `ivf_min_rows` rows an inverted file index
+    (spherical k-means lists) limits the product to the `nprobe` closest lists plus the rows added since it was built.
+    """
+
+    def __init__(
+        self, directory: Path, embedder: Any = None, ivf_min_rows: int = 100_000, nprobe: int = 16, rebuild_ratio: float = 0.1
+    ):
+        self.directory = directory
+        self._embedder = embedder
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self.rebuild_ratio = rebuild_ratio
+        self._vectors: np.memmap | None = None
+        self._offsets: np.memmap | None = None
+        self._ivf: dict[str, np.ndarray] | None = None
+        self._state: dict[str, Any] | None = None
+        # Guards the files and state, held briefly by appends and queries; embedding happens outside of it
+        self._lock = threading.Lock()
+        self._indexing = threading.Lock()
+
+    @property
+    def embedder(self) -> Any:
+        # Loading a model takes a while, only do it when memory is used
+        if self._embedder is None:
+            self._embedder = default_embedder()
+        return self._embedder
+
+    @property
+    def state(self) -> dict[str, Any]:
+        if self._state is None:
+            path: Path = self.directory / "state.json"
+            self._state = json.loads(path.read_text()) if path.exists() else {}
+            if self._state.get("embedder") != self.embedder.name or self._state.get("dim") != self.embedder.dim:
+                # Vectors of another model are not comparable, start over
+                self._reset()
+        return self._state
+
+    def __len__(self) -> int:
+        return self.state["rows"]
+
+    def _reset(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for name in ("vectors.f32", "offsets.i64", "turns.jsonl", "ivf.npz"):
+            (self.directory / name).unlink(missing_ok=True)
+        self._state = {"embedder": self.embedder.name, "dim": self.embedder.dim, "rows": 0, "conversations": {}}
+        self._save_state()
+        self._vectors, self._offsets, self._ivf = None, None, None
+
+    def _save_state(self) -> None:
+        (self.directory / "state.json").write_text(json.dumps(self._state))
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None or len(self._vectors) != len(self):
+            if not len(self):
+                return np.zeros((0, self.state["dim"]), dtype=np.float32)
+            self._vectors = np.memmap(
+                self.directory / "vectors.f32", dtype=np.float32, mode="r", shape=(len(self), self.state["dim"])
+            )
+            self._offsets = np.memmap(self.directory / "offsets.i64", dtype=np.int64, mode="r", shape=(len(self),))
+        return self._vectors
+
+    def add_vectors(self, vectors: np.ndarray, records: list[dict[str, Any]]) -> None:
+        """Append embedded turns.
+
+        Args:
+            vectors (np.ndarray): Unit length embeddings, one row per record.
+            records (list[dict[str, Any]]): `conversation_id`, `date` and `text` of each turn.
+        """
+        with open(self.directory / "turns.jsonl", "ab") as turns_fp:
+            position: int = turns_fp.tell()
+            lines: list[bytes] = [json.dumps(record).encode() + b"\n" for record in records]
+            offsets: np.ndarray = position + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.int64)
+            turns_fp.write(b"".join(lines))
+        with open(self.directory / "offsets.i64", "ab") as fp:
+            offsets.tofile(fp)
+        with open(self.directory / "vectors.f32", "ab") as fp:
+            np.ascontiguousarray(vectors, dtype=np.float32).tofile(fp)
+        self.state["rows"] += len(records)
+        self._save_state()
+
+    def index_history(self, directory: Path = Path("history"), exclude: set[str] | None = None) -> int:
+        """Embed the turns of saved conversations that are not indexed yet.
+
+        Args:
+            directory (Path): Directory of the chat history files.
+            exclude (set[str] | None): Conversations to leave out, like the current one.
+
+        Returns:
+            int: Number of turns added.
+        """
+        added: int = 0
+        # Queries keep answering from the rows added so far, only one indexer runs at a time
+        with self._indexing:
+            # Transcripts, and the chat history files of earlier versions
+            paths: list[Path] = [*directory.glob("*.jsonl"), *directory.glob("*.json")]
+            for path in sorted(paths, key=lambda path: path.stat().st_mtime):
+                conversation_id: str = path.stem
+                if exclude and conversation_id in exclude:
+                    continue
+                try:
+                    turns: list[str] = conversation_turns(transcript=load_transcript(path=path))
+                except (ValueError, KeyError, OSError) as e:
+                    logger.warning("Skipping chat history {path}: {e}", path=path, e=e)
+                    continue
+
+                # Conversations only grow, the turns indexed before are a prefix
+                new_turns: list[str] = turns[self.state["conversations"].get(conversation_id, 0) :]
+                if not new_turns:
+                    continue
+                date: str = datetime.fromtimestamp(path.stat().st_mtime).strftime("%Y-%m-%d")
+                vectors: np.ndarray = self.embedder.embed(new_turns)
+                with self._lock:
+                    self.state["conversations"][conversation_id] = len(turns)
+                    self.add_vectors(
+                        vectors=vectors,
+                        records=[{"conversation_id": conversation_id, "date": date, "text": text} for text in new_turns],
+                    )
+                added += len(new_turns)
+            ivf: dict[str, np.ndarray] | None = self._load_ivf()
+            if len(self) >= self.ivf_min_rows and (ivf is None or len(self) - int(ivf["rows"]) > self.rebuild_ratio * len(self)):
+                self.build_ivf()
+        return added
+
+    def _load_ivf(self) -> dict[str, np.ndarray] | None:
+        if self._ivf is None and (path := self.directory / "ivf.npz").exists():
+            self._ivf = dict(np.load(path))
+        return self._ivf
+
+    def build_ivf(self, nlist: int | None = None, sample_size: int = 50_000, iterations: int = 10, block: int = 65_536) -> None:
+        """Partition the rows into `nlist` lists around spherical k-means centroids.
+
+        Args:
+            nlist (int | None): Number of lists, about the square root of the number of rows by default.
+            sample_size (int): Rows used to train the centroids.
+            iterations (int): k-means iterations.
+            block (int): Rows assigned per matrix product, bounds the memory used.
+        """
+        vectors: np.ndarray = self.vectors
+        rows: int = len(vectors)
+        nlist = nlist or max(1, int(np.sqrt(rows)))
+        rng: np.random.Generator = np.random.default_rng(0)
+        sample: np.ndarray = np.asarray(vectors[np.sort(rng.choice(rows, size=min(sample_size, rows), replace=False))])
+
+        centroids: np.ndarray = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignment: np.ndarray = np.argmax(sample @ centroids.T, axis=1)
+            sums: np.ndarray = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty: np.ndarray = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize(vectors=sums)
+
+        assignment = np.concatenate(
+            [np.argmax(vectors[i : i + block] @ centroids.T, axis=1) for i in range(0, rows, block)]
+        ).astype(np.int32)
+        ids: np.ndarray = np.argsort(assignment, kind="stable").astype(np.int64)
+        offsets: np.ndarray = np.searchsorted(assignment[ids], np.arange(nlist + 1)).astype(np.int64)
+        self._ivf = {"centroids": centroids, "ids": ids, "offsets": offsets, "rows": np.array(rows)}
+        np.savez(self.directory / "ivf.npz", **self._ivf)
+        logger.info("Memory IVF index built: {n} rows in {l} lists", n=rows, l=nlist)
+
+    def search_vector(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k rows by cosine similarity to a unit length query.
+
+        Args:
+            query (np.ndarray): Query embedding.
+            k (int): Number of rows.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Row ids and scores, best first.
+        """
+        vectors: np.ndarray = self.vectors
+        ivf: dict[str, np.ndarray] | None = self._load_ivf() if len(vectors) >= self.ivf_min_rows else None
+        if ivf is None:
+            scores: np.ndarray = vectors @ query
+            best: np.ndarray = top_k(scores=scores, k=k)
+            return best, scores[best]
+
+        # Closest lists, plus the rows appended since the index was built
+        lists: np.ndarray = top_k(scores=ivf["centroids"] @ query, k=self.nprobe)
+        candidates: np.ndarray = np.concatenate(
+            [ivf["ids"][ivf["offsets"][i] : ivf["offsets"][i + 1]] for i in lists] + [np.arange(int(ivf["rows"]), len(vectors))]
+        )
+        candidates.sort()
+        scores = vectors[candidates] @ query
+        best = top_k(scores=scores, k=k)
+        return candidates[best], scores[best]
+
+    def search(self, query: str, k: int = 3, min_score: float = 0.0) -> list[Memory]:
+        """Past turns most similar to a query.
+
+        Args:
+            query (str): Text to look up, usually the user message.
+            k (int): Maximum number of turns.
+            min_score (float): Minimum cosine similarity.
+
+        Returns:
+            list[Memory]: Turns, most similar first.
+        """
+        if not len(self):
+            return []
+        embedding: np.ndarray = self.embedder.embed([query])[0]
+        memories: list[Memory] = []
+        with self._lock, open(self.directory / "turns.jsonl", "rb") as fp:
+            ids, scores = self.search_vector(query=embedding, k=k)
+            for row, score in zip(ids, scores):
+                if score < min_score:
+                    break
+                fp.seek(int(self._offsets[row]))
+                memories.append(Memory(**json.loads(fp.readline()), score=float(score)))
+        return memories
+
+
+def format_memories(memories: list[Memory], max_chars: int = 300) -> str:
+    """Render recalled turns as a compact system message.
+
+    Args:
+        memories (list[Memory]): Recalled turns.
+        max_chars (int): Characters kept of each turn.
+
+    Returns:
+        str: Message content.
+    """
+    snippets: list[str] = []
+    for memory in memories:
+        text: str = " ".join(memory.text.split())
+        snippets.append(f"- [{memory.date}] {text[:max_chars]}{'...' if len(text) > max_chars else ''}")
+    return "Relevant excerpts from past conversations with the user:\n" + "\n".join(snippets)
+
+
+memory_index = MemoryIndex(directory=settings.cache_dir / "memory")
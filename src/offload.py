@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+from typing import Any, Callable, TypeVar
+
+from loguru import logger
+
+from src.scheduler import remaining
+from src.settings import Settings
+
+settings = Settings()
+
+T = TypeVar("T")
+
+# Buffers smaller than this are cheaper to pickle than to share
+SHARED_MEMORY_MIN_SIZE: int = 1 << 20
+
+
+class OffloadTimeout(TimeoutError):
+    """Raised when offloaded work does not finish in time."""
+
+
+def _call_shared(fn: Callable[..., T], name: str, size: int, args: tuple, kwargs: dict[str, Any]) -> T:
+    """Run `fn` in a worker process on a buffer in shared memory, passed as a memoryview in place of the bytes."""
+    # Spawned workers share the parent's resource tracker, the segment stays registered once, to the parent
+    shm = SharedMemory(name=name)
+    view: memoryview = shm.buf[:size]
+    try:
+        return fn(view, *args, **kwargs)
+    finally:
+        view.release()
+        shm.close()
+
+
+class Offload:
+    """Shared, size-bounded pools for CPU heavy tool steps, so the event loop keeps streaming tokens and audio.
+
+    Work that holds the GIL (pure Python, base64, hashing) goes to the process pool; work that releases it (image codecs,
+    compression, blocking I/O) goes to the thread pool, which shares memory with the loop. Large buffers reach the process
+    pool through shared memory: one copy into the segment instead of pickling through a pipe. Both pools start on first
+    use. Every call has a timeout, capped by the turn deadline; on timeout or cancellation queued work is dropped and
+    running work is abandoned, its result discarded.
+    """
+
+    def __init__(self, processes: int = 2, threads: int = 4, timeout: float = 30.0):
+        self.processes = processes
+        self.threads = threads
+        self.timeout = timeout
+        self._process_pool: ProcessPoolExecutor | None = None
+        self._thread_pool: ThreadPoolExecutor | None = None
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        if self._process_pool is None:
+            # Forking a process that runs audio and GUI threads is unsafe, workers are spawned
+            self._process_pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self._process_pool
+
+    @property
+    def thread_pool(self) -> ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="offload")
+        return self._thread_pool
+
+    async def run(self, fn: Callable[..., T], *args: Any, process: bool = True, timeout: float | None = None, **kwargs: Any) -> T:
+        """Run a blocking function off the event loop.
+
+        Args:
+            fn (Callable[..., T]): The function. For the process pool it must be importable (defined at module level) and
+                its arguments picklable.
+            *args (Any): Positional arguments.
+            process (bool): Whether to run in the process pool rather than the thread pool.
+            timeout (float | None): Seconds to wait for the result, the pool default if None.
+            **kwargs (Any): Keyword arguments.
+
+        Returns:
+            T: What the function returned.
+        """
+        pool: Executor = self.process_pool if process else self.thread_pool
+        return await self._wait(future=pool.submit(fn, *args, **kwargs), name=fn.__name__, timeout=timeout)
+
+    async def run_on_buffer(
+        self, fn: Callable[..., T], data: bytes | memoryview, *args: Any, timeout: float | None = None, **kwargs: Any
+    ) -> T:
+        """Run a function on a large buffer in the process pool without pickling the buffer.
+
+        Args:
+            fn (Callable[..., T]): Module level function taking the buffer (a memoryview) as its first argument. It must not
+                keep references to the view after returning.
+            data (bytes | memoryview): The buffer.
+            *args (Any): Further positional arguments.
+            timeout (float | None): Seconds to wait for the result, the pool default if None.
+            **kwargs (Any): Keyword arguments.
+
+        Returns:
+            T: What the function returned.
+        """
+        if len(data) < SHARED_MEMORY_MIN_SIZE:
+            return await self.run(fn, bytes(data), *args, timeout=timeout, **kwargs)
+
+        shm = SharedMemory(create=True, size=len(data))
+        try:
+            shm.buf[: len(data)] = data
+            future: Future = self.process_pool.submit(partial(_call_shared, fn, shm.name, len(data), args, kwargs))
+            return await self._wait(future=future, name=fn.__name__, timeout=timeout)
+        finally:
+            # The worker attached by name, the segment outlives this unlink until it closes it
+            shm.close()
+            shm.unlink()
+
+    async def _wait(self, future: Future, name: str, timeout: float | None) -> Any:
+        timeout = self.timeout if timeout is None else timeout
+        if (left := remaining()) is not None:
+            timeout = min(timeout, max(left, 0.0))
+        _now: float = perf_counter()
+        try:
+            async with asyncio.timeout(timeout):
+                result: Any = await asyncio.wrap_future(future)
+        except TimeoutError as e:
+            future.cancel()
+            raise OffloadTimeout(f"{name} did not finish in {timeout:.1f} seconds") from e
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        logger.debug("Offloaded {name} took {s:.3f} seconds", name=name, s=perf_counter() - _now)
+        return result
+
+    def shutdown(self) -> None:
+        """Stop the pools, dropping queued work."""
+        for pool in (self._process_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._process_pool = self._thread_pool = None
+
+
+offload = Offload(processes=settings.offload_processes, threads=settings.offload_threads, timeout=settings.offload_timeout)
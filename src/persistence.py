@@ -2,31 +2,44 @@ import json
 from pathlib import Path
 from typing import Any
 
+from src.transcript import Transcript
 
-def save_json_chat_history(conversation_id: str, chat_history: dict[str, Any], directory: Path = Path("history")) -> None:
+
+def save_transcript(transcript: Transcript, directory: Path = Path("history")) -> None:
     """
-    Saves chat history as a JSON file.
+    Appends what the transcript recorded since it was last saved to its JSON lines file, so saving a turn costs the
+    size of the turn rather than of the conversation.
 
     Args:
-        conversation_id (str): Unique identifier of the conversation.
-        chat_history (Dict[str, Any]): Content of the JSON file that will be written.
-            - 'conversation_id'
-            - 'content'
-                - 'messages'
-                - 'metadata'
-            - 'temperature'
-            - 'stream'
-        directory (Path): Path that stores the JSON file.
+        transcript (Transcript): Transcript of the conversation.
+        directory (Path): Path that stores the JSON lines file.
 
     Return:
         None
     """
-    # Make directory or skip if it already exists.
+    if not (lines := transcript.pending()):
+        return
     directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / f"{transcript.conversation_id}.jsonl", mode="a") as fp:
+        fp.write(lines)
+
 
-    # Make path of JSON file.
-    file_path: Path = directory / f"{conversation_id}.json"
+def load_transcript(path: Path) -> Transcript:
+    """
+    Loads a saved conversation: a transcript file, or a JSON chat history file saved by earlier versions.
 
-    # Save JSON file.
-    with open(file_path, mode="w") as fp:
-        json.dump(chat_history, fp, indent=4)
+    Args:
+        path (Path): Path of the `.jsonl` or `.json` file.
+
+    Return:
+        Transcript: The conversation. Of a chat history file, only its last and complete context is kept.
+    """
+    with open(path) as fp:
+        if path.suffix == ".jsonl":
+            return Transcript.load(lines=fp)
+        chat_history: dict[str, Any] = json.load(fp)
+    transcript = Transcript(conversation_id=chat_history.get("conversation_id", path.stem))
+    if content := chat_history.get("content"):
+        *_, last = content
+        transcript.record(messages=last.get("messages", []), metadata={k: v for k, v in last.items() if k != "messages"})
+    return transcript
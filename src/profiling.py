@@ -0,0 +1,200 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+from pathlib import Path
+from time import monotonic, sleep
+from types import FrameType
+
+from loguru import logger
+from pydantic import BaseModel
+
+
+class Stall(BaseModel):
+    """A callback that blocked the event loop."""
+
+    seconds: float
+    stack: str
+
+
+class LagStats(BaseModel):
+    """Event loop lag since the last reset."""
+
+    samples: int = 0
+    total_lag: float = 0.0
+    max_lag: float = 0.0
+    stalls: int = 0
+
+    @property
+    def mean_lag(self) -> float:
+        return self.total_lag / self.samples if self.samples else 0.0
+
+
+class LoopWatchdog:
+    """Measures event loop lag and captures the stack of callbacks that block it for longer than `threshold`.
+
+    A heartbeat task on the loop records when it last ran. A watchdog thread checks the heartbeat and, once it is
+    `threshold` late, takes the stack of the loop thread while the blocking callback is still running. The cost is one
+    timer per `interval` on the loop and one wakeup per `interval` in the thread.
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05, history: int = 100):
+        self.threshold = threshold
+        self.interval = interval
+        self.stats = LagStats()
+        self.stalls: deque[Stall] = deque(maxlen=history)
+        self._beat: float = monotonic()
+        self._reported: float | None = None
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """Start watching the running loop."""
+        self._loop_thread_id = threading.get_ident()
+        self._beat = monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected: float = monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now: float = monotonic()
+            lag: float = max(0.0, now - expected)
+            self.stats.samples += 1
+            self.stats.total_lag += lag
+            self.stats.max_lag = max(self.stats.max_lag, lag)
+            if self._reported is not None:
+                self.stalls[-1].seconds = lag
+                logger.warning("Event loop was blocked for {s:.0f} ms", s=lag * 1000)
+                self._reported = None
+            self._beat = now
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            beat: float = self._beat
+            late: float = monotonic() - beat - self.interval
+            if late < self.threshold or self._reported is not None:
+                continue
+            # The loop thread is still inside the blocking callback, its stack names the culprit
+            frame: FrameType | None = sys._current_frames().get(self._loop_thread_id)
+            stack: str = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            self._reported = monotonic()
+            self.stats.stalls += 1
+            self.stalls.append(Stall(seconds=late, stack=stack))
+            logger.warning("Event loop blocked for more than {s:.0f} ms in:\n{stack}", s=late * 1000, stack=stack)
+
+    def log_stats(self, reset: bool = True) -> None:
+        """Log the lag since the last reset.
+
+        Args:
+            reset (bool): Whether to start over.
+        """
+        logger.info(
+            "Event loop lag: mean {m:.1f} ms, max {x:.1f} ms, {n} stalls over {t:.0f} ms",
+            m=self.stats.mean_lag * 1000,
+            x=self.stats.max_lag * 1000,
+            n=self.stats.stalls,
+            t=self.threshold * 1000,
+        )
+        if reset:
+            self.stats = LagStats()
+
+
+def frame_label(frame: FrameType) -> str:
+    """Name of a frame in a folded stack."""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Statistical profiler that samples the stacks of all threads from a background thread.
+
+    Samples are aggregated as folded stacks (`thread;outer;...;inner count`), the input format of flamegraph.pl,
+    speedscope and inferno, and written once per turn. Toggled with SIGUSR1; while off the sampling thread sleeps.
+    """
+
+    def __init__(self, directory: Path = Path("profiles"), interval: float = 0.005):
+        self.directory = directory
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self._enabled = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled.is_set()
+
+    def start(self) -> None:
+        self._enabled.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        logger.info("Sampling profiler started, writing to {d}", d=self.directory)
+
+    def stop(self) -> None:
+        self._enabled.clear()
+        logger.info("Sampling profiler stopped")
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def install_signal_handler(self, sig: int = signal.SIGUSR1) -> None:
+        """Toggle the profiler with a signal, e.g. `kill -USR1 <pid>`. Must be called from the running loop."""
+        asyncio.get_running_loop().add_signal_handler(sig, self.toggle)
+
+    def _run(self) -> None:
+        own_id: int = threading.get_ident()
+        while True:
+            self._enabled.wait()
+            names: dict[int, str] = {thread.ident: thread.name for thread in threading.enumerate()}
+            folded: list[str] = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack: list[str] = []
+                while frame is not None:
+                    stack.append(frame_label(frame=frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                folded.append(";".join(reversed(stack)))
+            with self._lock:
+                self.samples.update(folded)
+            sleep(self.interval)
+
+    def dump(self, label: str) -> Path | None:
+        """Write the samples collected since the last dump as folded stacks.
+
+        Args:
+            label (str): Name of the profiled span, like the turn.
+
+        Returns:
+            Path | None: The written file, None if there were no samples.
+        """
+        with self._lock:
+            samples, self.samples = self.samples, Counter()
+        if not samples:
+            return None
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path: Path = self.directory / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{label}.folded"
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in samples.most_common()))
+        logger.info("Profile of {label} written to {path} ({n} samples)", label=label, path=path, n=samples.total())
+        return path
@@ -1,4 +1,5 @@
 from typing import Any
+from uuid import uuid4
 
 from pydantic import BaseModel, Field
 
@@ -10,3 +11,9 @@ class Metadata(BaseModel):
     system_fingerprint: str
     usage: dict[str, Any]
     finish_reason: str = Field(default="unknown")
+
+
+class ToolCall(BaseModel):
+    id: str = Field(default_factory=lambda: f"call_{uuid4().hex[:24]}")
+    name: str
+    arguments: dict[str, Any]
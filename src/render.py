@@ -0,0 +1,80 @@
+import asyncio
+import sys
+from typing import TextIO
+
+from termcolor import colored
+
+
+class TokenRenderer:
+    """Writes streamed tokens to the terminal at a capped frame rate.
+
+    Tokens are buffered and a background task flushes them `hz` times per second, or right away on a newline, so the
+    stream consumer never pays for ANSI formatting and a flushing write per token. While the task is not running every
+    write is flushed immediately. A disabled renderer (headless mode) drops everything.
+    """
+
+    def __init__(self, hz: float = 30.0, enabled: bool = True, stream: TextIO | None = None):
+        self.interval = 1 / hz
+        self.enabled = enabled
+        self.stream = stream or sys.stdout
+        self._buffer: list[tuple[str | None, str]] = []
+        self._task: asyncio.Task | None = None
+
+    def write(self, text: str, color: str | None = None) -> None:
+        """Queue text for the next frame.
+
+        Args:
+            text (str): Text to write.
+            color (str | None): termcolor color of the text.
+        """
+        if not self.enabled:
+            return
+        self._buffer.append((color, text))
+        if self._task is None or "\n" in text:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered text, formatting each run of same colored text once."""
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, []
+
+        runs: list[str] = []
+        run_color, run = buffer[0][0], [buffer[0][1]]
+        for color, text in buffer[1:]:
+            if color != run_color:
+                runs.append(colored("".join(run), run_color) if run_color else "".join(run))
+                run_color, run = color, []
+            run.append(text)
+        runs.append(colored("".join(run), run_color) if run_color else "".join(run))
+
+        self.stream.write("".join(runs))
+        self.stream.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def start(self) -> None:
+        """Start flushing at the capped rate in the background."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background flushing and write what is left."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    async def __aenter__(self) -> "TokenRenderer":
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
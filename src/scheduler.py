@@ -0,0 +1,327 @@
+import asyncio
+import random
+import threading
+from collections import deque
+from contextvars import Context, ContextVar, copy_context
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep, time
+from typing import Any, Awaitable, Callable, TypeVar
+
+import httpx
+import openai
+from loguru import logger
+from pydantic import BaseModel
+
+from src.settings import Settings
+
+settings = Settings()
+
+T = TypeVar("T")
+
+# Monotonic time by which the current turn has to be done, inherited by the tasks it starts.
+deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+def without_deadline() -> Context:
+    """A copy of the current context with no turn deadline, for work shared beyond the turn that starts it."""
+    context: Context = copy_context()
+    context.run(deadline.set, None)
+    return context
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the turn has no time left for a request or a retry."""
+
+
+def set_turn_deadline(seconds: float | None) -> None:
+    """Give the scheduled requests of the current turn, and of the tasks it starts from now on, a shared time budget.
+
+    Args:
+        seconds (float | None): Budget, None for no deadline.
+    """
+    deadline.set(None if seconds is None else monotonic() + seconds)
+
+
+def remaining() -> float | None:
+    """Seconds left before the turn deadline, None without one."""
+    current: float | None = deadline.get()
+    return None if current is None else current - monotonic()
+
+
+class ProviderPolicy(BaseModel):
+    """Limits and retry behaviour of one provider."""
+
+    rate: float = 5.0
+    burst: int = 5
+    timeout: float = 30.0
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_samples: int = 20
+
+
+class TokenBucket:
+    """Client side rate limit: `rate` requests per second with bursts of up to `capacity`.
+
+    Shared by the event loop and the worker threads that make blocking requests.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens: float = capacity
+        self.updated: float = monotonic()
+        self.paused_until: float = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now: float = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available right now."""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1 and monotonic() >= self.paused_until:
+                self.tokens -= 1
+                return True
+            return False
+
+    def _wait(self) -> float:
+        wait: float = max(self.paused_until - monotonic(), (1 - self.tokens) / self.rate, 0.0)
+        if (left := remaining()) is not None and wait > left:
+            raise DeadlineExceeded("Rate limited past the turn deadline")
+        return wait
+
+    async def acquire(self) -> None:
+        """Wait for a token, without waiting past the turn deadline."""
+        while not self.try_acquire():
+            await asyncio.sleep(self._wait())
+
+    def acquire_blocking(self) -> None:
+        """`acquire` for worker threads."""
+        while not self.try_acquire():
+            sleep(self._wait())
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for a while, after the provider said it is overloaded."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class LatencyTracker:
+    """Recent latencies of a provider."""
+
+    def __init__(self, size: int = 100):
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        if not self.samples:
+            return None
+        ordered: list[float] = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def status_code(e: Exception) -> int | None:
+    """HTTP status of a failed request of any of the clients in use."""
+    if isinstance(e, (httpx.HTTPStatusError, openai.APIStatusError)):
+        return e.response.status_code
+    if (resp := getattr(e, "resp", None)) is not None and hasattr(resp, "status"):
+        # googleapiclient.errors.HttpError
+        return int(resp.status)
+    return None
+
+
+def retry_after(e: Exception) -> float | None:
+    """Seconds the provider asked to wait, from the Retry-After header."""
+    headers: Any = None
+    if isinstance(e, (httpx.HTTPStatusError, openai.APIStatusError)):
+        headers = e.response.headers
+    elif (resp := getattr(e, "resp", None)) is not None:
+        headers = resp
+    value: str | None = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_transient(e: Exception) -> bool:
+    """Whether a request may succeed if sent again."""
+    if isinstance(e, (TimeoutError, httpx.TransportError, openai.APIConnectionError)):
+        return True
+    code: int | None = status_code(e=e)
+    return code is not None and (code in (408, 429) or code >= 500)
+
+
+class Provider:
+    def __init__(self, name: str, policy: ProviderPolicy):
+        self.name = name
+        self.policy = policy
+        self.bucket = TokenBucket(rate=policy.rate, capacity=policy.burst)
+        self.latency = LatencyTracker()
+
+
+class Scheduler:
+    """Single path for outbound requests: per-provider rate limits, timeouts, retries and hedging.
+
+    Every request waits for a token of its provider's bucket and runs with the provider timeout, capped by the turn
+    deadline. Transient failures are retried with full jitter exponential backoff; a 429 also pauses the bucket for
+    the Retry-After the provider sent. With hedging on, a second request (a duplicate or an alternate) is sent when the
+    first is slower than the provider's recent p95 latency, and the first response wins.
+    """
+
+    def __init__(self, policies: dict[str, ProviderPolicy]):
+        self.providers: dict[str, Provider] = {name: Provider(name=name, policy=policy) for name, policy in policies.items()}
+
+    async def call(
+        self,
+        provider: str,
+        request: Callable[[], Awaitable[T]],
+        retries: bool = True,
+        hedge: Callable[[], Awaitable[T]] | None = None,
+        discard: Callable[[T], Awaitable[Any]] | None = None,
+        idempotent: bool = True,
+    ) -> T:
+        """Send a request.
+
+        Args:
+            provider (str): Provider name.
+            request (Callable[[], Awaitable[T]]): Makes the request, called again on every attempt.
+            retries (bool): Whether the request is safe to send again.
+            hedge (Callable[[], Awaitable[T]] | None): Request to send when the first one is slow, the same request or an
+                alternate (endpoint, model). No hedging without it.
+            discard (Callable[[T], Awaitable[Any]] | None): Releases the response of a request that lost the hedge.
+            idempotent (bool): Whether a request that timed out may be sent again. A timeout abandons the request without
+                stopping it (a worker thread runs to the end), so a request with side effects could be performed twice.
+
+        Returns:
+            T: The response.
+        """
+        p: Provider = self.providers[provider]
+        max_attempts: int = p.policy.max_attempts if retries else 1
+        for attempt in range(1, max_attempts + 1):
+            await p.bucket.acquire()
+            try:
+                return await self._attempt(p=p, request=request, hedge=hedge, discard=discard)
+            except Exception as e:
+                if attempt == max_attempts or (isinstance(e, TimeoutError) and not idempotent):
+                    raise
+                await asyncio.sleep(self._backoff(p=p, e=e, attempt=attempt))
+
+    def call_blocking(self, provider: str, request: Callable[[], T], retries: bool = True) -> T:
+        """Send a blocking request from a worker thread, like the ones of a long sync.
+
+        Each request of the sync waits for its own token and is retried on its own, instead of the whole sync counting as
+        one request. There is no timeout on top of the client's own: a thread cannot be stopped, only abandoned.
+
+        Args:
+            provider (str): Provider name.
+            request (Callable[[], T]): Makes the request, called again on every attempt.
+            retries (bool): Whether the request is safe to send again.
+
+        Returns:
+            T: The response.
+        """
+        p: Provider = self.providers[provider]
+        max_attempts: int = p.policy.max_attempts if retries else 1
+        for attempt in range(1, max_attempts + 1):
+            p.bucket.acquire_blocking()
+            try:
+                return request()
+            except Exception as e:
+                if attempt == max_attempts:
+                    raise
+                sleep(self._backoff(p=p, e=e, attempt=attempt))
+
+    @staticmethod
+    def _backoff(p: Provider, e: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying a failed request, re-raising the error if it is not worth a retry."""
+        if not is_transient(e=e):
+            raise e
+        delay: float = random.uniform(0, min(p.policy.max_delay, p.policy.base_delay * 2**attempt))
+        if status_code(e=e) == 429:
+            wait: float = retry_after(e=e) or delay
+            p.bucket.pause(seconds=wait)
+            delay = max(delay, wait)
+        if (left := remaining()) is not None and delay >= left:
+            raise DeadlineExceeded(f"No time left to retry {p.name}") from e
+        logger.warning("{p} request failed ({e}), retry {n} in {d:.2f} seconds", p=p.name, e=e, n=attempt, d=delay)
+        return delay
+
+    def _timeout(self, p: Provider) -> float:
+        left: float | None = remaining()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded(f"Turn deadline passed before the {p.name} request")
+        return p.policy.timeout if left is None else min(p.policy.timeout, left)
+
+    async def _timed(self, p: Provider, request: Callable[[], Awaitable[T]]) -> T:
+        _now: float = monotonic()
+        async with asyncio.timeout(self._timeout(p=p)):
+            result: T = await request()
+        p.latency.record(monotonic() - _now)
+        return result
+
+    async def _attempt(
+        self,
+        p: Provider,
+        request: Callable[[], Awaitable[T]],
+        hedge: Callable[[], Awaitable[T]] | None,
+        discard: Callable[[T], Awaitable[Any]] | None,
+    ) -> T:
+        delay: float | None = p.latency.quantile(q=p.policy.hedge_quantile)
+        if hedge is None or not p.policy.hedge or delay is None or len(p.latency.samples) < p.policy.hedge_min_samples:
+            return await self._timed(p=p, request=request)
+
+        first: asyncio.Task = asyncio.create_task(self._timed(p=p, request=request))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        # Only hedge if the bucket has room for it, hedges must not cause rate limiting
+        if done or not p.bucket.try_acquire():
+            return await first
+
+        logger.info(
+            "{p} request slower than p{q:.0f} ({d:.3f} seconds), hedging", p=p.name, q=p.policy.hedge_quantile * 100, d=delay
+        )
+        second: asyncio.Task = asyncio.create_task(self._timed(p=p, request=hedge))
+        pending: set[asyncio.Task] = {first, second}
+        error: Exception | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                        if discard is not None:
+                            loser.add_done_callback(lambda t: self._discard(task=t, discard=discard))
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    @staticmethod
+    def _discard(task: asyncio.Task, discard: Callable[[Any], Awaitable[Any]]) -> None:
+        # The loser may have completed before it could be cancelled
+        if not task.cancelled() and task.exception() is None:
+            asyncio.create_task(discard(task.result()))
+
+
+scheduler = Scheduler(
+    policies={
+        "samba": ProviderPolicy(rate=1.0, burst=4, timeout=30.0, hedge=settings.hedge_requests),
+        "openai": ProviderPolicy(rate=5.0, burst=10, timeout=30.0, hedge=settings.hedge_requests),
+        "weatherstack": ProviderPolicy(rate=1.0, burst=2, timeout=10.0),
+        "worldnewsapi": ProviderPolicy(rate=1.0, burst=2, timeout=20.0),
+        "google": ProviderPolicy(rate=10.0, burst=20, timeout=30.0),
+    }
+)
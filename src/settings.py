@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Literal
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -12,5 +13,40 @@ class Settings(BaseSettings):
     timezone: str = "Europe/London"
     weatherstack_api_key: str
     worlds_news_api_key: str
+    intent_fast_path: bool = True
+    intent_threshold: float = 0.75
+    native_tool_calling: bool = False
+    cache_dir: Path = Path(".cache")
+    calendar_sync_interval: int = 300
+    gmail_sync_interval: int = 120
+    gmail_mirror_size: int = 2000
+    write_behind: bool = True
+    outbox_max_attempts: int = 5
+    headless: bool = False
+    render_hz: float = 30.0
+    tts_format: Literal["pcm", "mp3", "flac"] = "pcm"
+    speculative_start: bool = False
+    partial_interval: float = 1.0
+    endpoint_silence: float = 0.8
+    completion_cache: bool = False
+    completion_cache_ttl: int = 86400
+    completion_cache_size: int = 1000
+    memory: bool = False
+    memory_top_k: int = 3
+    memory_min_score: float = 0.35
+    loop_lag_threshold: float = 0.1
+    profile: bool = False
+    profile_dir: Path = Path("profiles")
+    profile_interval: float = 0.005
+    turn_timeout: float = 60.0
+    hedge_requests: bool = False
+    samba_fallback_model: str | None = None
+    hands_free: bool = False
+    wake_word: str = "hey_jarvis"
+    wake_word_threshold: float = 0.5
+    tool_plugins: dict[str, str] = {}
+    offload_processes: int = 2
+    offload_threads: int = 4
+    offload_timeout: float = 30.0
 
     model_config = SettingsConfigDict(env_file=".env")
@@ -0,0 +1,91 @@
+import asyncio
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from loguru import logger
+from openai import AsyncStream
+from pydantic import BaseModel
+
+from src.intent import normalize_utterance
+
+# Marks the end of the prefetched chunks.
+_END: object = object()
+
+
+class SpeculationStats(BaseModel):
+    """Outcome of the speculative completions and the latency they hid."""
+
+    launched: int = 0
+    committed: int = 0
+    saved_seconds: float = 0.0
+
+    @property
+    def commit_rate(self) -> float:
+        return self.committed / self.launched if self.launched else 0.0
+
+
+class SpeculativeTurn:
+    """Completion started on a stable partial transcript, before the final transcript is known.
+
+    The stream is consumed in the background into a queue so the request, the prefill and the first tokens overlap the
+    end of the recording and the final transcription. Nothing is shown, spoken or executed until the turn is committed;
+    a turn that is not committed is cancelled.
+    """
+
+    def __init__(
+        self,
+        transcript: str,
+        messages: list[dict[str, Any]],
+        start: Callable[[list[dict[str, Any]]], Awaitable[tuple[AsyncStream, bool]]],
+    ):
+        self.transcript = transcript
+        self.messages = [*messages, {"role": "user", "content": transcript}]
+        self.native: bool | None = None
+        self.started_at: float = perf_counter()
+        self._chunks: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task = asyncio.create_task(self._prefetch(start=start))
+
+    def matches(self, transcript: str) -> bool:
+        """Whether a transcript is the one the completion was started on, after normalization."""
+        return normalize_utterance(s=transcript) == normalize_utterance(s=self.transcript)
+
+    async def _prefetch(self, start: Callable[[list[dict[str, Any]]], Awaitable[tuple[AsyncStream, bool]]]) -> None:
+        stream: AsyncStream | None = None
+        try:
+            # The messages may be rewritten in place if the endpoint falls back to the text protocol
+            stream, self.native = await start(self.messages)
+            async for chunk in stream:
+                self._chunks.put_nowait(chunk)
+        except Exception as e:
+            self._chunks.put_nowait(e)
+        finally:
+            self._chunks.put_nowait(_END)
+            if stream is not None:
+                await stream.close()
+
+    async def commit(self) -> tuple[AsyncIterator, bool]:
+        """Take over the speculative completion.
+
+        Returns:
+            tuple[AsyncIterator, bool]: The stream, replaying what was prefetched first, and whether native function
+                calling is in use.
+        """
+        # Wait for the request to be accepted, the first chunk tells it was
+        first: Any = await self._chunks.get()
+        if isinstance(first, Exception):
+            raise first
+
+        async def replay() -> AsyncIterator:
+            chunk: Any = first
+            while chunk is not _END:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+                chunk = await self._chunks.get()
+
+        return replay(), self.native
+
+    def cancel(self) -> None:
+        """Discard the speculative completion."""
+        self._task.cancel()
+        logger.info("Speculative completion discarded: {t}", t=self.transcript)
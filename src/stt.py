@@ -1,3 +1,5 @@
+import asyncio
+import io
 import os
 import select
 import sys
@@ -5,12 +7,15 @@ import tempfile
 import termios
 import tty
 import wave
-from typing import List, Optional
+from typing import Awaitable, Callable, List, Optional
 
+import numpy as np
 import pyaudio
 from loguru import logger
 from openai import AsyncOpenAI
 
+from src.scheduler import scheduler
+
 
 async def capture_voice_input(
     client: AsyncOpenAI,
@@ -83,10 +88,15 @@ async def capture_voice_input(
 
         # Transcribe
         with open(temp_filename, "rb") as audio_file:
-            transcription: str = await client.audio.transcriptions.create(
-                model="whisper-1", file=audio_file, response_format="text", temperature=0.0
+            audio: bytes = audio_file.read()
+
+        def transcribe() -> Awaitable[str]:
+            return client.audio.transcriptions.create(
+                model="whisper-1", file=("speech.wav", audio), response_format="text", temperature=0.0
             )
 
+        transcription: str = await scheduler.call("openai", transcribe, hedge=transcribe)
+
         return transcription
 
     except Exception as e:
@@ -97,3 +107,168 @@ async def capture_voice_input(
         # Restore the terminal settings
         termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
         os.unlink(temp_filename)
+
+
+def to_wav(frames: List[bytes], rate: int, sample_width: int = 2) -> bytes:
+    """Wrap mono PCM frames in an in-memory WAV file.
+
+    Args:
+        frames (List[bytes]): Recorded PCM chunks.
+        rate (int): Sample rate of the recording.
+        sample_width (int): Bytes per sample.
+
+    Returns:
+        bytes: WAV file content.
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(sample_width)
+        wf.setframerate(rate)
+        wf.writeframes(b"".join(frames))
+    return buffer.getvalue()
+
+
+def rms(data: bytes) -> float:
+    """Root mean square energy of 16-bit PCM audio."""
+    samples: np.ndarray = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+    return float(np.sqrt(np.mean(samples**2))) if len(samples) else 0.0
+
+
+async def capture_streaming_voice_input(
+    client: AsyncOpenAI,
+    p: pyaudio.PyAudio,
+    on_stable: Optional[Callable[[str], None]] = None,
+    timeout: int = 20,
+    partial_interval: float = 1.0,
+    endpoint_silence: float = 0.8,
+    energy_threshold: float = 500.0,
+    stream: Optional[pyaudio.Stream] = None,
+    pre_roll: bytes = b"",
+) -> Optional[str]:
+    """
+    Capture voice input until the user stops speaking, transcribing partial audio while recording.
+
+    Partial transcripts are requested every `partial_interval` seconds of speech and as soon as the user pauses. A pause
+    partial that is still current when it comes back (the user stayed silent) is stable and handed to `on_stable`, so
+    work can start on it while the recording waits for the endpoint and the final transcription. When no speech followed
+    the pause, that partial is the final transcript, awaited if still in flight, instead of a second round trip.
+
+    Args:
+        client (AsyncOpenAI): OpenAI client instance for transcription
+        p (pyaudio.PyAudio): PyAudio instance for audio recording
+        on_stable (Optional[Callable[[str], None]]): Called with every stable partial transcript.
+        timeout (int, optional): Maximum recording duration in seconds. Defaults to 20.
+        partial_interval (float): Seconds of speech between partial transcriptions.
+        endpoint_silence (float): Seconds of trailing silence that end the recording.
+        energy_threshold (float): RMS energy above which a chunk counts as speech.
+        stream (Optional[pyaudio.Stream]): Open 16 kHz input stream to record from, like the wake word listener's. It is
+            left open. A new one is opened by default.
+        pre_roll (bytes): Audio recorded before the capture started, the start of the utterance.
+
+    Returns:
+        Optional[str]: Final transcribed text if successful, None if nothing was said or an error occurs
+    """
+    # Audio recording parameters, 16 kHz keeps the repeated partial uploads small
+    CHUNK: int = 512
+    RATE: int = 16000
+    chunk_seconds: float = CHUNK / RATE
+
+    async def transcribe(frames: List[bytes], hedged: bool = False) -> str:
+        audio: bytes = to_wav(frames=frames, rate=RATE)
+
+        def request() -> Awaitable[str]:
+            return client.audio.transcriptions.create(
+                model="whisper-1", file=("speech.wav", audio), response_format="text", temperature=0.0
+            )
+
+        # Only the final transcription is worth a hedge
+        return await scheduler.call("openai", request, hedge=request if hedged else None)
+
+    # Save the terminal settings
+    old_settings = termios.tcgetattr(sys.stdin)
+    own_stream: bool = stream is None
+    partial: Optional[asyncio.Task] = None
+    try:
+        # Set terminal to cbreak mode
+        tty.setcbreak(sys.stdin.fileno())
+
+        if own_stream:
+            stream = p.open(format=pyaudio.paInt16, channels=1, rate=RATE, input=True, frames_per_buffer=CHUNK)
+        logger.info("Listening... (Press Enter to stop)")
+
+        frames: List[bytes] = []
+        speech_frames: int = 0  # Number of chunks recorded up to the last speech chunk
+        silence: float = 0.0
+        partial_frames: int = 0  # Number of chunks covered by the running or last partial
+        partial_is_pause: bool = False
+        covered: Optional[str] = None  # Result of the last pause partial, while no speech followed it
+        pending: List[bytes] = [pre_roll[i : i + CHUNK * 2] for i in range(0, len(pre_roll), CHUNK * 2)]
+        for _ in range(0, len(pending) + int(timeout / chunk_seconds)):
+            data: bytes = pending.pop(0) if pending else await asyncio.to_thread(stream.read, CHUNK, False)
+            frames.append(data)
+
+            if rms(data=data) > energy_threshold:
+                speech_frames, silence = len(frames), 0.0
+            elif speech_frames:
+                silence += chunk_seconds
+
+            # Check if Enter key is pressed
+            if select.select([sys.stdin], [], [], 0)[0]:
+                c = sys.stdin.read(1)
+                if c == "\n":
+                    break  # Exit the loop if Enter is pressed
+
+            # Endpoint
+            if speech_frames and silence >= endpoint_silence:
+                break
+
+            # A partial that comes back while the user is still silent is stable
+            if partial is not None and partial.done():
+                result: Optional[str] = None if partial.cancelled() or partial.exception() else partial.result()
+                text: Optional[str] = result.strip() if result else None
+                logger.debug("Partial transcript: {t}", t=text)
+                if text and partial_is_pause and speech_frames <= partial_frames:
+                    covered = result
+                    if on_stable is not None:
+                        on_stable(text)
+                partial = None
+
+            # Transcribe what was said so far, periodically while speaking and once on every pause
+            if partial is None and speech_frames > partial_frames:
+                pausing: bool = silence >= endpoint_silence / 2
+                if pausing or (len(frames) - partial_frames) * chunk_seconds >= partial_interval:
+                    partial_frames, partial_is_pause, covered = len(frames), pausing, None
+                    partial = asyncio.create_task(transcribe(frames=list(frames)))
+
+        if not speech_frames:
+            return None
+
+        # A pause partial started after the last speech already transcribes all of it: use it rather than sending the
+        # audio again, waiting for it if it is still in flight
+        if speech_frames <= partial_frames and partial_is_pause:
+            if covered is not None:
+                return covered
+            if partial is not None:
+                reused, partial = partial, None
+                try:
+                    if (result := await reused) and result.strip():
+                        return result
+                except Exception as e:
+                    logger.warning("Pause partial failed, transcribing again: {e}", e=e)
+
+        # Transcribe
+        return await transcribe(frames=frames, hedged=True)
+
+    except Exception as e:
+        logger.error("Error capturing voice: {e}", e=e)
+        return None
+
+    finally:
+        if partial is not None:
+            partial.cancel()
+        if own_stream and stream is not None:
+            stream.stop_stream()
+            stream.close()
+        # Restore the terminal settings
+        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
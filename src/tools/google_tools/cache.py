@@ -0,0 +1,248 @@
+import asyncio
+import json
+import threading
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import monotonic
+from typing import Any
+
+import pytz
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from loguru import logger
+
+from src.scheduler import remaining, scheduler, without_deadline
+from src.settings import Settings
+from src.tools.google_tools.credentials import GoogleCredsManager
+from src.tools.google_tools.services import GoogleServices
+
+settings = Settings()
+
+
+def event_bounds(event: dict[str, Any]) -> tuple[datetime, datetime]:
+    """Get the start and end of a calendar event as aware datetimes.
+
+    Args:
+        event (dict[str, Any]): Calendar API event resource.
+
+    Returns:
+        tuple[datetime, datetime]: Start and end of the event. All-day events are placed in the configured timezone.
+    """
+    bounds: list[datetime] = []
+    for key in ("start", "end"):
+        value: str = event[key].get("dateTime", event[key].get("date"))
+        moment: datetime = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if moment.tzinfo is None:
+            moment = pytz.timezone(settings.timezone).localize(moment)
+        bounds.append(moment)
+    return bounds[0], bounds[1]
+
+
+class CalendarEventCache:
+    """Local copy of the primary calendar, kept current through Calendar API incremental sync.
+
+    Events are indexed by start time so upcoming, range and free/busy queries never leave the process.
+    """
+
+    def __init__(self, path: Path | None = None, max_age: float = 300.0, lookbehind: timedelta = timedelta(days=1)):
+        self.path = path
+        self.max_age = max_age
+        self.lookbehind = lookbehind
+        self.sync_token: str | None = None
+        self.synced_at: float | None = None
+        self._events: dict[str, dict[str, Any]] = {}
+        self._index: list[tuple[float, str]] = []
+        self._max_duration: float = 0.0
+        self._lock = threading.RLock()
+        # The running sync, shared by the background loop and the reads that find the cache stale
+        self._syncing: asyncio.Task | None = None
+        if path is not None and path.exists():
+            self._load()
+
+    @property
+    def is_stale(self) -> bool:
+        return self.synced_at is None or monotonic() - self.synced_at > self.max_age
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def upsert(self, event: dict[str, Any]) -> None:
+        """Insert, update or remove (if cancelled) an event.
+
+        Args:
+            event (dict[str, Any]): Calendar API event resource.
+        """
+        with self._lock:
+            if (previous := self._events.pop(event["id"], None)) is not None:
+                key: tuple[float, str] = (event_bounds(previous)[0].timestamp(), event["id"])
+                del self._index[bisect_left(self._index, key)]
+            if event.get("status") == "cancelled":
+                return
+            start, end = event_bounds(event)
+            self._events[event["id"]] = event
+            insort(self._index, (start.timestamp(), event["id"]))
+            self._max_duration = max(self._max_duration, (end - start).total_seconds())
+
+    def upcoming(self, n: int, after: datetime) -> list[dict[str, Any]]:
+        """Get the next n events starting at or after a moment.
+
+        Args:
+            n (int): Number of events.
+            after (datetime): Aware datetime.
+
+        Returns:
+            list[dict[str, Any]]: Events ordered by start time.
+        """
+        with self._lock:
+            i: int = bisect_left(self._index, (after.timestamp(), ""))
+            return [self._events[event_id] for _, event_id in self._index[i : i + n]]
+
+    def between(self, start: datetime, end: datetime) -> list[dict[str, Any]]:
+        """Get the events that start within a range.
+
+        Args:
+            start (datetime): Aware datetime, inclusive.
+            end (datetime): Aware datetime, exclusive.
+
+        Returns:
+            list[dict[str, Any]]: Events ordered by start time.
+        """
+        with self._lock:
+            i: int = bisect_left(self._index, (start.timestamp(), ""))
+            j: int = bisect_left(self._index, (end.timestamp(), ""))
+            return [self._events[event_id] for _, event_id in self._index[i:j]]
+
+    def busy(self, start: datetime, end: datetime) -> list[tuple[datetime, datetime]]:
+        """Get the merged busy intervals within a range.
+
+        Args:
+            start (datetime): Aware datetime.
+            end (datetime): Aware datetime.
+
+        Returns:
+            list[tuple[datetime, datetime]]: Non overlapping busy intervals clipped to the range.
+        """
+        with self._lock:
+            # Events that started before the range may still overlap it
+            i: int = bisect_left(self._index, (start.timestamp() - self._max_duration, ""))
+            j: int = bisect_right(self._index, (end.timestamp(), "\uffff"))
+            candidates: list[dict[str, Any]] = [self._events[event_id] for _, event_id in self._index[i:j]]
+
+        intervals: list[tuple[datetime, datetime]] = []
+        for event in candidates:
+            if event.get("transparency") == "transparent":
+                continue
+            event_start, event_end = event_bounds(event)
+            if event_end <= start or event_start >= end:
+                continue
+            event_start, event_end = max(event_start, start), min(event_end, end)
+            if intervals and event_start <= intervals[-1][1]:
+                intervals[-1] = (intervals[-1][0], max(intervals[-1][1], event_end))
+            else:
+                intervals.append((event_start, event_end))
+        return intervals
+
+    def sync(self, creds: Credentials) -> int:
+        """Bring the cache up to date. Blocking, meant to run in a worker thread.
+
+        Uses the stored sync token for an incremental sync and falls back to a full sync when there is none or Google
+        invalidated it.
+
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
+
+        Returns:
+            int: Number of events that changed.
+        """
+        service = build(serviceName="calendar", version="v3", credentials=creds)
+        sync_token: str | None = self.sync_token
+        try:
+            events, next_sync_token = self._fetch(service=service, sync_token=sync_token)
+        except HttpError as e:
+            if sync_token is None or e.resp.status != 410:
+                raise
+            logger.info("Calendar sync token expired, running a full sync")
+            sync_token = None
+            events, next_sync_token = self._fetch(service=service, sync_token=sync_token)
+
+        # Network calls are done, only now block the readers
+        with self._lock:
+            if sync_token is None:
+                self._events.clear()
+                self._index.clear()
+                self._max_duration = 0.0
+            for event in events:
+                self.upsert(event=event)
+            self.sync_token = next_sync_token
+            self.synced_at = monotonic()
+            if (events or sync_token is None) and self.path is not None:
+                self._save()
+        return len(events)
+
+    def _fetch(self, service: Any, sync_token: str | None) -> tuple[list[dict[str, Any]], str | None]:
+        if sync_token is None:
+            params: dict[str, Any] = {"timeMin": (datetime.now(pytz.utc) - self.lookbehind).isoformat()}
+        else:
+            params: dict[str, Any] = {"syncToken": sync_token, "showDeleted": True}
+
+        events: list[dict[str, Any]] = []
+        page_token: str | None = None
+        while True:
+            page: dict[str, Any] = scheduler.call_blocking(
+                "google", service.events().list(calendarId="primary", singleEvents=True, pageToken=page_token, **params).execute
+            )
+            events.extend(page.get("items", []))
+            if not (page_token := page.get("nextPageToken")):
+                break
+
+        # Without a sync token the next call is a full sync again
+        return events, page.get("nextSyncToken")
+
+    async def refresh(self, creds: Credentials) -> int:
+        """Sync in a worker thread, or wait for the sync that is already running instead of starting another.
+
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
+
+        Returns:
+            int: Number of events that changed.
+        """
+        if self._syncing is None or self._syncing.done():
+            # No timeout or retries around the whole sync: an abandoned thread would run on next to the retry. Every
+            # request of the sync goes through the scheduler on its own
+            self._syncing = asyncio.create_task(asyncio.to_thread(self.sync, creds), context=without_deadline())
+        # A caller out of time (turn deadline) leaves the sync running for the others
+        return await asyncio.wait_for(asyncio.shield(self._syncing), timeout=remaining())
+
+    async def run_periodic_sync(self, creds_manager: GoogleCredsManager, interval: float) -> None:
+        """Keep the cache current in the background.
+
+        Args:
+            creds_manager (GoogleCredsManager): Provider of Google credentials.
+            interval (float): Seconds between syncs.
+        """
+        while True:
+            try:
+                creds = await asyncio.to_thread(creds_manager.get_credentials, scopes=GoogleServices.get_all_scopes())
+                if changed := await self.refresh(creds=creds):
+                    logger.info("Calendar cache synced, {n} events changed", n=changed)
+            except Exception as e:
+                logger.error("Error syncing calendar cache: {e}", e=e)
+            await asyncio.sleep(interval)
+
+    def _load(self) -> None:
+        with open(self.path) as fp:
+            data: dict[str, Any] = json.load(fp)
+        for event in data.get("events", []):
+            self.upsert(event=event)
+        self.sync_token = data.get("sync_token")
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, mode="w") as fp:
+            json.dump({"sync_token": self.sync_token, "events": list(self._events.values())}, fp)
+
+
+calendar_cache = CalendarEventCache(path=settings.cache_dir / "calendar.json", max_age=settings.calendar_sync_interval)
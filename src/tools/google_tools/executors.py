@@ -1,19 +1,46 @@
+import asyncio
 import base64
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 from email.message import EmailMessage
+from time import time
 from typing import Any
+from uuid import uuid4
 
 import pytz
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from pydantic import BaseModel, ConfigDict, Field
 
+from src.scheduler import scheduler
 from src.settings import Settings
+from src.tools.google_tools.cache import calendar_cache, event_bounds
+from src.tools.google_tools.mirror import gmail_mirror
+from src.tools.google_tools.outbox import outbox
 
 settings = Settings()
 
 
+def format_emails(emails: list[dict[str, Any]]) -> str:
+    """Format mirrored emails for the model.
+
+    Args:
+        emails (list[dict[str, Any]]): Rows of the Gmail mirror.
+
+    Returns:
+        str: A formatted string containing email information.
+    """
+    formatted_emails: list[str] = []
+    for i, email in enumerate(emails):
+        labels: list[str] = email["labels"].split()
+        formatted_emails.append(
+            f"[{i+1}] Subject: {email['subject']}\n(From: {email['sender']} at {email['date']})\nSnippet: {email['snippet']}\nLabels: {labels}"
+        )
+
+    return "\n ---- \n".join(formatted_emails)
+
+
 class GoogleServiceExecutor(BaseModel, ABC):
     """Base class for Google service executors."""
 
@@ -22,6 +49,58 @@ class GoogleServiceExecutor(BaseModel, ABC):
         pass
 
 
+class GoogleWriteExecutor(GoogleServiceExecutor):
+    """Base class for Google service executors with side effects.
+
+    With write-behind enabled the operation goes through the outbox and the model gets a provisional result right away.
+    """
+
+    @abstractmethod
+    def perform(self, creds: Credentials, idempotency_key: str, retry: bool = False) -> str:
+        """Perform the side effect. Blocking, runs in a worker thread.
+
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
+            idempotency_key (str): Stable key of the operation, the same on every attempt.
+            retry (bool): Whether a previous attempt may have reached Google.
+
+        Returns:
+            str: Outcome of the operation.
+        """
+        pass
+
+    @abstractmethod
+    def provisional_result(self) -> str:
+        """Result handed to the model while the operation waits in the outbox."""
+        pass
+
+    async def execute(self, creds: Credentials) -> str:
+        if not settings.write_behind:
+            # The idempotency key makes retrying failed requests safe, but a timed out one may still be running
+            idempotency_key: str = uuid4().hex
+            attempts: int = 0
+
+            def perform() -> Any:
+                nonlocal attempts
+                attempts += 1
+                return asyncio.to_thread(self.perform, creds=creds, idempotency_key=idempotency_key, retry=attempts > 1)
+
+            return await scheduler.call("google", perform, idempotent=False)
+
+        operation = outbox.enqueue(name=self.model_config["json_schema_extra"]["name"], payload=self.model_dump())
+        if operation.duplicate:
+            minutes: int = max(1, round((time() - operation.created_at) / 60))
+            outcome: str = {
+                "done": f"it went through ({operation.result})",
+                "failed": f"it failed ({operation.error})",
+            }.get(operation.status, "it is still queued")
+            return (
+                f"The exact same request was made {minutes} minutes ago and {outcome}, so it was not repeated. Tell the user; "
+                "to do it again on purpose the request has to differ, e.g. in its wording."
+            )
+        return self.provisional_result()
+
+
 class GmailReadExecutor(GoogleServiceExecutor):
     """Get the n most recent emails from Gmail"""
 
@@ -38,31 +117,37 @@ class GmailReadExecutor(GoogleServiceExecutor):
         Returns:
             str: A formatted string containing email information.
         """
-        service = build(serviceName="gmail", version="v1", credentials=creds)
-        # Obtain ids of the n most recent emails in the inbox
-        messages: dict[str, Any] = (
-            service.users().messages().list(userId="me", labelIds=["INBOX"], q="category:primary", maxResults=self.n).execute()
-        )
+        # Answer from the local mirror, syncing first only if the background sync fell behind
+        if gmail_mirror.is_stale:
+            await gmail_mirror.refresh(creds=creds)
 
-        # Extract email information from the messages
-        formatted_emails: list[str] | None = []
-
-        for i, message in enumerate(messages.get("messages")):
-            msg: dict[str, Any] = service.users().messages().get(userId="me", id=message.get("id")).execute()
-            snippet: str = msg.get("snippet", "No snippet")
-            labels: list[str] = msg.get("labelIds", [])
-            headers: list[dict[str, Any]] = msg.get("payload", {}).get("headers")
-            date: str = next((header.get("value") for header in headers if header.get("name") == "Date"), "Unknown Date")
-            subject: str = next((header.get("value") for header in headers if header.get("name") == "Subject"), "No Subject")
-            sender: str = next((header.get("value") for header in headers if header.get("name") == "From"), "Unknown Sender")
-            formatted_emails.append(
-                f"[{i+1}] Subject: {subject}\n(From: {sender} at {date})\nSnippet: {snippet}\nLabels: {labels}"
-            )
+        return format_emails(emails=gmail_mirror.recent(n=self.n))
+
+
+class GmailSearchExecutor(GoogleServiceExecutor):
+    """Search emails in Gmail by sender, subject or content"""
+
+    model_config = ConfigDict(json_schema_extra={"name": "search_gmail_emails"})
+    query: str = Field(description="Words to search for in the sender, subject or content of the emails")
+    n: int = Field(default=5, description="Maximum number of emails to return")
 
-        return "\n ---- \n".join(formatted_emails)
+    async def execute(self, creds: Credentials) -> str:
+        """
+        Search the local Gmail mirror.
 
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
 
-class GmailWriteExecutor(GoogleServiceExecutor):
+        Returns:
+            str: A formatted string containing email information.
+        """
+        if gmail_mirror.is_stale:
+            await gmail_mirror.refresh(creds=creds)
+
+        return format_emails(emails=gmail_mirror.search(query=self.query, n=self.n)) or f"No emails found for '{self.query}'"
+
+
+class GmailWriteExecutor(GoogleWriteExecutor):
     """Send an email from Gmail"""
 
     model_config = ConfigDict(json_schema_extra={"name": "send_gmail_email"})
@@ -70,22 +155,31 @@ class GmailWriteExecutor(GoogleServiceExecutor):
     subject: str = Field(description="Email subject")
     body: str = Field(description="Complete content of the email. Expected to be long text.")
 
-    async def execute(self, creds) -> str:
+    def perform(self, creds: Credentials, idempotency_key: str, retry: bool = False) -> str:
         """Send an email using the Gmail API.
 
         Args:
             creds (Credentials): Google OAuth2 credentials.
+            idempotency_key (str): Used as the Message-ID, so a retry can tell whether the email already left.
+            retry (bool): Whether a previous attempt may have sent the email.
 
         Returns:
             str: A message indicating if the email was sent successfully.
         """
         service = build(serviceName="gmail", version="v1", credentials=creds)
+        message_id: str = f"<{idempotency_key}@{settings.gmail_host_user.partition('@')[2] or 'localhost'}>"
+
+        if retry:
+            sent: dict[str, Any] = service.users().messages().list(userId="me", q=f"in:sent rfc822msgid:{message_id}").execute()
+            if sent.get("messages"):
+                return f"Message with id {sent['messages'][0].get('id')} was sent successfully. Don't share id."
 
         message = EmailMessage()
         message.set_content(self.body)
         message["To"] = self.to
         message["From"] = settings.gmail_host_user
         message["Subject"] = self.subject
+        message["Message-ID"] = message_id
 
         # Encoded message
         encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
@@ -98,6 +192,9 @@ class GmailWriteExecutor(GoogleServiceExecutor):
         if "SENT" in label:
             return f"Message with id {sent_message.get('id')} was sent successfully. Don't share id."
 
+    def provisional_result(self) -> str:
+        return f"The email to {self.to} is queued and will be sent in the background."
+
 
 class CalendarReadExecutor(GoogleServiceExecutor):
     """Retrieve the next n calendar appointments"""
@@ -114,35 +211,64 @@ class CalendarReadExecutor(GoogleServiceExecutor):
         Returns:
             str: A formatted string containing appointment information.
         """
-        service = build(serviceName="calendar", version="v3", credentials=creds)
+        # Answer from the local cache, syncing first only if the background sync fell behind
+        if calendar_cache.is_stale:
+            await calendar_cache.refresh(creds=creds)
 
         utc_now = datetime.now(pytz.utc)
-        time_min = (utc_now - timedelta(days=1)).isoformat()
-        time_max = (utc_now + timedelta(days=365)).isoformat()
-
-        events = (
-            service.events()
-            .list(
-                calendarId="primary",
-                timeMin=time_min,
-                timeMax=time_max,
-                maxResults=self.n,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
-        )
+        events: list[dict[str, Any]] = calendar_cache.upcoming(n=self.n, after=utc_now - timedelta(days=1))
 
         formatted_appointments: list[str] | None = []
-        for i, event in enumerate(events.get("items", [])):
-            start: str = event["start"].get("dateTime", event["start"].get("date"))
-            start_time: datetime = datetime.fromisoformat(start.replace("Z", "+00:00"))
+        for i, event in enumerate(events):
+            start_time, _ = event_bounds(event)
             formatted_appointments.append(f"[{i+1}] {event['summary']} (Start: {start_time.strftime('%Y-%m-%d %H:%M:%S')})")
 
         return "\n ---- \n".join(formatted_appointments)
 
 
-class CalendarInsertExecutor(GoogleServiceExecutor):
+class CalendarAvailabilityExecutor(GoogleServiceExecutor):
+    """Check when the calendar is busy or free between two moments"""
+
+    model_config = ConfigDict(json_schema_extra={"name": "get_calendar_availability"})
+    start_time: str = Field(description="Start of the range in RFC3339 format", examples=["2024-11-10T09:00:00"])
+    end_time: str = Field(description="End of the range in RFC3339 format", examples=["2024-11-10T18:00:00"])
+
+    async def execute(self, creds) -> str:
+        """List the busy and free intervals of the calendar within the range.
+
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
+
+        Returns:
+            str: A formatted string containing the busy and free intervals.
+        """
+        if calendar_cache.is_stale:
+            await calendar_cache.refresh(creds=creds)
+
+        timezone = pytz.timezone(settings.timezone)
+        start, end = (datetime.fromisoformat(t.replace("Z", "+00:00")) for t in (self.start_time, self.end_time))
+        start, end = (t if t.tzinfo else timezone.localize(t) for t in (start, end))
+
+        busy: list[tuple[datetime, datetime]] = calendar_cache.busy(start=start, end=end)
+        free: list[tuple[datetime, datetime]] = []
+        cursor: datetime = start
+        for busy_start, busy_end in busy:
+            if busy_start > cursor:
+                free.append((cursor, busy_start))
+            cursor = max(cursor, busy_end)
+        if cursor < end:
+            free.append((cursor, end))
+
+        def format_intervals(intervals: list[tuple[datetime, datetime]]) -> str:
+            return ", ".join(
+                f"{a.astimezone(timezone).strftime('%Y-%m-%d %H:%M')} - {b.astimezone(timezone).strftime('%H:%M')}"
+                for a, b in intervals
+            )
+
+        return f"Busy: {format_intervals(busy) or 'never'}\nFree: {format_intervals(free) or 'never'}"
+
+
+class CalendarInsertExecutor(GoogleWriteExecutor):
     """Insert an appointment into the calendar"""
 
     model_config = ConfigDict(json_schema_extra={"name": "insert_calendar_appointment"})
@@ -153,10 +279,22 @@ class CalendarInsertExecutor(GoogleServiceExecutor):
     end_time: str = Field(description="End time in RFC3339 format", examples=["2024-11-10T20:30:00"])
     attendees: list[str] | None = Field(description="List of attendee email addresses")
 
-    async def execute(self, creds) -> str:
+    def perform(self, creds: Credentials, idempotency_key: str, retry: bool = False) -> str:
+        """Insert the appointment using the Calendar API.
+
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
+            idempotency_key (str): Used as the event id, so Calendar rejects a second insert of the same appointment.
+            retry (bool): Unused, a repeated insert of the same event id fails with 409.
+
+        Returns:
+            str: A message with the link to the event.
+        """
         service = build(serviceName="calendar", version="v3", credentials=creds)
         attendees = self.attendees if self.attendees else []
         event = {
+            # Event ids allow lowercase base32hex characters, hex digits are a subset
+            "id": idempotency_key,
             "summary": self.summary,
             "location": self.location,
             "description": self.description,
@@ -171,5 +309,15 @@ class CalendarInsertExecutor(GoogleServiceExecutor):
             "attendees": [{"email": settings.gmail_host_user}].extend([{"email": attendee} for attendee in attendees]),
         }
 
-        event = service.events().insert(calendarId="primary", body=event).execute()
+        try:
+            event = service.events().insert(calendarId="primary", body=event).execute()
+        except HttpError as e:
+            # The id is this operation's own key: the event exists because an earlier attempt went through
+            if e.resp.status != 409:
+                raise
+            event = service.events().get(calendarId="primary", eventId=idempotency_key).execute()
+        calendar_cache.upsert(event=event)
         return f"Event created: {event.get('htmlLink')}"
+
+    def provisional_result(self) -> str:
+        return f"The appointment '{self.summary}' is queued and will be added to the calendar in the background."
@@ -0,0 +1,379 @@
+import asyncio
+import random
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Any
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from loguru import logger
+
+from src.scheduler import is_transient, remaining, scheduler, without_deadline
+from src.settings import Settings
+from src.tools.google_tools.credentials import GoogleCredsManager
+from src.tools.google_tools.services import GoogleServices
+
+settings = Settings()
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    internal_date INTEGER,
+    date TEXT,
+    sender TEXT,
+    subject TEXT,
+    snippet TEXT,
+    labels TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date DESC);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    sender, subject, snippet, content='messages', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, sender, subject, snippet) VALUES (new.rowid, new.sender, new.subject, new.snippet);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, sender, subject, snippet)
+    VALUES ('delete', old.rowid, old.sender, old.subject, old.snippet);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, sender, subject, snippet)
+    VALUES ('delete', old.rowid, old.sender, old.subject, old.snippet);
+    INSERT INTO messages_fts (rowid, sender, subject, snippet) VALUES (new.rowid, new.sender, new.subject, new.snippet);
+END;
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Labels of the primary inbox, the equivalent of the `category:primary` search in the inbox.
+PRIMARY_LABELS: tuple[str, ...] = ("INBOX", "CATEGORY_PERSONAL")
+
+
+def message_row(message: dict[str, Any]) -> tuple:
+    """Flatten a Gmail API message resource (metadata format) into a `messages` row.
+
+    Args:
+        message (dict[str, Any]): Gmail API message resource.
+
+    Returns:
+        tuple: Row values in column order.
+    """
+    headers: list[dict[str, Any]] = message.get("payload", {}).get("headers", [])
+    date: str = next((header.get("value") for header in headers if header.get("name") == "Date"), "Unknown Date")
+    subject: str = next((header.get("value") for header in headers if header.get("name") == "Subject"), "No Subject")
+    sender: str = next((header.get("value") for header in headers if header.get("name") == "From"), "Unknown Sender")
+    # Labels are space delimited on both ends so a label can be matched with LIKE '% LABEL %'
+    labels: str = f" {' '.join(message.get('labelIds', []))} "
+    return (
+        message["id"],
+        message.get("threadId"),
+        int(message.get("internalDate", 0)),
+        date,
+        sender,
+        subject,
+        message.get("snippet", "No snippet"),
+        labels,
+    )
+
+
+def is_rate_limited(e: Exception) -> bool:
+    """Whether a Gmail error is a quota error worth retrying. Gmail reports some of them as 403 rather than 429."""
+    if is_transient(e=e):
+        return True
+    content: bytes = getattr(e, "content", b"") or b""
+    return isinstance(e, HttpError) and e.resp.status == 403 and b"ateLimitExceeded" in content
+
+
+def fts_query(s: str) -> str:
+    """Turn free text into an FTS5 query that matches every word as a prefix.
+
+    Args:
+        s (str): Free text search.
+
+    Returns:
+        str: FTS5 query.
+    """
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", s))
+
+
+class GmailMirror:
+    """Local SQLite copy of the mailbox metadata, kept current through Gmail history incremental sync.
+
+    Sender, subject and snippet are indexed with FTS5 so reads and searches never leave the process.
+    """
+
+    def __init__(self, path: Path, max_age: float = 300.0, size: int = 2000, batch_size: int = 50, max_attempts: int = 5):
+        self.path = path
+        self.max_age = max_age
+        self.size = size
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.synced_at: float | None = None
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        # The running sync, shared by the background loop and the reads that find the mirror stale
+        self._syncing: asyncio.Task | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    @property
+    def is_stale(self) -> bool:
+        return self.synced_at is None or monotonic() - self.synced_at > self.max_age
+
+    @property
+    def history_id(self) -> str | None:
+        with self._lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = 'history_id'").fetchone()
+        return row[0] if row else None
+
+    def store(self, messages: list[dict[str, Any]], history_id: str | None = None, replace: bool = False) -> None:
+        """Upsert messages and optionally advance the history id, in one transaction. The mirror is trimmed to `size`.
+
+        Args:
+            messages (list[dict[str, Any]]): Gmail API message resources (metadata format).
+            history_id (str | None): History id the mirror is current up to.
+            replace (bool): Whether the messages replace the whole mirror.
+        """
+        with self._lock, self.connection as connection:
+            if replace:
+                connection.execute("DELETE FROM messages")
+            connection.executemany(
+                """
+                INSERT INTO messages (id, thread_id, internal_date, date, sender, subject, snippet, labels)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    internal_date = excluded.internal_date, date = excluded.date, sender = excluded.sender,
+                    subject = excluded.subject, snippet = excluded.snippet, labels = excluded.labels
+                """,
+                [message_row(message) for message in messages],
+            )
+            # Everything older than the size-th newest message, found through the internal_date index
+            connection.execute(
+                """
+                DELETE FROM messages WHERE internal_date < (
+                    SELECT internal_date FROM messages ORDER BY internal_date DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (self.size - 1,),
+            )
+            if history_id is not None:
+                connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('history_id', ?)", (history_id,))
+
+    def delete(self, message_ids: list[str]) -> None:
+        """Remove messages from the mirror.
+
+        Args:
+            message_ids (list[str]): Gmail message ids.
+        """
+        with self._lock, self.connection as connection:
+            connection.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in message_ids])
+
+    def recent(self, n: int, labels: tuple[str, ...] = PRIMARY_LABELS) -> list[dict[str, Any]]:
+        """Get the n most recent messages carrying all the given labels.
+
+        Args:
+            n (int): Number of messages.
+            labels (tuple[str, ...]): Required labels.
+
+        Returns:
+            list[dict[str, Any]]: Messages, newest first.
+        """
+        where: str = " AND ".join("labels LIKE ?" for _ in labels) or "1"
+        with self._lock:
+            cursor = self.connection.execute(
+                f"SELECT * FROM messages WHERE {where} ORDER BY internal_date DESC LIMIT ?",
+                (*(f"% {label} %" for label in labels), n),
+            )
+            return self._rows(cursor=cursor)
+
+    def search(self, query: str, n: int) -> list[dict[str, Any]]:
+        """Full text search over sender, subject and snippet.
+
+        Args:
+            query (str): Free text search.
+            n (int): Maximum number of messages.
+
+        Returns:
+            list[dict[str, Any]]: Messages, best match first.
+        """
+        if not (match := fts_query(s=query)):
+            return []
+        with self._lock:
+            cursor = self.connection.execute(
+                """
+                SELECT messages.* FROM messages_fts JOIN messages ON messages.rowid = messages_fts.rowid
+                WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts), messages.internal_date DESC LIMIT ?
+                """,
+                (match, n),
+            )
+            return self._rows(cursor=cursor)
+
+    def sync(self, creds: Credentials) -> int:
+        """Bring the mirror up to date. Blocking, meant to run in a worker thread.
+
+        Replays the mailbox history since the stored history id and falls back to a full sync of the `size` most recent
+        messages when there is none or Gmail no longer has it.
+
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
+
+        Returns:
+            int: Number of messages that changed.
+        """
+        service = build(serviceName="gmail", version="v1", credentials=creds)
+        changed: int | None = None
+        if (history_id := self.history_id) is not None:
+            try:
+                changed = self._sync_history(service=service, history_id=history_id)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logger.info("Gmail history id expired, running a full sync")
+        if changed is None:
+            changed = self._sync_full(service=service)
+        self.synced_at = monotonic()
+        return changed
+
+    def _sync_full(self, service: Any) -> int:
+        # Take the history id first so nothing that happens during the sync is missed
+        history_id: str = scheduler.call_blocking("google", service.users().getProfile(userId="me").execute)["historyId"]
+
+        message_ids: list[str] = []
+        page_token: str | None = None
+        while len(message_ids) < self.size:
+            page: dict[str, Any] = scheduler.call_blocking(
+                "google",
+                service.users()
+                .messages()
+                .list(userId="me", maxResults=min(500, self.size - len(message_ids)), pageToken=page_token)
+                .execute,
+            )
+            message_ids.extend(message["id"] for message in page.get("messages", []))
+            if not (page_token := page.get("nextPageToken")):
+                break
+
+        messages: list[dict[str, Any]] = self._get_messages(service=service, message_ids=message_ids)
+        self.store(messages=messages, history_id=history_id, replace=True)
+        return len(messages)
+
+    def _sync_history(self, service: Any, history_id: str) -> int:
+        updated: set[str] = set()
+        deleted: set[str] = set()
+        page_token: str | None = None
+        while True:
+            page: dict[str, Any] = scheduler.call_blocking(
+                "google", service.users().history().list(userId="me", startHistoryId=history_id, pageToken=page_token).execute
+            )
+            for record in page.get("history", []):
+                for change in record.get("messagesAdded", []) + record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+                    updated.add(change["message"]["id"])
+                for change in record.get("messagesDeleted", []):
+                    deleted.add(change["message"]["id"])
+            if not (page_token := page.get("nextPageToken")):
+                break
+
+        updated -= deleted
+        messages: list[dict[str, Any]] = self._get_messages(service=service, message_ids=list(updated))
+        self.delete(message_ids=list(deleted))
+        self.store(messages=messages, history_id=page.get("historyId", history_id))
+        return len(messages) + len(deleted)
+
+    def _get_messages(self, service: Any, message_ids: list[str]) -> list[dict[str, Any]]:
+        """Fetch message metadata with batched requests.
+
+        Messages deleted between listing and fetching (404) are skipped. Requests that hit the per-user quota or a server
+        error are sent again with backoff; any other failure, or one that persists, is raised, so the caller does not
+        advance the history id past messages the mirror is missing.
+        """
+        messages: list[dict[str, Any]] = []
+        failed: dict[str, Exception] = {}
+
+        def callback(request_id: str, response: dict[str, Any], exception: Exception | None) -> None:
+            if exception is None:
+                messages.append(response)
+            elif not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                failed[request_id] = exception
+
+        pending: list[str] = message_ids
+        for attempt in range(1, self.max_attempts + 1):
+            failed.clear()
+            for i in range(0, len(pending), self.batch_size):
+                batch = service.new_batch_http_request(callback=callback)
+                for message_id in pending[i : i + self.batch_size]:
+                    batch.add(
+                        service.users()
+                        .messages()
+                        .get(userId="me", id=message_id, format="metadata", metadataHeaders=["From", "Subject", "Date"]),
+                        request_id=message_id,
+                    )
+                # The callbacks of a batch that failed half way may have run, its failures are retried above instead
+                scheduler.call_blocking("google", batch.execute, retries=False)
+            if not failed:
+                return messages
+            error: Exception = next(iter(failed.values()))
+            if attempt == self.max_attempts or not all(is_rate_limited(e=e) for e in failed.values()):
+                raise error
+            pending = list(failed)
+            delay: float = random.uniform(0, min(32.0, 2.0**attempt))
+            logger.warning(
+                "{n} Gmail message fetches failed ({e}), retry {a} in {d:.1f} seconds",
+                n=len(pending),
+                e=error,
+                a=attempt,
+                d=delay,
+            )
+            sleep(delay)
+        return messages
+
+    async def refresh(self, creds: Credentials) -> int:
+        """Sync in a worker thread, or wait for the sync that is already running instead of starting another.
+
+        Args:
+            creds (Credentials): Google OAuth2 credentials.
+
+        Returns:
+            int: Number of messages that changed.
+        """
+        if self._syncing is None or self._syncing.done():
+            # No timeout or retries around the whole sync: an abandoned thread would run on next to the retry. Every
+            # request of the sync goes through the scheduler on its own
+            self._syncing = asyncio.create_task(asyncio.to_thread(self.sync, creds), context=without_deadline())
+        # A caller out of time (turn deadline) leaves the sync running for the others
+        return await asyncio.wait_for(asyncio.shield(self._syncing), timeout=remaining())
+
+    async def run_periodic_sync(self, creds_manager: GoogleCredsManager, interval: float) -> None:
+        """Keep the mirror current in the background.
+
+        Args:
+            creds_manager (GoogleCredsManager): Provider of Google credentials.
+            interval (float): Seconds between syncs.
+        """
+        while True:
+            try:
+                creds = await asyncio.to_thread(creds_manager.get_credentials, scopes=GoogleServices.get_all_scopes())
+                if changed := await self.refresh(creds=creds):
+                    logger.info("Gmail mirror synced, {n} messages changed", n=changed)
+            except Exception as e:
+                logger.error("Error syncing Gmail mirror: {e}", e=e)
+            await asyncio.sleep(interval)
+
+    @staticmethod
+    def _rows(cursor: sqlite3.Cursor) -> list[dict[str, Any]]:
+        columns: list[str] = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+gmail_mirror = GmailMirror(
+    path=settings.cache_dir / "gmail.sqlite3", max_age=settings.gmail_sync_interval, size=settings.gmail_mirror_size
+)
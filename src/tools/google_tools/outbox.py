@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+from pathlib import Path
+from time import time
+from typing import Any, Awaitable
+
+from googleapiclient.errors import HttpError
+from loguru import logger
+from pydantic import BaseModel
+
+from src.scheduler import scheduler
+from src.settings import Settings
+from src.tools.google_tools.credentials import GoogleCredsManager
+from src.tools.google_tools.services import GoogleServices
+
+settings = Settings()
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT UNIQUE,
+    content_hash TEXT,
+    name TEXT,
+    payload TEXT,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    created_at REAL,
+    next_attempt_at REAL,
+    result TEXT,
+    error TEXT,
+    reported INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS operations_due ON operations (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS operations_content ON operations (content_hash, created_at);
+"""
+
+
+class Operation(BaseModel):
+    """A side effect waiting in the outbox."""
+
+    id: int
+    idempotency_key: str
+    name: str
+    payload: dict[str, Any]
+    status: str
+    attempts: int
+    created_at: float = 0.0
+    result: str | None = None
+    error: str | None = None
+    # Set when enqueue found the same operation within the dedupe window instead of adding it
+    duplicate: bool = False
+
+
+def is_retryable(e: Exception) -> bool:
+    """Whether a failed operation may succeed if tried again.
+
+    Args:
+        e (Exception): Error raised by the operation.
+
+    Returns:
+        bool: False for client errors other than timeouts and rate limits.
+    """
+    if isinstance(e, HttpError):
+        return e.resp.status in (408, 429) or e.resp.status >= 500
+    return True
+
+
+class Outbox:
+    """Durable queue of side effecting tool calls, performed by a background worker.
+
+    Write tools enqueue a validated operation and hand a provisional result to the model right away. The worker performs
+    the operation with retries and jittered exponential backoff; failures are reported on the next turn.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        dedupe_window: float = 600.0,
+        poll_interval: float = 5.0,
+    ):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dedupe_window = dedupe_window
+        self.poll_interval = poll_interval
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._wakeup: asyncio.Event | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def enqueue(self, name: str, payload: dict[str, Any]) -> Operation:
+        """Add an operation, unless the same one was enqueued within the dedupe window.
+
+        Args:
+            name (str): Tool name.
+            payload (dict[str, Any]): Validated tool arguments.
+
+        Returns:
+            Operation: The new operation, or the existing duplicate with `duplicate` set.
+        """
+        serialized: str = json.dumps(payload, sort_keys=True)
+        content_hash: str = hashlib.sha256(f"{name}\n{serialized}".encode()).hexdigest()
+        now: float = time()
+        cursor: sqlite3.Cursor | None = None
+        with self._lock, self.connection as connection:
+            row = connection.execute(
+                "SELECT id FROM operations WHERE content_hash = ? AND created_at > ? AND status != 'failed'",
+                (content_hash, now - self.dedupe_window),
+            ).fetchone()
+            if row is None:
+                cursor = connection.execute(
+                    "INSERT INTO operations (content_hash, name, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+                    (content_hash, name, serialized, now, now),
+                )
+                # Stable across retries and restarts, unique per operation
+                key: str = hashlib.sha256(f"{content_hash}{cursor.lastrowid}".encode()).hexdigest()
+                connection.execute("UPDATE operations SET idempotency_key = ? WHERE id = ?", (key, cursor.lastrowid))
+                row = (cursor.lastrowid,)
+            else:
+                logger.info("Operation {name} already in the outbox, not enqueued again", name=name)
+
+        duplicate: bool = cursor is None
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return self.get(operation_id=row[0]).model_copy(update={"duplicate": duplicate})
+
+    def get(self, operation_id: int) -> Operation:
+        with self._lock:
+            cursor = self.connection.execute("SELECT * FROM operations WHERE id = ?", (operation_id,))
+            return self._operations(cursor=cursor)[0]
+
+    def next_due(self) -> Operation | None:
+        """Get the pending operation that is due first, if any is due now."""
+        with self._lock:
+            cursor = self.connection.execute(
+                "SELECT * FROM operations WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+                (time(),),
+            )
+            operations: list[Operation] = self._operations(cursor=cursor)
+        return operations[0] if operations else None
+
+    def start(self, operation: Operation) -> Operation:
+        """Mark an operation as in flight and count the attempt, before it is performed.
+
+        The attempt is counted up front so that, after a crash or a timeout during the previous attempt, the next one
+        knows the side effect may already have happened.
+
+        Args:
+            operation (Operation): Due operation.
+
+        Returns:
+            Operation: The operation with the attempt counted.
+        """
+        with self._lock, self.connection as connection:
+            connection.execute(
+                "UPDATE operations SET status = 'in_flight', attempts = attempts + 1 WHERE id = ?", (operation.id,)
+            )
+        return operation.model_copy(update={"status": "in_flight", "attempts": operation.attempts + 1})
+
+    def recover(self) -> int:
+        """Requeue the operations that were in flight when the process stopped.
+
+        Returns:
+            int: Number of requeued operations.
+        """
+        with self._lock, self.connection as connection:
+            cursor = connection.execute(
+                "UPDATE operations SET status = 'pending', next_attempt_at = ? WHERE status = 'in_flight'", (time(),)
+            )
+        return cursor.rowcount
+
+    def complete(self, operation: Operation, result: str) -> None:
+        with self._lock, self.connection as connection:
+            # Successes were already announced through the provisional result
+            connection.execute(
+                "UPDATE operations SET status = 'done', result = ?, reported = 1 WHERE id = ?", (result, operation.id)
+            )
+
+    def fail(self, operation: Operation, error: Exception) -> None:
+        """Schedule a retry with jittered exponential backoff, or give up on the operation.
+
+        Args:
+            operation (Operation): Failed operation, as returned by `start`.
+            error (Exception): Error raised by the operation.
+        """
+        attempts: int = operation.attempts
+        if attempts >= self.max_attempts or not is_retryable(e=error):
+            status, next_attempt_at = "failed", None
+            logger.error("Operation {name} failed after {n} attempts: {e}", name=operation.name, n=attempts, e=error)
+        else:
+            status = "pending"
+            next_attempt_at = time() + random.uniform(0.5, 1.0) * min(self.max_delay, self.base_delay * 2**attempts)
+            logger.warning("Operation {name} failed, retrying (attempt {n}): {e}", name=operation.name, n=attempts, e=error)
+        with self._lock, self.connection as connection:
+            connection.execute(
+                "UPDATE operations SET status = ?, attempts = ?, next_attempt_at = ?, error = ? WHERE id = ?",
+                (status, attempts, next_attempt_at, str(error), operation.id),
+            )
+
+    def drain_failures(self) -> list[Operation]:
+        """Get the failed operations that were not reported yet, marking them as reported."""
+        with self._lock, self.connection as connection:
+            cursor = connection.execute("SELECT * FROM operations WHERE status = 'failed' AND reported = 0")
+            operations: list[Operation] = self._operations(cursor=cursor)
+            connection.executemany("UPDATE operations SET reported = 1 WHERE id = ?", [(o.id,) for o in operations])
+        return operations
+
+    async def run_worker(self, creds_manager: GoogleCredsManager, executors: dict[str, Any]) -> None:
+        """Perform the queued operations in the background.
+
+        Args:
+            creds_manager (GoogleCredsManager): Provider of Google credentials.
+            executors (dict[str, Any]): Executor class of every tool name that can be in the outbox.
+        """
+        self._wakeup = asyncio.Event()
+        if requeued := self.recover():
+            logger.warning("{n} operations were interrupted, retrying them", n=requeued)
+        while True:
+            if (operation := self.next_due()) is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except TimeoutError:
+                    pass
+                continue
+
+            operation = self.start(operation=operation)
+            perform: asyncio.Task | None = None
+            try:
+                creds = await asyncio.to_thread(creds_manager.get_credentials, scopes=GoogleServices.get_all_scopes())
+                executor = executors[operation.name](**operation.payload)
+
+                def request() -> Awaitable[str]:
+                    nonlocal perform
+                    perform = asyncio.ensure_future(
+                        asyncio.to_thread(
+                            executor.perform,
+                            creds=creds,
+                            idempotency_key=operation.idempotency_key,
+                            retry=operation.attempts > 1,
+                        )
+                    )
+                    return asyncio.shield(perform)
+
+                # Rate limited and timed out by the scheduler, retried by the outbox
+                result: str = await scheduler.call("google", request, retries=False)
+            except Exception as e:
+                error: BaseException | None = e
+                if perform is not None and not perform.done():
+                    # A timeout does not stop the thread, the attempt is over when it returns: a retry must not overlap it
+                    logger.warning("Operation {name} timed out, waiting for the request to finish", name=operation.name)
+                    await asyncio.wait({perform})
+                    error = perform.exception()
+                if error is not None:
+                    self.fail(operation=operation, error=error)
+                    continue
+                result = perform.result()
+            self.complete(operation=operation, result=result)
+            logger.info("Operation {name} done: {r}", name=operation.name, r=result)
+
+    @staticmethod
+    def _operations(cursor: sqlite3.Cursor) -> list[Operation]:
+        columns: list[str] = [column[0] for column in cursor.description]
+        operations: list[Operation] = []
+        for row in cursor.fetchall():
+            values: dict[str, Any] = dict(zip(columns, row))
+            values["payload"] = json.loads(values["payload"])
+            operations.append(Operation(**values))
+        return operations
+
+
+outbox = Outbox(path=settings.cache_dir / "outbox.sqlite3", max_attempts=settings.outbox_max_attempts)
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 from io import BytesIO
 from time import perf_counter
@@ -9,31 +10,55 @@ from openai import AsyncOpenAI
 from PIL import Image
 from pydantic import ConfigDict, Field
 
+from src.offload import offload
+from src.scheduler import scheduler
 from src.settings import Settings
 from src.tools.base import AsyncTool
 
 settings = Settings()
 
+# Llama 3.2 Vision sees at most 2x2 tiles of 560 pixels, larger images are downscaled by the endpoint anyway
+VISION_MAX_SIZE: int = 1120
 
-async def url_to_base64(image_url: str) -> str:
-    """Convert image URL to base64 string.
+
+def encode_data_uri(data: bytes | memoryview) -> str:
+    """Base64 encode an image as a data URI. CPU bound, holds the GIL, runs in the offload process pool.
 
     Args:
-        image_url: URL of the image to convert
+        data (bytes | memoryview): The image.
 
     Returns:
-        Base64 encoded image with data URI prefix
+        str: Base64 encoded image with data URI prefix
+    """
+    return f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def encode_for_vision(data: bytes | memoryview, max_size: int = VISION_MAX_SIZE) -> str:
+    """Downscale an image to the size the vision model sees and encode it as a JPEG data URI. CPU bound, runs in the
+    offload process pool.
 
-    Raises:
-        httpx.HTTPError: If image download fails
+    A full resolution scan makes a request body of tens of megabytes, which the client serializes on the event loop.
+
+    Args:
+        data (bytes | memoryview): The image.
+        max_size (int): Longest side in pixels.
+
+    Returns:
+        str: Base64 encoded image with data URI prefix
     """
-    async with httpx.AsyncClient() as client:
-        response = await client.get(image_url)
-        response.raise_for_status()
+    with Image.open(BytesIO(data)) as img:
+        if max(img.size) <= max_size and img.format == "JPEG":
+            return encode_data_uri(data)
+        img.thumbnail((max_size, max_size))
+        buffer = BytesIO()
+        img.convert("RGB").save(buffer, format="JPEG", quality=90)
+    return encode_data_uri(buffer.getvalue())
 
-        image_binary = response.content
-        base64_image = base64.b64encode(image_binary).decode("utf-8")
-        return f"data:image/jpeg;base64,{base64_image}"
+
+def show_image(data: bytes) -> None:
+    """Decode an image and open it in the system viewer. The codec releases the GIL, runs in the offload thread pool."""
+    with Image.open(BytesIO(data)) as img:
+        img.show()
 
 
 class NewspaperFrontTool(AsyncTool):
@@ -55,15 +80,29 @@ class NewspaperFrontTool(AsyncTool):
         params = {"api-key": settings.worlds_news_api_key, "source-country": self.city, "source-name": self.source}
 
         async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
+
+            async def get_front_page() -> httpx.Response:
+                response = await client.get(url, params=params)
+                response.raise_for_status()
+                return response
+
+            response = await scheduler.call("worldnewsapi", get_front_page)
             data = response.json()
             front_page_image_url = data.get("front_page", {}).get("image")
-            image = await client.get(front_page_image_url)
-            with Image.open(BytesIO(image.content)) as img:
-                img.show()
 
-        samba_client = AsyncOpenAI(api_key=settings.samba_api_key, base_url=settings.samba_url)
+            async def get_image() -> httpx.Response:
+                response = await client.get(front_page_image_url)
+                response.raise_for_status()
+                return response
+
+            image = await scheduler.call("worldnewsapi", get_image)
+
+        # Decoding and encoding a multi-megabyte image would stall token and audio streaming on the loop
+        _, image_url = await asyncio.gather(
+            offload.run(show_image, image.content, process=False), offload.run_on_buffer(encode_for_vision, image.content)
+        )
+
+        samba_client = AsyncOpenAI(api_key=settings.samba_api_key, base_url=settings.samba_url, max_retries=0)
         messages = [
             {
                 "role": "user",
@@ -72,17 +111,20 @@ class NewspaperFrontTool(AsyncTool):
                         "type": "text",
                         "text": f"Analyze the provided newspaper ({self.source.replace('-', ' ').capitalize()}) front page as a concise news expert. Summarize the main headline and key stories visible.",
                     },
-                    {"type": "image_url", "image_url": {"url": await url_to_base64(front_page_image_url)}},
+                    {"type": "image_url", "image_url": {"url": image_url}},
                 ],
             },
         ]
 
         logger.info("Using multimodal model to analyze {url}", url=front_page_image_url)
         _now: float = perf_counter()
-        completion = await samba_client.chat.completions.create(
-            messages=messages,
-            model="Llama-3.2-90B-Vision-Instruct",
-            temperature=0.0,
+        completion = await scheduler.call(
+            "samba",
+            lambda: samba_client.chat.completions.create(
+                messages=messages,
+                model="Llama-3.2-90B-Vision-Instruct",
+                temperature=0.0,
+            ),
         )
         logger.info("Multimodal generation time: {s:.3f} seconds", s=perf_counter() - _now)
 
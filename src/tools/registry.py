@@ -0,0 +1,182 @@
+import hashlib
+import importlib
+import importlib.util
+import json
+import sys
+from collections.abc import Iterator, Mapping
+from importlib.metadata import entry_points
+from pathlib import Path
+from typing import Any
+
+import pydantic
+from loguru import logger
+
+from src.settings import Settings
+from src.tools.schema_generation import MyGenerateJsonSchema
+
+settings = Settings()
+
+# Entry point group of the tools installed by other packages, e.g. in their pyproject.toml:
+# [tool.poetry.plugins."samba_agent.tools"]
+# get_stock_price = "my_package.stocks:StockTool"
+ENTRY_POINT_GROUP: str = "samba_agent.tools"
+
+BUILTIN_TOOLS: dict[str, str] = {
+    "read_gmail_emails": "src.tools.google_tools.executors:GmailReadExecutor",
+    "search_gmail_emails": "src.tools.google_tools.executors:GmailSearchExecutor",
+    "send_gmail_email": "src.tools.google_tools.executors:GmailWriteExecutor",
+    "insert_calendar_appointment": "src.tools.google_tools.executors:CalendarInsertExecutor",
+    "get_calendar_appointments": "src.tools.google_tools.executors:CalendarReadExecutor",
+    "get_calendar_availability": "src.tools.google_tools.executors:CalendarAvailabilityExecutor",
+    "get_weather_data": "src.tools.weather:WeatherTool",
+    "get_news_data": "src.tools.news:NewspaperFrontTool",
+}
+
+
+def source_modules(cls: type) -> list[str]:
+    """Modules a tool schema is generated from: those defining the classes in the tool's MRO, and the schema generator.
+
+    The standard library and Pydantic (versioned in the hash instead) are left out. Field types defined in other modules
+    are not followed, a change to them alone keeps the cached schema.
+
+    Args:
+        cls (type): Tool class.
+
+    Returns:
+        list[str]: Module names, sorted.
+    """
+    names: set[str] = {c.__module__ for c in cls.__mro__} | {MyGenerateJsonSchema.__module__}
+    return sorted(n for n in names if n.split(".")[0] not in sys.stdlib_module_names | {"builtins", "pydantic"})
+
+
+def source_hash(target: str, modules: list[str]) -> str:
+    """Hash of everything a tool schema depends on: the source of its modules and the Pydantic version.
+
+    Args:
+        target (str): Tool class as `module:attribute`.
+        modules (list[str]): Modules the schema was generated from, see `source_modules`.
+
+    Returns:
+        str: Hex digest, the key of the cached schema.
+    """
+    digest = hashlib.sha256(f"{target}\n{pydantic.VERSION}\n".encode())
+    for name in modules:
+        # Locating the module does not run it
+        spec = importlib.util.find_spec(name)
+        if spec is not None and spec.origin and Path(spec.origin).is_file():
+            digest.update(Path(spec.origin).read_bytes())
+    return digest.hexdigest()
+
+
+def load_target(target: str) -> Any:
+    """Import a `module:attribute` reference."""
+    module_name, _, attribute = target.partition(":")
+    obj: Any = importlib.import_module(module_name)
+    for part in attribute.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+class ToolRegistry(Mapping):
+    """Tool classes by name, imported on first use, with their JSON schemas cached on disk.
+
+    Tools come from the built-in table, the `samba_agent.tools` entry points and the `TOOL_PLUGINS` setting, later sources
+    overriding earlier ones. Listing the tools, building the prompt and the intent matcher only need the schemas, which
+    are read from the cache while the source of the tool's modules (its own and its base classes'), the schema generator and
+    the Pydantic version are unchanged, so no tool module is imported at startup. A tool's module is imported the first time the tool is looked up.
+    """
+
+    def __init__(self, cache_path: Path, targets: dict[str, str] | None = None):
+        self.cache_path = cache_path
+        self.targets: dict[str, str] = targets if targets is not None else self.discover()
+        self._classes: dict[str, Any] = {}
+        self._schemas: dict[str, dict[str, Any]] | None = None
+
+    @staticmethod
+    def discover() -> dict[str, str]:
+        """Built-in, installed and configured tools.
+
+        Returns:
+            dict[str, str]: Tool class as `module:attribute` per tool name.
+        """
+        targets: dict[str, str] = dict(BUILTIN_TOOLS)
+        targets.update({ep.name: ep.value for ep in entry_points(group=ENTRY_POINT_GROUP)})
+        targets.update(settings.tool_plugins)
+        return targets
+
+    def __getitem__(self, name: str) -> Any:
+        if (cls := self._classes.get(name)) is None:
+            cls = self._classes[name] = load_target(target=self.targets[name])
+            logger.debug("Tool {name} loaded from {target}", name=name, target=self.targets[name])
+        return cls
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.targets
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.targets)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    @property
+    def schemas(self) -> dict[str, dict[str, Any]]:
+        """JSON schema per tool name, from the cache when it is current."""
+        if self._schemas is None:
+            self._schemas = self._load_schemas()
+        return self._schemas
+
+    def _load_schemas(self) -> dict[str, dict[str, Any]]:
+        cached: dict[str, Any] = {}
+        if self.cache_path.exists():
+            try:
+                cached = json.loads(self.cache_path.read_text())
+            except json.JSONDecodeError:
+                logger.warning("Tool schema cache {path} is corrupt, rebuilding it", path=self.cache_path)
+
+        schemas: dict[str, dict[str, Any]] = {}
+        entries: dict[str, Any] = {}
+        stale: list[str] = []
+        for name, target in self.targets.items():
+            # The modules of the class hierarchy are recorded with the schema, checking them does not import the tool
+            entry: dict[str, Any] | None = cached.get(name)
+            if entry is None or entry.get("key") != source_hash(target=target, modules=entry.get("modules", [])):
+                stale.append(name)
+                modules: list[str] = source_modules(cls=self[name])
+                entry = {
+                    "key": source_hash(target=target, modules=modules),
+                    "modules": modules,
+                    "schema": self[name].model_json_schema(schema_generator=MyGenerateJsonSchema),
+                }
+            schemas[name] = entry["schema"]
+            entries[name] = entry
+
+        if stale or entries.keys() != cached.keys():
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp: Path = self.cache_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(entries))
+            tmp.replace(self.cache_path)
+        logger.info("Tool schemas: {n} cached, {s} regenerated", n=len(schemas) - len(stale), s=len(stale))
+        return schemas
+
+    async def run(self, name: str, arguments: dict[str, Any], creds_manager: Any = None) -> Any:
+        """Invoke a tool.
+
+        Args:
+            name (str): Tool name.
+            arguments (dict[str, Any]): Arguments of the tool call.
+            creds_manager (Any): Google credentials manager, used by the Google executors.
+
+        Returns:
+            Any: The tool output.
+        """
+        cls: Any = self[name]
+        if hasattr(cls, "execute"):
+            # Google executors run with the user's credentials
+            from src.tools.google_tools.base import GoogleTool
+
+            return await GoogleTool(creds_manager=creds_manager, executor=cls(**arguments)).run()
+        return await cls(**arguments).run()
+
+
+tool_registry = ToolRegistry(cache_path=settings.cache_dir / "tool_schemas.json")
@@ -1,8 +1,6 @@
 import json
 from typing import Any
 
-from src.tools.schema_generation import MyGenerateJsonSchema
-
 
 def lowercase_first(s: str) -> str:
     """Lowercase the first letter of a string.
@@ -16,19 +14,30 @@ def lowercase_first(s: str) -> str:
     return s[0].lower() + s[1:] if s else s
 
 
-def prepare_schemas(models: list[Any]) -> str:
-    """Prepare the JSON schemas for a list of pydantic models.
+def prepare_schemas(schemas: list[dict[str, Any]]) -> str:
+    """Prepare the prompt block describing a list of tool schemas.
 
     Args:
-        models (list[Any]): A list of pydantic model instances.
+        schemas (list[dict[str, Any]]): JSON schemas of the tools, as found in the tool registry.
 
     Returns:
-        str: A string containing the JSON schemas for the models.
+        str: A string containing the JSON schemas for the tools.
     """
-    schemas: list = [model.model_json_schema(schema_generator=MyGenerateJsonSchema) for model in models]
     return "\n".join(
         [
             f"Use the function '{schema.get('name')}' to {lowercase_first(s=schema.get('description'))}:\n```json\n{json.dumps(schema, indent=4)}\n```"
             for schema in schemas
         ]
     )
+
+
+def prepare_tool_definitions(schemas: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Prepare the tool definitions of a list of tool schemas for native function calling.
+
+    Args:
+        schemas (list[dict[str, Any]]): JSON schemas of the tools, as found in the tool registry.
+
+    Returns:
+        list[dict[str, Any]]: Definitions for the `tools` parameter of the chat completions API.
+    """
+    return [{"type": "function", "function": schema} for schema in schemas]
@@ -1,6 +1,7 @@
 import httpx
 from pydantic import ConfigDict, Field
 
+from src.scheduler import scheduler
 from src.settings import Settings
 from src.tools.base import AsyncTool
 
@@ -27,8 +28,13 @@ class WeatherTool(AsyncTool):
         params = {"access_key": settings.weatherstack_api_key, "query": self.city}
 
         async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
+
+            async def get_current() -> httpx.Response:
+                response = await client.get(url, params=params)
+                response.raise_for_status()
+                return response
+
+            response = await scheduler.call("weatherstack", get_current)
 
             data = response.json()
             observation_time = data.get("current").get("observation_time")
@@ -0,0 +1,145 @@
+import json
+import sys
+from typing import Any, Iterable
+
+# Key orders of the messages, shared by all the records of the same shape
+_SHAPES: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+
+class Turn:
+    """One message of the conversation, stored once however many snapshots contain it."""
+
+    __slots__ = ("role", "content", "extra", "shape")
+
+    def __init__(self, message: dict[str, Any]):
+        self.role: str = sys.intern(message["role"])
+        self.content: Any = message.get("content")
+        # Only tool calls and tool outputs carry more keys
+        self.extra: dict[str, Any] | None = {k: v for k, v in message.items() if k not in ("role", "content")} or None
+        shape: tuple[str, ...] = tuple(message)
+        self.shape: tuple[str, ...] = _SHAPES.setdefault(shape, shape)
+
+    def to_message(self) -> dict[str, Any]:
+        values: dict[str, Any] = {"role": self.role, "content": self.content, **(self.extra or {})}
+        return {key: values[key] for key in self.shape}
+
+
+class Snapshot:
+    """The context of one completion: a run of the log and the completion metadata."""
+
+    __slots__ = ("start", "end", "metadata")
+
+    def __init__(self, start: int, end: int, metadata: dict[str, Any]):
+        self.start = start
+        self.end = end
+        self.metadata = metadata
+
+
+class Transcript:
+    """Append-only log of the conversation messages, with the context of every completion as offsets into it.
+
+    The chat history used to keep a copy of the message list per completion, which grows quadratically with the number
+    of turns. Here consecutive snapshots share their common prefix, the system prompt included: each message is a
+    `Turn` record stored once and a snapshot is a `(start, end)` run of the log. The working message list is mirrored
+    by identity, so `record` only appends what is new; a context rewritten in place (the text protocol fallback) starts a
+    new run.
+
+    It is saved the same way, as JSON lines appended after every completion (`pending`, `load`): a header, one line per
+    record and one per snapshot with its offsets and metadata.
+    """
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.records: list[Turn] = []
+        self.snapshots: list[Snapshot] = []
+        self._start: int = 0
+        # The message dicts of the current run, to recognize them in the working list
+        self._run: list[dict[str, Any]] = []
+        # Records and snapshots already handed out by `pending`
+        self._saved: tuple[int, int] | None = None
+
+    def __len__(self) -> int:
+        return len(self.snapshots)
+
+    def record(self, messages: list[dict[str, Any]], metadata: dict[str, Any]) -> Snapshot:
+        """Take a snapshot of the working message list after a completion.
+
+        Args:
+            messages (list[dict[str, Any]]): Conversation messages the completion was generated from.
+            metadata (dict[str, Any]): Completion metadata.
+
+        Returns:
+            Snapshot: The snapshot.
+        """
+        shared: int = 0
+        for message, seen in zip(messages, self._run):
+            if message is not seen:
+                break
+            shared += 1
+        if shared < len(self._run):
+            # Rewritten, the new context starts a new run
+            self._start, self._run, shared = len(self.records), [], 0
+        self.records.extend(Turn(message=message) for message in messages[shared:])
+        self._run.extend(messages[shared:])
+        snapshot = Snapshot(start=self._start, end=len(self.records), metadata=metadata)
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    def pending(self) -> str:
+        """JSON lines of what was recorded since the last call, the header first, to append to the transcript file.
+
+        Returns:
+            str: The lines, empty if nothing was recorded.
+        """
+        lines: list[str] = []
+        if self._saved is None:
+            lines.append(json.dumps({"conversation_id": self.conversation_id}))
+            self._saved = (0, 0)
+        records, snapshots = self._saved
+        lines.extend(json.dumps({"message": record.to_message()}) for record in self.records[records:])
+        lines.extend(
+            json.dumps({"snapshot": [snapshot.start, snapshot.end], "metadata": snapshot.metadata})
+            for snapshot in self.snapshots[snapshots:]
+        )
+        self._saved = (len(self.records), len(self.snapshots))
+        return "".join(line + "\n" for line in lines)
+
+    @classmethod
+    def load(cls, lines: Iterable[str]) -> "Transcript":
+        """Read a transcript back from the lines written by `pending`.
+
+        Args:
+            lines (Iterable[str]): The lines, a file object works.
+
+        Returns:
+            Transcript: The transcript, with nothing pending. A line cut short by a crash ends it.
+        """
+        transcript: Transcript | None = None
+        for line in lines:
+            try:
+                entry: dict[str, Any] = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if transcript is None:
+                transcript = cls(conversation_id=entry["conversation_id"])
+            elif "message" in entry:
+                transcript.records.append(Turn(message=entry["message"]))
+            elif "snapshot" in entry:
+                start, end = entry["snapshot"]
+                transcript.snapshots.append(Snapshot(start=start, end=end, metadata=entry["metadata"]))
+        if transcript is None:
+            raise ValueError("Transcript has no header")
+        transcript._saved = (len(transcript.records), len(transcript.snapshots))
+        return transcript
+
+    def messages(self, index: int = -1) -> list[dict[str, Any]]:
+        """Rebuild the message list of a snapshot.
+
+        Args:
+            index (int): Snapshot index.
+
+        Returns:
+            list[dict[str, Any]]: The messages, as sent in the request.
+        """
+        snapshot: Snapshot = self.snapshots[index]
+        return [record.to_message() for record in self.records[snapshot.start : snapshot.end]]
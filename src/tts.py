@@ -1,36 +1,77 @@
-import numpy as np
-import pyaudio
+from contextlib import AsyncExitStack
+from time import perf_counter
+
+from loguru import logger
 from openai import AsyncOpenAI
 
+from src.audio import AudioOutput, StreamingDecoder
 from src.gui import WaveformVisualizer
+from src.scheduler import scheduler
+from src.settings import Settings
+
+settings = Settings()
 
 
 async def play_audio(
-    p: pyaudio.PyAudio, openai_client: AsyncOpenAI, response: str, visualizer: WaveformVisualizer | None = None
+    output: AudioOutput, openai_client: AsyncOpenAI, response: str, visualizer: WaveformVisualizer | None = None
 ) -> None:
     """Plays the audio response from OpenAI and updates the waveform visualizer.
 
     Args:
-        p (pyaudio.PyAudio): The PyAudio instance.
+        output (AudioOutput): The shared audio output.
         openai_client (AsyncOpenAI): The OpenAI client.
         response (str): The response from OpenAI.
         visualizer (WaveformVisualizer | None): Optional waveform visualizer instance.
     """
-    audio_stream = p.open(format=8, channels=1, rate=24_000, output=True)
-
-    async with openai_client.audio.speech.with_streaming_response.create(
-        model="tts-1", voice="echo", input=response, response_format="pcm"
-    ) as response_audio:
-        async for tts_chunk in response_audio.iter_bytes(1024):
-            # Play audio
-            audio_stream.write(tts_chunk)
-
-            # Update visualizer if provided
-            if visualizer is not None:
-                # Convert the audio chunk to numpy array for visualization
-                audio_data = np.frombuffer(tts_chunk, dtype=np.int16)
-                visualizer.update_waveform(audio_data)
-
-    # Close the audio stream
-    audio_stream.stop_stream()
-    audio_stream.close()
+    # Redraw the waveform of what is being played at most every 40 ms
+    last_update: float = 0.0
+
+    def update_visualizer(frames) -> None:
+        nonlocal last_update
+        if visualizer is not None and perf_counter() - last_update > 0.04:
+            visualizer.update_waveform(frames)
+            last_update = perf_counter()
+
+    output.begin_speech()
+    try:
+        async with AsyncExitStack() as stack:
+            # Retried until the response headers arrive, the audio itself streams without retries
+            response_audio = await scheduler.call(
+                "openai",
+                lambda: stack.enter_async_context(
+                    openai_client.audio.speech.with_streaming_response.create(
+                        model="tts-1", voice="echo", input=response, response_format=settings.tts_format
+                    )
+                ),
+            )
+            if settings.tts_format == "pcm":
+                async for tts_chunk in response_audio.iter_bytes(1024):
+                    # Queue audio
+                    output.write(tts_chunk)
+                    update_visualizer(output.last_frames)
+            else:
+                # Compressed audio is decoded as it arrives
+                decoder = StreamingDecoder(audio_format=settings.tts_format, on_pcm=output.write, rate=output.rate)
+                decoder.start()
+                try:
+                    async for tts_chunk in response_audio.iter_bytes(4096):
+                        decoder.feed(tts_chunk)
+                        update_visualizer(output.last_frames)
+                finally:
+                    # Ends the decoder thread, also when the stream breaks off
+                    decoder.feed(None)
+                await decoder.wait()
+    finally:
+        output.end_speech()
+
+    # Wait for the queued audio to be played
+    await output.drain(on_frame=update_visualizer)
+    stats = output.speech.stats
+    logger.info(
+        "TTS ({f}) time to first audio: {t:.3f} seconds, underruns: {u}, prefill: {p:.0f} ms, jitter: {j:.1f} ms",
+        f=settings.tts_format,
+        t=stats.time_to_first_audio or 0.0,
+        u=stats.underruns,
+        p=stats.prefill * 1000,
+        j=stats.jitter * 1000,
+    )
@@ -0,0 +1,178 @@
+import asyncio
+from typing import Any
+
+import numpy as np
+import pyaudio
+from loguru import logger
+from pydantic import BaseModel
+
+from src.stt import rms
+
+WAKE_WORD_RATE: int = 16000
+# openWakeWord scores 80 ms frames
+WAKE_WORD_FRAME: int = 1280
+
+
+class RingBuffer:
+    """Fixed size buffer of the most recent 16-bit samples."""
+
+    def __init__(self, size: int):
+        self.samples: np.ndarray = np.zeros(size, dtype=np.int16)
+        self.written: int = 0
+
+    def write(self, pcm: bytes) -> None:
+        data: np.ndarray = np.frombuffer(pcm, dtype=np.int16)[-len(self.samples) :]
+        start: int = self.written % len(self.samples)
+        end: int = start + len(data)
+        if end <= len(self.samples):
+            self.samples[start:end] = data
+        else:
+            split: int = len(self.samples) - start
+            self.samples[start:] = data[:split]
+            self.samples[: end - len(self.samples)] = data[split:]
+        self.written += len(data)
+
+    def last(self, n: int) -> np.ndarray:
+        """The n most recent samples, oldest first."""
+        n = min(n, self.written, len(self.samples))
+        end: int = self.written % len(self.samples)
+        return np.roll(self.samples, -end)[len(self.samples) - n :]
+
+
+class WakeWordStats(BaseModel):
+    """Share of the audio the model had to score."""
+
+    frames: int = 0
+    scored: int = 0
+
+    @property
+    def gated_ratio(self) -> float:
+        return 1 - self.scored / self.frames if self.frames else 0.0
+
+
+def load_model(name: str) -> Any:
+    """Load an openWakeWord model (ONNX runtime), downloading it on first use."""
+    from openwakeword.model import Model
+    from openwakeword.utils import download_models
+
+    download_models(model_names=[name])
+    return Model(wakeword_models=[name], inference_framework="onnx")
+
+
+class WakeWordDetector:
+    """Spots the wake word in a stream of 80 ms frames.
+
+    An energy gate keeps the model idle while the room is quiet, which is most of the time. When the gate opens the
+    model first catches up on the recent frames it skipped, so the start of the wake word is scored too, and it keeps
+    scoring for `hangover` seconds after the last loud frame. The ring buffer holds `pre_roll` seconds for the capture
+    that follows, so nothing said right after the wake word is lost.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "hey_jarvis",
+        threshold: float = 0.5,
+        energy_threshold: float = 300.0,
+        pre_roll: float = 1.5,
+        warmup: float = 0.5,
+        hangover: float = 1.0,
+        model: Any = None,
+    ):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.energy_threshold = energy_threshold
+        self.warmup: int = int(warmup * WAKE_WORD_RATE) // WAKE_WORD_FRAME * WAKE_WORD_FRAME
+        self.hangover: int = int(hangover * WAKE_WORD_RATE)
+        self.ring = RingBuffer(size=int(pre_roll * WAKE_WORD_RATE))
+        self.stats = WakeWordStats()
+        self._model = model
+        self._scored_until: int = 0
+        self._loud_at: int | None = None
+
+    @property
+    def model(self) -> Any:
+        if self._model is None:
+            self._model = load_model(name=self.model_name)
+        return self._model
+
+    def process(self, frame: bytes) -> bool:
+        """Add a frame of 16 kHz mono audio.
+
+        Args:
+            frame (bytes): 80 ms of 16-bit PCM.
+
+        Returns:
+            bool: Whether the wake word was just spoken.
+        """
+        self.ring.write(pcm=frame)
+        self.stats.frames += 1
+        if rms(data=frame) >= self.energy_threshold:
+            self._loud_at = self.ring.written
+        if self._loud_at is None or self.ring.written - self._loud_at > self.hangover:
+            return False
+
+        # Score the frames skipped while the gate was closed (up to the warmup) and the new one
+        pending: int = min(self.ring.written - self._scored_until, self.warmup + len(frame) // 2)
+        samples: np.ndarray = self.ring.last(n=pending)
+        self._scored_until = self.ring.written
+        score: float = 0.0
+        for i in range(len(samples) % WAKE_WORD_FRAME, len(samples), WAKE_WORD_FRAME):
+            self.stats.scored += 1
+            scores: dict[str, float] = self.model.predict(samples[i : i + WAKE_WORD_FRAME])
+            score = max(score, max(scores.values(), default=0.0))
+        return score >= self.threshold
+
+    def pre_roll(self) -> bytes:
+        """Audio leading up to now, the wake word included."""
+        return self.ring.last(n=len(self.ring.samples)).tobytes()
+
+    def reset(self) -> None:
+        """Forget the audio heard so far, after a detection."""
+        self.model.reset()
+        self.ring = RingBuffer(size=len(self.ring.samples))
+        self._scored_until, self._loud_at = 0, None
+
+
+class WakeWordListener:
+    """Keeps the microphone open and waits for the wake word, then hands the stream over to endpointed capture."""
+
+    def __init__(self, p: pyaudio.PyAudio, detector: WakeWordDetector):
+        self.p = p
+        self.detector = detector
+        self.stream: pyaudio.Stream | None = None
+
+    def open(self) -> None:
+        """Open the input stream and load the model."""
+        # Load the model now rather than on the first loud frame
+        _ = self.detector.model
+        self.stream = self.p.open(
+            format=pyaudio.paInt16, channels=1, rate=WAKE_WORD_RATE, input=True, frames_per_buffer=WAKE_WORD_FRAME
+        )
+
+    def close(self) -> None:
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+    def _hear(self) -> bool:
+        """Read the next frame and score it, both blocking."""
+        return self.detector.process(frame=self.stream.read(WAKE_WORD_FRAME, False))
+
+    async def listen(self) -> bytes:
+        """Wait for the wake word.
+
+        Returns:
+            bytes: Pre-roll audio, the start of the utterance.
+        """
+        logger.info("Waiting for the wake word ({w})...", w=self.detector.model_name)
+        while True:
+            # The model runs in the thread too, catching up on the skipped frames can take a while
+            if await asyncio.to_thread(self._hear):
+                pre_roll: bytes = self.detector.pre_roll()
+                self.detector.reset()
+                logger.info(
+                    "Wake word detected, the model scored {r:.0%} of the audio",
+                    r=1 - self.detector.stats.gated_ratio,
+                )
+                return pre_roll
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# Settings are read at import time, the tests never reach the real services
+for name in ("OPENAI_API_KEY", "SAMBA_API_KEY", "WEATHERSTACK_API_KEY", "WORLDS_NEWS_API_KEY"):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("SAMBA_URL", "http://samba.test")
+os.environ.setdefault("GMAIL_HOST_USER", "user@example.com")
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="samba-agent-tests-"))
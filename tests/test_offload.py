@@ -0,0 +1,83 @@
+import asyncio
+from functools import partial
+from io import BytesIO
+from types import SimpleNamespace
+
+import httpx
+import numpy as np
+import openai
+from PIL import Image
+
+from src.offload import offload
+from src.profiling import LoopWatchdog
+from src.settings import Settings
+from src.tools import news
+
+settings = Settings()
+
+COMPLETION: dict = {
+    "id": "completion",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "Llama-3.2-90B-Vision-Instruct",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Main headline"}}],
+}
+
+
+def front_page(width: int, height: int) -> bytes:
+    """Noise compresses badly, a high quality JPEG of it is as large as front page scans get."""
+    pixels: np.ndarray = np.random.default_rng(0).integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def decode_image(data: bytes) -> None:
+    with Image.open(BytesIO(data)) as img:
+        img.load()
+
+
+def test_large_image_tool_call_keeps_the_loop_responsive(monkeypatch):
+    image: bytes = front_page(width=4000, height=5000)
+    requests: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.host)
+        if request.url.host == "api.worldnewsapi.com":
+            return httpx.Response(200, json={"front_page": {"image": "https://images.test/front-page.jpg"}})
+        if request.url.host == "images.test":
+            return httpx.Response(200, content=image)
+        return httpx.Response(200, json=COMPLETION)
+
+    transport = httpx.MockTransport(handler)
+    samba_client = partial(openai.AsyncOpenAI, http_client=httpx.AsyncClient(transport=transport))
+    # Only the tool's own clients, the OpenAI client checks the httpx classes
+    monkeypatch.setattr(
+        news, "httpx", SimpleNamespace(AsyncClient=partial(httpx.AsyncClient, transport=transport), Response=httpx.Response)
+    )
+    monkeypatch.setattr(news, "AsyncOpenAI", samba_client)
+    monkeypatch.setattr(news, "show_image", decode_image)
+
+    async def main() -> float:
+        # Outside of the measurement: spawning the workers and the client's first request (lazy imports), which the
+        # completions of the turn have already paid for when a tool runs
+        await asyncio.gather(*(offload.run(news.encode_data_uri, b"warm up") for _ in range(offload.processes)))
+        await samba_client(api_key="test").chat.completions.create(messages=[{"role": "user", "content": "Hi"}], model="test")
+        requests.clear()
+        watchdog = LoopWatchdog(threshold=settings.loop_lag_threshold, interval=0.01)
+        watchdog.start()
+        try:
+            output: str = await news.NewspaperFrontTool(city="gb", source="the-guardian").run()
+            # Let the heartbeat record a stall at the very end
+            await asyncio.sleep(0.1)
+        finally:
+            watchdog.stop()
+            offload.shutdown()
+        assert output == "Main headline"
+        return watchdog.stats.max_lag
+
+    max_lag: float = asyncio.run(main())
+    assert requests == ["api.worldnewsapi.com", "images.test", "samba.test"]
+    assert (
+        max_lag < settings.loop_lag_threshold
+    ), f"max loop lag {max_lag * 1000:.1f} ms with a {len(image) / (1 << 20):.1f} MB image"
@@ -0,0 +1,185 @@
+import asyncio
+from time import monotonic
+
+import httpx
+import pytest
+
+from src.scheduler import ProviderPolicy, Scheduler
+
+
+def make_scheduler(**policy) -> Scheduler:
+    return Scheduler(policies={"api": ProviderPolicy(**{"base_delay": 0.01, **policy})})
+
+
+def make_client(handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://api.test")
+
+
+async def fetch(client: httpx.AsyncClient, path: str = "/") -> httpx.Response:
+    response: httpx.Response = await client.get(path)
+    response.raise_for_status()
+    return response
+
+
+def test_retry_after_pauses_the_bucket():
+    calls: list[float] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(monotonic())
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "0.3"})
+        return httpx.Response(200, text="ok")
+
+    async def main() -> None:
+        scheduler = make_scheduler(rate=100.0, burst=10)
+        async with make_client(handler) as client:
+            response = await scheduler.call("api", lambda: fetch(client))
+        assert response.text == "ok"
+        assert len(calls) == 2
+        assert calls[1] - calls[0] >= 0.3
+
+    asyncio.run(main())
+
+
+def test_client_errors_are_not_retried():
+    calls: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(400)
+
+    async def main() -> None:
+        scheduler = make_scheduler()
+        async with make_client(handler) as client:
+            with pytest.raises(httpx.HTTPStatusError):
+                await scheduler.call("api", lambda: fetch(client))
+        assert len(calls) == 1
+
+    asyncio.run(main())
+
+
+def test_token_bucket_limits_the_rate():
+    calls: list[float] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(monotonic())
+        return httpx.Response(200)
+
+    async def main() -> None:
+        scheduler = make_scheduler(rate=10.0, burst=2)
+        async with make_client(handler) as client:
+            await asyncio.gather(*(scheduler.call("api", lambda: fetch(client)) for _ in range(5)))
+        # The burst goes out at once, the other three wait for a token each
+        assert calls[1] - calls[0] < 0.05
+        assert calls[-1] - calls[0] >= 0.25
+
+    asyncio.run(main())
+
+
+def test_timed_out_requests_are_only_retried_if_idempotent():
+    calls: list[httpx.Request] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        await asyncio.sleep(0.2)
+        return httpx.Response(200)
+
+    async def main() -> None:
+        scheduler = make_scheduler(timeout=0.05, max_attempts=3)
+        async with make_client(handler) as client:
+            with pytest.raises(TimeoutError):
+                await scheduler.call("api", lambda: fetch(client), idempotent=False)
+            assert len(calls) == 1
+            with pytest.raises(TimeoutError):
+                await scheduler.call("api", lambda: fetch(client))
+            assert len(calls) == 4
+
+    asyncio.run(main())
+
+
+def warm_up(scheduler: Scheduler, seconds: float = 0.01, samples: int = 20) -> None:
+    for _ in range(samples):
+        scheduler.providers["api"].latency.record(seconds)
+
+
+def test_slow_request_is_hedged_and_the_loser_discarded():
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/primary":
+            await asyncio.sleep(0.1)
+        return httpx.Response(200, text=request.url.path)
+
+    async def main() -> None:
+        scheduler = make_scheduler(rate=100.0, burst=10, hedge=True)
+        warm_up(scheduler)
+        discarded: list[httpx.Response] = []
+
+        async def discard(response: httpx.Response) -> None:
+            discarded.append(response)
+
+        async with make_client(handler) as client:
+            _now: float = monotonic()
+            response = await scheduler.call(
+                "api", lambda: fetch(client, "/primary"), hedge=lambda: fetch(client, "/fallback"), discard=discard
+            )
+            assert response.text == "/fallback"
+            assert monotonic() - _now < 0.1
+            # The primary request was cancelled, nothing came back to release
+            await asyncio.sleep(0.15)
+            assert discarded == []
+
+    asyncio.run(main())
+
+
+def test_fast_request_is_not_hedged():
+    paths: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        paths.append(request.url.path)
+        return httpx.Response(200, text=request.url.path)
+
+    async def main() -> None:
+        scheduler = make_scheduler(rate=100.0, burst=10, hedge=True)
+        warm_up(scheduler, seconds=1.0)
+        async with make_client(handler) as client:
+            response = await scheduler.call("api", lambda: fetch(client, "/primary"), hedge=lambda: fetch(client, "/fallback"))
+        assert response.text == "/primary"
+        assert paths == ["/primary"]
+
+    asyncio.run(main())
+
+
+def test_failed_request_falls_back_to_the_hedge():
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/primary":
+            await asyncio.sleep(0.05)
+            return httpx.Response(503)
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, text=request.url.path)
+
+    async def main() -> None:
+        scheduler = make_scheduler(rate=100.0, burst=10, hedge=True, max_attempts=1)
+        warm_up(scheduler)
+        async with make_client(handler) as client:
+            response = await scheduler.call("api", lambda: fetch(client, "/primary"), hedge=lambda: fetch(client, "/fallback"))
+        assert response.text == "/fallback"
+
+    asyncio.run(main())
+
+
+def test_blocking_calls_retry_and_share_the_bucket():
+    calls: list[float] = []
+
+    def request() -> str:
+        calls.append(monotonic())
+        if len(calls) == 1:
+            raise httpx.ConnectError("refused")
+        return "ok"
+
+    async def main() -> None:
+        scheduler = make_scheduler(rate=10.0, burst=1)
+        # A worker thread takes its tokens from the same bucket as the event loop
+        assert await asyncio.to_thread(scheduler.call_blocking, "api", request) == "ok"
+        assert len(calls) == 2
+        assert calls[1] - calls[0] >= 0.09
+
+    asyncio.run(main())
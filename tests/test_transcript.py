@@ -0,0 +1,61 @@
+import json
+
+from src.memory import conversation_turns
+from src.persistence import load_transcript, save_transcript
+from src.transcript import Transcript
+
+
+def conversation() -> list[list[dict]]:
+    return [
+        [{"role": "system", "content": "You are Jarvis."}, {"role": "user", "content": "Weather in London?"}],
+        [{"role": "assistant", "content": '<tool>{"name": "get_weather_data"}</tool>'}, {"role": "ipython", "content": "Sunny"}],
+        [{"role": "assistant", "content": "It is sunny."}, {"role": "user", "content": "Thanks"}],
+        [{"role": "assistant", "content": "You're welcome."}],
+    ]
+
+
+def test_saved_transcript_is_appended_and_loads_back(tmp_path):
+    transcript = Transcript(conversation_id="conversation")
+    messages: list[dict] = []
+    sizes: list[int] = []
+    for new in conversation():
+        messages.extend(new)
+        transcript.record(messages=messages, metadata={"model": "llama3-405b"})
+        save_transcript(transcript=transcript, directory=tmp_path)
+        sizes.append((tmp_path / "conversation.jsonl").stat().st_size)
+
+    # Every save appends its own messages only
+    lines: list[str] = (tmp_path / "conversation.jsonl").read_text().splitlines()
+    assert len(lines) == 1 + len(messages) + len(conversation())
+    assert sizes == sorted(sizes)
+
+    loaded: Transcript = load_transcript(path=tmp_path / "conversation.jsonl")
+    assert [loaded.messages(index=i) for i in range(len(loaded.snapshots))] == [
+        transcript.messages(index=i) for i in range(len(transcript.snapshots))
+    ]
+    assert [s.metadata for s in loaded.snapshots] == [s.metadata for s in transcript.snapshots]
+    assert loaded.pending() == ""
+    assert conversation_turns(transcript=loaded) == [
+        "User: Weather in London?\nAssistant: It is sunny.",
+        "User: Thanks\nAssistant: You're welcome.",
+    ]
+
+
+def test_line_cut_short_ends_the_transcript(tmp_path):
+    transcript = Transcript(conversation_id="conversation")
+    messages: list[dict] = [*conversation()[0], {"role": "assistant", "content": "Sunny."}]
+    transcript.record(messages=messages, metadata={})
+    path = tmp_path / "conversation.jsonl"
+    path.write_text(transcript.pending() + '{"message": {"role": "us')
+
+    assert load_transcript(path=path).messages() == messages
+
+
+def test_chat_history_files_still_load(tmp_path):
+    messages: list[dict] = [*conversation()[0], {"role": "assistant", "content": "Sunny."}]
+    chat_history: dict = {"conversation_id": "old", "content": [{"messages": messages[:2]}, {"messages": messages}]}
+    (tmp_path / "old.json").write_text(json.dumps(chat_history, indent=4))
+
+    assert conversation_turns(transcript=load_transcript(path=tmp_path / "old.json")) == [
+        "User: Weather in London?\nAssistant: Sunny."
+    ]